@@ -11,14 +11,22 @@ import os
 
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
-
-from main_app.urls import websocket_urlpatterns
+from django.urls import re_path
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'CalculatorApp.settings')
 
 django_asgi_app = get_asgi_application()
 
-application = ProtocolTypeRouter({
-    "http": django_asgi_app,
+# app registry has to be ready before models are imported
+from main_app.urls import websocket_urlpatterns, stream_urlpatterns
+from main_app.writebehind import Lifespan
+from main_app.retention import StartRetention
+
+# history retention runs in the background of every server, see README
+application = StartRetention(ProtocolTypeRouter({
+    # streaming endpoints read request bodies incrementally, Django handles the rest
+    "http": URLRouter(stream_urlpatterns + [re_path(r"", django_asgi_app)]),
     "websocket": URLRouter(websocket_urlpatterns),
-})
\ No newline at end of file
+    # servers sending lifespan events get buffered results written on shutdown
+    "lifespan": Lifespan(),
+}))
\ No newline at end of file
@@ -11,8 +11,81 @@ ALLOWED_HOSTS = ['0.0.0.0', 'localhost']
 
 # Application definition
 EXE_PATH = BASE_DIR.parent/"build"/"app.exe"
+LIB_PATH = BASE_DIR.parent/"build"/"libcalculator.so"
 MAKE_PATH = BASE_DIR.parent/"Makefile"
 SYNC_PERIOD = 10 # seconds
+# Only the sync leader process runs the heartbeat; "redis" lock or "file" lock (single host)
+SYNC_LEADER_LOCK = "redis"
+SYNC_LEADER_TTL = SYNC_PERIOD * 3 # seconds until a dead leader's redis lock expires
+SYNC_LEADER_REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+SYNC_LEADER_LOCK_PATH = "/dev/shm/calc-sync-leader.lock" if os.path.isdir("/dev/shm") else BASE_DIR / "sync-leader.lock"
+
+# Evaluation limits
+CALC_MAX_CONCURRENCY = os.cpu_count() or 1 # calculator processes running at once
+CALC_MAX_QUEUE = 64 # interactive requests allowed to wait for a free slot
+# scheduler priority classes: /calc and WebSocket frames are interactive,
+# batch, stream and vector work is bulk; bulk leaves a quarter of the slots
+# to interactive work, with a single slot both share it and interactive
+# requests may wait for a running bulk evaluation
+CALC_SCHEDULER_CLASSES = {
+    "interactive": {"weight": 8, "max_concurrency": CALC_MAX_CONCURRENCY, "max_waiting": CALC_MAX_QUEUE},
+    "bulk": {"weight": 1, "max_concurrency": max(1, CALC_MAX_CONCURRENCY * 3 // 4), "max_waiting": 1024},
+}
+CALC_TIMEOUT = 5 # seconds, per-request deadline including queue wait
+# "pool" - persistent app.exe --serve workers, "library" - in-process libcalculator.so,
+# "process" - spawn app.exe per request
+CALC_BACKEND = "pool"
+CALC_WORKERS = os.cpu_count() or 1
+CALC_WORKER_MAX_REQUESTS = 10000 # recycle worker after this many requests
+CALC_WORKER_HEALTH_INTERVAL = 30 # seconds
+# admission control: per-client token buckets (one token per evaluation) and
+# shedding while a scheduler class is backed up
+CALC_RATE_LIMIT = 50 # tokens per second per client
+CALC_RATE_BURST = 100
+CALC_API_KEY_HEADER = "X-Api-Key"
+CALC_API_KEYS = {} # API key -> {"rate": ..., "burst": ...}, other clients are limited by IP
+CALC_RATE_MAX_CLIENTS = 10000 # buckets kept in memory
+CALC_SHED_QUEUE_RATIO = 0.8 # shed when a class queue is this full
+CALC_SHED_MAX_WAIT = CALC_TIMEOUT / 2 # or its oldest request waited this long, seconds
+CALC_BATCH_MAX_ITEMS = 1000 # expressions accepted by /calc/batch
+CALC_BATCH_CONCURRENCY = CALC_MAX_CONCURRENCY # evaluations in flight per batch or stream
+CALC_STREAM_WINDOW = 256 # /calc/stream lines read but not answered yet
+CALC_STREAM_MAX_LINE = 1024 * 1024 # bytes per /calc/stream line
+CALC_STREAM_FLUSH_ROWS = 500 # /calc/stream history rows per INSERT
+CALC_SYNC_CHUNK_ROWS = 500 # history rows per sync frame and per query
+CALC_HISTORY_PAGE_ROWS = 100 # GET /history rows per page by default
+CALC_HISTORY_MAX_ROWS = 1000 # largest limit= it accepts
+CALC_WS_MAX_IN_FLIGHT = 64 # calculation frames pending per /ws/sync socket
+CALC_WS_OUTBOX_BYTES = 1024 * 1024 # unsent bytes per socket before sync frames are coalesced
+CALC_WS_MAX_LAG = 30 # seconds a socket may leave a frame unread before it is closed
+CALC_WS_PING_INTERVAL = 20 # seconds of client silence before a ping
+CALC_WS_PING_TIMEOUT = 20 # seconds to answer it
+# write-behind: results are stored in batches; without waiting they get ids
+# at once, a crash loses the rows still buffered and only one process may write
+CALC_WRITE_BEHIND = False # off: every result is committed before it is answered
+CALC_WRITE_BEHIND_WAIT = True # answer once the batch holding the result is committed
+CALC_WRITE_BEHIND_ROWS = 500 # buffered rows starting a flush
+CALC_WRITE_BEHIND_DELAY = 0.005 # seconds a buffered row waits for a flush at most
+CALC_WRITE_BEHIND_MAX_ROWS = 10000 # buffered rows before new results wait for a flush
+CALC_WRITE_BEHIND_ID_BLOCK = 10000 # ids reserved at a time without waiting
+# history retention: a row expires if any policy set expires it (None is off)
+CALC_RETENTION_MAX_AGE = None # seconds a row is kept
+CALC_RETENTION_MAX_ROWS = None # newest rows kept
+CALC_RETENTION_KEEP_PER_MODE = None # newest rows kept of each mode (int, float)
+CALC_RETENTION_ARCHIVE = "table" # "table" (calc_result_archive), "file" (gzipped NDJSON) or None to only delete
+CALC_RETENTION_ARCHIVE_PATH = BASE_DIR / "archive" # directory of "file" segments
+CALC_RETENTION_BATCH_ROWS = 1000 # rows archived and deleted per transaction
+CALC_RETENTION_PERIOD = 3600 # seconds between background runs, None leaves them to `manage.py retention`
+# one process runs retention, elected like the sync leader (SYNC_LEADER_LOCK) with a lock of its own
+CALC_RETENTION_LOCK_PATH = "/dev/shm/calc-retention.lock" if os.path.isdir("/dev/shm") else BASE_DIR / "retention.lock"
+CALC_VECTOR_MAX_ELEMENTS = 100000 # elements per /calc/vector variable list
+
+# Result cache
+CALC_CACHE_MAX_ENTRIES = 10000 # per-process LRU tier
+CALC_CACHE_TTL = 300 # seconds
+CALC_CACHE_MAX_KEY_LENGTH = 4096 # longer expressions are not cached
+CALC_CACHE_SHARED_PATH = "/dev/shm/calc-cache" if os.path.isdir("/dev/shm") else None # host-wide tier, None disables
+CALC_CACHE_SHARED_SLOTS = 65536 # 256 bytes each
 
 INSTALLED_APPS = [
     'daphne',
@@ -36,11 +109,38 @@ ROOT_URLCONF = 'CalculatorApp.urls'
 WSGI_APPLICATION = 'CalculatorApp.wsgi.application'
 ASGI_APPLICATION = 'CalculatorApp.asgi.application'
 
+# SQLite setup run on every new connection: WAL lets readers and the
+# writer work at once, NORMAL sync is still safe from corruption in WAL
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024 # bytes of the database file read through mmap
+SQLITE_CACHE_SIZE = 64 * 1024 # KiB of page cache per connection
+SQLITE_PRAGMAS = (
+    f"PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; "
+    f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}; PRAGMA cache_size=-{SQLITE_CACHE_SIZE}"
+)
+HISTORY_DB = 'history' # read-only alias serving history queries
+CALC_DB_READERS = 4 # threads (and connections) serving history queries
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'CONN_MAX_AGE': None, # kept by main_app.database threads
+        'OPTIONS': {
+            'init_command': SQLITE_PRAGMAS,
+            # take the write lock up front, a deferred transaction upgrading
+            # to a writer fails at once in WAL mode
+            'transaction_mode': 'IMMEDIATE',
+        },
+    },
+    HISTORY_DB: {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': None,
+        'OPTIONS': {
+            'init_command': SQLITE_PRAGMAS + "; PRAGMA query_only=ON",
+        },
+        'TEST': {'MIRROR': 'default'},
+    },
 }
 
 # Internationalization
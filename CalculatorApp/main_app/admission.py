@@ -0,0 +1,165 @@
+import math
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.http import HttpResponse
+
+from main_app.scheduler import get_scheduler
+
+RATE_LIMITED = 429
+OVERLOADED = 503
+
+
+class TokenBucket:
+    """
+    Refills `rate` tokens per second up to `burst`; an evaluation costs one
+    token, a batch one per item
+
+    Parameters
+    ----------
+        rate (float): tokens added per second
+        burst (float): bucket capacity
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, cost: float) -> float:
+        """Takes cost tokens and returns 0, or seconds until they are available"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # a request bigger than the bucket needs a full one
+        cost = min(cost, self.burst)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """
+    Decides whether a request may be queued for evaluation at all. Requests
+    are shed with 503 while the scheduler class they would wait in is
+    backed up (queue filled to `shed_queue_ratio` of its limit or its
+    oldest request waiting longer than `shed_max_wait`), then rate limited
+    with 429 by the client's token bucket. Clients are identified by a
+    configured API key or by IP address. All state is in process memory,
+    so rejecting costs no database access or subprocess
+
+    Parameters
+    ----------
+        rate (float): tokens per second of a client without an API key
+        burst (float): bucket capacity of a client without an API key
+        api_keys (dict): API key -> {"rate", "burst"}
+        max_clients (int): buckets kept, least recently seen are dropped
+        shed_queue_ratio (float): queue fill which starts shedding
+        shed_max_wait (float): seconds of oldest wait which starts shedding
+    """
+    def __init__(self, rate: float, burst: float, api_keys: dict, max_clients: int,
+                 shed_queue_ratio: float, shed_max_wait: float):
+        self.rate = rate
+        self.burst = burst
+        self.api_keys = api_keys
+        self.max_clients = max_clients
+        self.shed_queue_ratio = shed_queue_ratio
+        self.shed_max_wait = shed_max_wait
+        self.admitted = 0
+        self.rate_limited = 0
+        self.shed = 0
+        self._buckets = OrderedDict() # client id -> TokenBucket
+
+    def client_id(self, api_key: str, address: str) -> str:
+        if api_key in self.api_keys:
+            return f"key:{api_key}"
+        # unknown keys are ignored, otherwise a client could mint fresh buckets
+        return f"ip:{address}"
+
+    def _bucket(self, client: str) -> TokenBucket:
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            limits = self.api_keys.get(client[4:], {}) if client.startswith("key:") else {}
+            bucket = TokenBucket(limits.get("rate", self.rate), limits.get("burst", self.burst))
+            self._buckets[client] = bucket
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+        return bucket
+
+    def overload(self, priority: str) -> float:
+        """Returns 0, or estimated seconds until the class queue drains if it is backed up"""
+        cls = get_scheduler().classes[priority]
+        if len(cls.queue) < cls.max_waiting * self.shed_queue_ratio and cls.oldest_wait < self.shed_max_wait:
+            return 0.0
+        return max(cls.drain_time(), cls.oldest_wait, 1.0)
+
+    def degraded(self) -> float:
+        """Returns 0, or Retry-After seconds if any class is shedding"""
+        return max(self.overload(priority) for priority in get_scheduler().classes)
+
+    def check(self, client: str, priority: str, cost: int = 1):
+        """Returns None if request is admitted, (status, Retry-After seconds) otherwise"""
+        retry_after = self.overload(priority)
+        if retry_after:
+            self.shed += 1
+            return (OVERLOADED, math.ceil(retry_after))
+        retry_after = self._bucket(client).take(cost)
+        if retry_after:
+            self.rate_limited += 1
+            return (RATE_LIMITED, math.ceil(retry_after))
+        self.admitted += 1
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "admitted": self.admitted,
+            "rate_limited": self.rate_limited,
+            "shed": self.shed,
+            "clients": len(self._buckets),
+        }
+
+
+_admission = None
+
+def get_admission() -> AdmissionController:
+    """Returns process-wide admission controller configured from settings"""
+    global _admission
+    if _admission is None:
+        _admission = AdmissionController(
+            settings.CALC_RATE_LIMIT,
+            settings.CALC_RATE_BURST,
+            settings.CALC_API_KEYS,
+            settings.CALC_RATE_MAX_CLIENTS,
+            settings.CALC_SHED_QUEUE_RATIO,
+            settings.CALC_SHED_MAX_WAIT,
+        )
+    return _admission
+
+
+def rejection_response(status: int, retry_after: int) -> HttpResponse:
+    message = "Too many requests" if status == RATE_LIMITED else "Server is overloaded"
+    response = HttpResponse(message, status=status)
+    response["Retry-After"] = str(retry_after)
+    return response
+
+
+def admit(request, priority: str, cost: int = 1):
+    """Returns a 429/503 response if request is rejected, None if it may go on"""
+    admission = get_admission()
+    client = admission.client_id(request.headers.get(settings.CALC_API_KEY_HEADER), request.META.get("REMOTE_ADDR"))
+    rejection = admission.check(client, priority, cost)
+    return rejection_response(*rejection) if rejection else None
+
+
+def admit_scope(scope, priority: str, cost: int = 1):
+    """admit() for raw ASGI apps and consumers, returns (status, Retry-After) or None"""
+    header = settings.CALC_API_KEY_HEADER.lower().encode("latin-1")
+    api_key = next((value.decode("latin-1") for name, value in scope.get("headers", []) if name == header), None)
+    address = scope["client"][0] if scope.get("client") else None
+    admission = get_admission()
+    return admission.check(admission.client_id(api_key, address), priority, cost)
@@ -0,0 +1,261 @@
+import os
+import re
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+from collections import OrderedDict
+from django.conf import settings
+
+OK = "OK"
+ERR = "ERR"
+WHITESPACE_RUN_RE = re.compile(r"[ \t\n\v\f\r]+") # C isspace(), other spaces are invalid input
+DIGITS = "0123456789"
+
+
+def canonicalize(expression: str) -> str:
+    """
+    Strips whitespace app.exe skips, except between two digits: "1 2" is
+    invalid input while "12" is not, so such runs collapse to a single
+    space instead of disappearing. Other characters, Unicode spaces
+    included, are kept: app.exe rejects them, so they must not share a
+    key with an expression without them
+    """
+    def collapse(match):
+        before = expression[match.start() - 1] if match.start() > 0 else ""
+        after = expression[match.end()] if match.end() < len(expression) else ""
+        return " " if before and after and before in DIGITS and after in DIGITS else ""
+    return WHITESPACE_RUN_RE.sub(collapse, expression)
+
+
+class LocalCache:
+    """
+    Per-process LRU tier with entry count and TTL limits
+
+    Parameters
+    ----------
+        max_entries (int): entries kept before least recently used ones are evicted
+        ttl (float): seconds an entry stays valid
+    """
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict() # key -> (expires_at, outcome)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, outcome = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return outcome
+
+    def put(self, key, outcome):
+        self._entries[key] = (time.monotonic() + self.ttl, outcome)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class SharedCache:
+    """
+    Host-wide tier: fixed-size hash table in a memory-mapped file that
+    every server process opens. Keys hash into 4-slot buckets; a full
+    bucket overwrites its oldest entry. Readers take a shared flock and
+    writers an exclusive one, so concurrent processes never see torn slots
+
+    Slot layout: key hash (8), expires at (8, unix time), status (1),
+    key length (2), value length (2), key bytes, value bytes
+
+    Parameters
+    ----------
+        path (str): backing file, /dev/shm keeps it in memory
+        slots (int): number of slots in the table
+        ttl (float): seconds an entry stays valid
+    """
+    MAGIC = b"CALCCSH1"
+    HEADER = struct.Struct("<8sII") # magic, slots, slot size
+    SLOT_HEADER = struct.Struct("<QdBHH")
+    SLOT_SIZE = 256
+    BUCKET = 4
+
+    def __init__(self, path: str, slots: int, ttl: float):
+        self.slots = max(slots - slots % self.BUCKET, self.BUCKET)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self.HEADER.size + self.slots * self.SLOT_SIZE
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self._fd, self.HEADER.size, 0)
+            if header != self.HEADER.pack(self.MAGIC, self.slots, self.SLOT_SIZE):
+                # new file or different layout - start from an empty table
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, self.HEADER.pack(self.MAGIC, self.slots, self.SLOT_SIZE), 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+
+    @staticmethod
+    def _hash(key: bytes) -> int:
+        # builtin hash() is salted per process, shared table needs a stable one
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+    def _offset(self, slot: int) -> int:
+        return self.HEADER.size + slot * self.SLOT_SIZE
+
+    def _read_slot(self, slot: int):
+        offset = self._offset(slot)
+        key_hash, expires_at, status, key_len, value_len = self.SLOT_HEADER.unpack_from(self._map, offset)
+        data_offset = offset + self.SLOT_HEADER.size
+        key = self._map[data_offset:data_offset + key_len]
+        value = self._map[data_offset + key_len:data_offset + key_len + value_len]
+        return key_hash, expires_at, status, key, value
+
+    def fits(self, key: bytes, value: bytes) -> bool:
+        return self.SLOT_HEADER.size + len(key) + len(value) <= self.SLOT_SIZE
+
+    def get(self, key: bytes):
+        key_hash = self._hash(key)
+        first = key_hash % self.slots // self.BUCKET * self.BUCKET
+        now = time.time()
+        fcntl.flock(self._fd, fcntl.LOCK_SH)
+        try:
+            for slot in range(first, first + self.BUCKET):
+                slot_hash, expires_at, status, slot_key, value = self._read_slot(slot)
+                if slot_hash == key_hash and slot_key == key and expires_at >= now:
+                    self.hits += 1
+                    return (OK if status == 0 else ERR, value.decode("utf-8"))
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self.misses += 1
+        return None
+
+    def put(self, key: bytes, outcome):
+        status, payload = outcome
+        value = payload.encode("utf-8")
+        if not self.fits(key, value):
+            return
+        key_hash = self._hash(key)
+        first = key_hash % self.slots // self.BUCKET * self.BUCKET
+        now = time.time()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            # same key, otherwise the slot expiring first (empty slots expire at 0)
+            target, oldest, oldest_expires = None, None, None
+            for slot in range(first, first + self.BUCKET):
+                slot_hash, expires_at, _, slot_key, _ = self._read_slot(slot)
+                if slot_hash == key_hash and slot_key == key:
+                    target = slot
+                    break
+                if oldest is None or expires_at < oldest_expires:
+                    oldest, oldest_expires = slot, expires_at
+            if target is None:
+                target = oldest
+                if oldest_expires >= now:
+                    self.evictions += 1
+            offset = self._offset(target)
+            self.SLOT_HEADER.pack_into(
+                self._map, offset, key_hash, now + self.ttl, 0 if status == OK else 1, len(key), len(value)
+            )
+            data_offset = offset + self.SLOT_HEADER.size
+            self._map[data_offset:data_offset + len(key) + len(value)] = key + value
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def stats(self) -> dict:
+        return {
+            "slots": self.slots,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class ResultCache:
+    """
+    Two-tier cache of evaluation outcomes keyed by (mode, canonical
+    expression). Outcomes are ("OK", result) or ("ERR", exit code) pairs,
+    so rejected expressions are cached as well. Local hits are served
+    first, shared hits are promoted into the local tier
+    """
+    def __init__(self, local: LocalCache, shared: SharedCache = None, max_key_length: int = 4096):
+        self.local = local
+        self.shared = shared
+        self.max_key_length = max_key_length
+        self.skipped = 0
+
+    def make_key(self, mode_str: str, expression: str):
+        canonical = canonicalize(expression)
+        if len(canonical) > self.max_key_length:
+            # huge expressions would only wash other entries out
+            self.skipped += 1
+            return None
+        return f"{mode_str} {canonical}"
+
+    def get(self, key: str):
+        outcome = self.local.get(key)
+        if outcome is None and self.shared is not None:
+            outcome = self.shared.get(key.encode("utf-8"))
+            if outcome is not None:
+                self.local.put(key, outcome)
+        return outcome
+
+    def put(self, key: str, outcome):
+        self.local.put(key, outcome)
+        if self.shared is not None:
+            self.shared.put(key.encode("utf-8"), outcome)
+
+    def stats(self) -> dict:
+        return {
+            "local": self.local.stats(),
+            "shared": self.shared.stats() if self.shared is not None else None,
+            "skipped": self.skipped,
+        }
+
+
+_cache = None
+
+def get_cache() -> ResultCache:
+    """Returns process-wide result cache configured from settings"""
+    global _cache
+    if _cache is None:
+        shared = None
+        if settings.CALC_CACHE_SHARED_PATH:
+            shared = SharedCache(
+                settings.CALC_CACHE_SHARED_PATH,
+                settings.CALC_CACHE_SHARED_SLOTS,
+                settings.CALC_CACHE_TTL,
+            )
+        _cache = ResultCache(
+            LocalCache(settings.CALC_CACHE_MAX_ENTRIES, settings.CALC_CACHE_TTL),
+            shared,
+            settings.CALC_CACHE_MAX_KEY_LENGTH,
+        )
+    return _cache
@@ -0,0 +1,151 @@
+import re
+import zlib
+import datetime
+
+JSON = "json" # text frames, default
+BINARY = "binary" # columnar binary frames
+BINARY_ZLIB = "binary-zlib" # binary frames with zlib compressed rows
+ENCODINGS = (JSON, BINARY, BINARY_ZLIB)
+
+# binary frame kinds, low bits of the first byte
+SNAPSHOT = 1
+SNAPSHOT_CHUNK = 2
+SNAPSHOT_END = 3
+DELTA = 4
+PACKED_EXPRESSIONS = 0x10 # expressions are packed two symbols a byte
+PACKED_RESULTS = 0x20 # results are packed two symbols a byte
+MORE = 0x40 # snapshot continues in chunks
+ZLIB = 0x80 # rows are zlib compressed
+
+COMPRESS_MIN = 64 # rows shorter than this are sent as they are
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# the 16 symbols of packed columns, in nibble order: stored expressions
+# are what app.exe accepts without spaces, results what "%ld" and "%.4f"
+# print, inf and nan included
+EXPRESSION_SYMBOLS = "0123456789+-*/()"
+RESULT_SYMBOLS = "0123456789-.naif"
+HEX_DIGITS = "0123456789abcdef"
+
+
+def validate_encoding(encoding) -> str:
+    if encoding not in ENCODINGS:
+        raise Exception("Incorrect encoding value")
+    return encoding
+
+
+def _varint(value: int, out: bytearray):
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _timestamp_us(timestamp: datetime.datetime) -> int:
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (timestamp - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+class _Packing:
+    """Packs strings of 16 symbols into nibbles, through hex digits"""
+    def __init__(self, symbols: str):
+        self.only = re.compile("[%s]*" % re.escape(symbols))
+        self.to_hex = str.maketrans(symbols, HEX_DIGITS)
+
+    def pack(self, text: str):
+        """Bytes of text, None if it has other characters"""
+        if not self.only.fullmatch(text):
+            return None
+        if len(text) % 2:
+            text += "0"
+        return bytes.fromhex(text.translate(self.to_hex))
+
+
+_PACKINGS = ((1, PACKED_EXPRESSIONS, _Packing(EXPRESSION_SYMBOLS)), (2, PACKED_RESULTS, _Packing(RESULT_SYMBOLS)))
+
+
+def encode_rows(rows: list, base_id: int = 0) -> tuple:
+    """
+    (flags, bytes) of rows as columns: count, ids as differences from the
+    previous one (the first from base_id), timestamps (microseconds since
+    the epoch) as zigzag differences, then lengths of expressions and
+    their text, lengths of results and their text. A column is packed two
+    symbols a byte, high nibble first, if every value of it has only its
+    symbols, and flagged so; otherwise it is UTF-8
+    """
+    flags = 0
+    out = bytearray()
+    _varint(len(rows), out)
+    previous = base_id
+    for row in rows:
+        _varint(row[0] - previous, out)
+        previous = row[0]
+    previous = 0
+    for row in rows:
+        stamp = _timestamp_us(row[3])
+        difference = stamp - previous
+        _varint(difference << 1 if difference >= 0 else (~difference << 1) | 1, out)
+        previous = stamp
+    for column, flag, packing in _PACKINGS:
+        values = [row[column] for row in rows]
+        packed = packing.pack("".join(values))
+        if packed is None:
+            values = [value.encode("utf-8") for value in values]
+        for value in values:
+            _varint(len(value), out)
+        if packed is None:
+            for value in values:
+                out += value
+        else:
+            flags |= flag
+            out += packed
+    return flags, out
+
+
+def encode_frame(encoding: str, kind: int, header: tuple, rows=None):
+    """
+    Sync frame of a kind in an encoding. Header is (version, more) for
+    SNAPSHOT, () for SNAPSHOT_CHUNK, (version,) for SNAPSHOT_END and
+    (from, version) for DELTA. For JSON rows are rows encoded by
+    encode_row(), otherwise (id, expression, result, timestamp, ...)
+    tuples; JSON frames are str, binary ones bytes. A binary delta holds
+    its version as the difference from its from
+    """
+    if encoding == JSON:
+        joined = ", ".join(rows) if rows is not None else ""
+        if kind == SNAPSHOT:
+            return '{"type": "snapshot", "version": %d, "rows": [%s], "more": %s}' % (
+                header[0], joined, "true" if header[1] else "false"
+            )
+        if kind == SNAPSHOT_CHUNK:
+            return '{"type": "snapshot.chunk", "rows": [%s]}' % joined
+        if kind == SNAPSHOT_END:
+            return '{"type": "snapshot.end", "version": %d}' % header
+        return '{"type": "delta", "from": %d, "version": %d, "rows": [%s]}' % (*header, joined)
+    out = bytearray(1)
+    first = kind
+    if kind == SNAPSHOT:
+        first |= MORE if header[1] else 0
+        header = header[:1]
+    elif kind == DELTA:
+        header = (header[0], header[1] - header[0])
+    for value in header:
+        _varint(value, out)
+    if rows is not None:
+        # delta rows are newer than its from
+        flags, body = encode_rows(rows, header[0] if kind == DELTA else 0)
+        first |= flags
+        if encoding == BINARY_ZLIB and len(body) >= COMPRESS_MIN:
+            packed = zlib.compress(body)
+            if len(packed) < len(body):
+                body = packed
+                first |= ZLIB
+        out += body
+    out[0] = first
+    return bytes(out)
+
+
+def row_values(row: dict) -> tuple:
+    """(id, expression, result, timestamp) of a serialized row"""
+    return (row["id"], row["expression"], row["result"], datetime.datetime.fromisoformat(row["timestamp"]))
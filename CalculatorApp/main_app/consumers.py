@@ -1,54 +1,474 @@
+import re
 import json
+import time
 import asyncio
-from channels.layers import get_channel_layer
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.conf import settings
 
-from main_app.utils import get_result_history
+from main_app.models import CalculatedResult
+from main_app.writebehind import store_results
+from main_app.serializers import CalculatedResultSerializer
+from main_app.utils import (
+    validate_batch_item, evaluate_expression, evaluation_error,
+)
+from main_app.scheduler import INTERACTIVE
+from main_app.sync import SYNC_GROUP, heartbeat, get_watcher
+from main_app.leader import get_leader_lock
+from main_app.fanout import get_hub
+from main_app.outbox import Outbox
+from main_app.snapshot import get_snapshot
+from main_app.subscription import Subscription
+from main_app.codec import JSON, DELTA, validate_encoding, encode_frame, row_values
+from main_app.admission import admit_scope, RATE_LIMITED
+
+REAP_PERIOD = 1 # seconds between liveness checks of all sockets
+LAGGARD_CLOSE_CODE = 4000 # client stayed behind longer than CALC_WS_MAX_LAG
+IDLE_CLOSE_CODE = 4001 # client didn't answer a ping
+SUBSCRIPTION_CLOSE_CODE = 4002 # invalid subscription or encoding parameters
+FLOOD_CLOSE_CODE = 4003 # client kept sending calculations without reading replies
+STATS_TOP_CONNECTIONS = 10 # deepest outbound queues listed in stats
+CLIENT_VERSION = -1 # catch-up from the version the client has when it runs
 
 class SyncConsumer(AsyncWebsocketConsumer):
-    _connections = 0
+    """
+    History sync and calculation channel.
+
+    Clients connecting with `?since=<version>` use the versioned protocol:
+    they get `{"type": "snapshot", "version", "rows", "more"}` with the
+    whole history (since=0, unknown version or one from before the latest
+    retention run) or `{"type": "delta", "from", "version", "rows"}` with
+    rows newer than `from`, and later deltas only when history moves. History is sent CALC_SYNC_CHUNK_ROWS
+    rows per frame: a snapshot with `more` is continued by `{"type":
+    "snapshot.chunk", "rows"}` frames and completed by `{"type":
+    "snapshot.end", "version"}`, long deltas are split into consecutive
+    deltas. A delta applies on top of version `from`;
+    a client seeing a gap sends `{"type": "resync", "since": <version>}`
+    (without since for a full snapshot). History version is the id of
+    the newest row.
+
+    New rows are pushed as deltas right after they are stored; every
+    SYNC_PERIOD seconds a `{"type": "heartbeat", "version"}` tells
+    clients the newest version. Clients without `since` get the whole
+    history as a plain JSON list, on connect and whenever it changes.
+
+    Query parameters `last`, `after`, `own` with `session`, and `mode`
+    subscribe to a part of the history (see Subscription); snapshots,
+    deltas and legacy lists then carry only its rows. Versions stay global:
+    broadcasts without matching rows are skipped, so a delta may start
+    from the version of the previous one the client got, and heartbeats
+    tell the version the client is at. Subscribers with the same filters
+    and version share encoded delta frames. Invalid parameters close the
+    socket with SUBSCRIPTION_CLOSE_CODE and the error as reason.
+
+    `encoding=binary` or `encoding=binary-zlib` makes snapshots, chunks
+    and deltas binary frames (see codec.encode_frame()), other frames
+    stay JSON text.
+
+    After a retention run deleted rows, clients connected with
+    `expire=true` get `{"type": "expire", "until", "keep"}`: every row up
+    to `until` is gone but the ids in `keep`. Other versioned clients
+    which may hold deleted rows get a snapshot.
+
+    Consumers get `sync_group` messages from the process-wide fanout hub
+    rather than joining the group themselves.
+
+    Frames go through a bounded Outbox. Snapshots and catch-ups are
+    streamed by a task of their own, so calculations and pongs are handled
+    while a slow client reads them; sync messages arriving meanwhile, and
+    further resyncs, are merged into one more catch-up after it. Sync
+    frames a slow client can't take are coalesced into one catch-up sent
+    once it has read the queue;
+    a client behind for longer than CALC_WS_MAX_LAG is closed. Versioned
+    clients silent for CALC_WS_PING_INTERVAL get `{"type": "ping"}` and
+    are closed unless they send anything (e.g. `{"type": "pong"}`) within
+    CALC_WS_PING_TIMEOUT
+    """
+    _live = set() # connected consumers of this process
     _sync_task = None
+    _reap_task = None
+    reaped_laggards = 0
+    reaped_idle = 0
+    reaped_flooding = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._dispatch_lock = asyncio.Lock()
+        self._writer = None
+
+    async def dispatch(self, message):
+        # hub delivers group messages from its own task, keep handlers serial
+        async with self._dispatch_lock:
+            await super().dispatch(message)
 
     async def connect(self):
+        self._calc_tasks = set() # calculation frames in flight on this socket
+        params = parse_qs(self.scope["query_string"].decode("latin-1"))
+        since = params.get("since")
+        # unparsable version gets a full snapshot
+        self.since = (int(since[0]) if since[0].isdigit() else 0) if since else None
+        try:
+            self.subscription = Subscription(params)
+            self.encoding = validate_encoding(params.get("encoding", [JSON])[0])
+            expire = params.get("expire", ["false"])[0]
+            if expire not in ("false", "true"):
+                raise Exception("Incorrect expire value")
+            self.expire = expire == "true"
+        except Exception as e:
+            await self.accept()
+            await self.close(code=SUBSCRIPTION_CLOSE_CODE, reason=str(e))
+            return
+        self.version = None # last version sent to the client
+        self._seen = None # newest version whose rows were considered, skipped ones included
+        self._last_seen = time.monotonic()
+        self._ping_sent = None
+        self._closing = None
+        self._catching_up = None # task streaming catch-ups
+        self._catch_ups = [] # since of catch-ups requested for after the running one
+        self._outbox = Outbox(
+            lambda frame: self.send(bytes_data=frame) if isinstance(frame, bytes) else self.send(text_data=frame),
+            lambda: self._catch_up(CLIENT_VERSION),
+            settings.CALC_WS_OUTBOX_BYTES,
+        )
         await self.accept()
-        await self.channel_layer.group_add("sync_group", self.channel_name)
-        SyncConsumer._connections += 1
-        if SyncConsumer._connections == 1:
+        self._writer = asyncio.create_task(self._outbox.run())
+        await get_hub(SYNC_GROUP).subscribe(self)
+        SyncConsumer._live.add(self)
+        if len(SyncConsumer._live) == 1:
             SyncConsumer._sync_task = asyncio.create_task(
                 self._periodic_sync()
             )
+            SyncConsumer._reap_task = asyncio.create_task(self._reap())
         # initial sync
-        history = await get_result_history()
-        await self.send(text_data=json.dumps(history))
+        self._catch_up(self.since)
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard("sync_group", self.channel_name)
-        SyncConsumer._connections -= 1
-        
-        if SyncConsumer._connections == 0 and SyncConsumer._sync_task:
+        if self._writer is None:
+            return # subscription was rejected
+        for task in self._calc_tasks:
+            task.cancel()
+        if self._catching_up:
+            self._catching_up.cancel()
+        self._writer.cancel()
+        await get_hub(SYNC_GROUP).unsubscribe(self)
+        SyncConsumer._live.discard(self)
+
+        if not SyncConsumer._live and SyncConsumer._sync_task:
+            SyncConsumer._reap_task.cancel()
             SyncConsumer._sync_task.cancel()
             try:
                 await SyncConsumer._sync_task
             except asyncio.CancelledError:
                 pass
             SyncConsumer._sync_task = None
+            SyncConsumer._reap_task = None
 
     @staticmethod
     async def _periodic_sync():
-        """Background task that sends messages periodically"""
-        channel_layer = get_channel_layer()
+        """
+        Background heartbeat, also picks up rows written by other processes.
+        Every process with sockets runs it, but only the elected sync leader
+        sends heartbeats; the others keep trying to take over
+        """
+        lock = get_leader_lock()
+        try:
+            while True:
+                await asyncio.sleep(settings.SYNC_PERIOD)
+                try:
+                    was_leader = lock.leader
+                    if not await lock.elect():
+                        continue
+                    if not was_leader:
+                        # previous leader has published rows this process didn't see
+                        get_watcher().reset()
+                    await heartbeat()
+                except Exception as e:
+                    print(e)
+        finally:
+            try:
+                await lock.resign()
+            except Exception as e:
+                print(e)
+
+    @classmethod
+    async def _reap(cls):
+        """Background task closing sockets which stay behind or don't answer pings"""
         while True:
-            await asyncio.sleep(settings.SYNC_PERIOD)
-            history = await get_result_history()
-            await channel_layer.group_send(
-                "sync_group",
-                {
-                    "type": "sync.message",
-                    "message": json.dumps(history)
-                }
-            )
+            await asyncio.sleep(REAP_PERIOD)
+            now = time.monotonic()
+            for consumer in list(cls._live):
+                consumer._check_liveness(now)
+
+    def _check_liveness(self, now: float):
+        if self._closing:
+            return
+        if self._outbox.lag() > settings.CALC_WS_MAX_LAG:
+            SyncConsumer.reaped_laggards += 1
+            self._reap_socket(LAGGARD_CLOSE_CODE)
+        elif self.since is None:
+            return # legacy clients don't know pings
+        elif self._ping_sent is not None:
+            if now - self._ping_sent > settings.CALC_WS_PING_TIMEOUT:
+                SyncConsumer.reaped_idle += 1
+                self._reap_socket(IDLE_CLOSE_CODE)
+        elif now - self._last_seen > settings.CALC_WS_PING_INTERVAL:
+            self._ping_sent = now
+            self._outbox.put(json.dumps({"type": "ping"}), droppable=False)
+
+    def _reap_socket(self, code: int):
+        # queued frames are freed at once, the close frame skips the queue
+        self._writer.cancel()
+        self._outbox.close()
+        self._closing = asyncio.create_task(self.close(code=code))
+
+    def _send_sync(self, text, version: int = None):
+        """Queues droppable frame, rolls version back to the one client has if frames are dropped"""
+        if not self._outbox.put(text, version=version):
+            self.version = self._outbox.sent_version
+
+    def _reply(self, reply: dict):
+        self._outbox.put(json.dumps(reply), droppable=False, reply=True)
+
+    async def _stream(self, frame, version: int = None) -> bool:
+        """Queues frame of a multi-frame answer once the client has read up, False if socket is closed"""
+        await self._outbox.writable()
+        return self._outbox.put(frame, droppable=False, version=version)
+
+    def _catch_up(self, since):
+        """
+        Sends history from since (see _send_since, CLIENT_VERSION for the
+        version the client has by then) in the catch-up task. It waits for
+        the client to read, so it doesn't hold the dispatch lock, and the
+        outbox writer may call this while a handler waits for it
+        """
+        if since not in self._catch_ups:
+            self._catch_ups.append(since)
+        if self._catching_up is None:
+            self._catching_up = asyncio.create_task(self._run_catch_ups())
+
+    async def _run_catch_ups(self):
+        try:
+            while self._catch_ups and not self._outbox.closed:
+                requests, self._catch_ups = self._catch_ups, []
+                if self.since is None:
+                    await self._send_legacy_history()
+                    continue
+                # the oldest request covers all others, a snapshot covers everything
+                sinces = [self.version if since == CLIENT_VERSION else since for since in requests]
+                await self._send_since(min(sinces) if all(sinces) else 0)
+        finally:
+            self._catching_up = None
+
+    async def _send_legacy_history(self):
+        snapshot = get_snapshot()
+        self.version = self._seen = await snapshot.refresh()
+        self._send_sync(snapshot.view(self.subscription).legacy_text(), self.version)
+
+    async def _send_since(self, since):
+        """
+        Streams deltas from since, or snapshot if since is 0, None, unknown
+        here or not past the retention horizon: deltas only add rows, a
+        client that was away during a retention run may hold deleted ones
+        """
+        snapshot = get_snapshot()
+        version = await snapshot.refresh()
+        view = snapshot.view(self.subscription)
+        self._seen = version
+        if not since or since > version or since <= snapshot.horizon:
+            # rows added later come as deltas from version
+            self.version = version
+            frames = view.snapshot_frames(self.encoding)
+        else:
+            frames = view.delta_frames(since, self.encoding)
+        for frame, frame_version in frames:
+            if frame_version is not None:
+                self.version = frame_version
+            if not await self._stream(frame, frame_version):
+                return
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Handles `{id, expression, float}` calculation frames. Each one runs
+        in its own task so many can be in flight on one socket; replies are
+        `{id, result}` with the stored history row or `{id, error[, code]}`,
+        sent as soon as they are ready
+        """
+        self._last_seen = time.monotonic()
+        self._ping_sent = None
+        try:
+            frame = json.loads(text_data)
+            if isinstance(frame, dict) and frame.get("type") == "pong":
+                return
+            if isinstance(frame, dict) and frame.get("type") == "resync":
+                since = frame.get("since")
+                self._catch_up(since if isinstance(since, int) and since >= 0 else None)
+                return
+            if not isinstance(frame, dict) or "id" not in frame:
+                raise Exception("Calculation frame must be an object with an id")
+        except Exception as e:
+            self._reply({"id": None, "error": str(e)})
+            return
+        # replies the client hasn't read yet count as in flight
+        if len(self._calc_tasks) + self._outbox.replies >= settings.CALC_WS_MAX_IN_FLIGHT:
+            if self._closing:
+                return
+            if self._outbox.replies >= settings.CALC_WS_MAX_IN_FLIGHT:
+                # replies are never dropped, a client not reading them can't grow the queue
+                SyncConsumer.reaped_flooding += 1
+                self._reap_socket(FLOOD_CLOSE_CODE)
+                return
+            self._reply({"id": frame["id"], "error": "Too many requests in flight"})
+            return
+        if rejection := admit_scope(self.scope, INTERACTIVE):
+            status, retry_after = rejection
+            self._reply({
+                "id": frame["id"],
+                "error": "Too many requests" if status == RATE_LIMITED else "Server is overloaded",
+                "retry_after": retry_after,
+            })
+            return
+        task = asyncio.create_task(self._calculate(frame))
+        self._calc_tasks.add(task)
+        task.add_done_callback(self._calc_tasks.discard)
+
+    async def _calculate(self, frame):
+        reply = {"id": frame["id"]}
+        try:
+            float_mode, expression = validate_batch_item(frame)
+        except Exception as e:
+            reply["error"] = str(e)
+        else:
+            try:
+                result = await evaluate_expression(float_mode, expression)
+                res_obj = CalculatedResult(
+                    expression=re.sub(r"\s", "", expression),
+                    result=result,
+                    float_mode=float_mode,
+                    session=self.subscription.session,
+                )
+                await store_results([res_obj])
+                reply["result"] = CalculatedResultSerializer(res_obj).data
+            except Exception as e:
+                reply.update(evaluation_error(e))
+        self._reply(reply)
+
+    async def sync_delta(self, event):
+        """Handler for broadcast of rows added between two versions"""
+        # the heartbeat doesn't publish them again
+        get_watcher().announced(event["from"], event["version"])
+        if self._held_back(event):
+            return
+        if event["version"] <= self._seen:
+            return # already sent, e.g. by another writer's broadcast
+        if event["from"] > self._seen:
+            # rows between own version and this delta were missed
+            if self.since is None:
+                await self._send_legacy_history()
+            else:
+                self._catch_up(CLIENT_VERSION)
+            return
+        if self.since is None:
+            # legacy clients get the whole list again if it changed for them
+            if self.subscription.select(event["rows"], event["meta"], self._seen):
+                await self._send_legacy_history()
+            else:
+                self._seen = event["version"]
+            return
+        frame = self._delta_frame(event)
+        self._seen = event["version"]
+        if frame is None:
+            return # no rows the client subscribed to
+        self.version = event["version"]
+        self._send_sync(frame, self.version)
+
+    def _delta_frame(self, event) -> str:
+        """Delta with broadcast rows the client takes, None if there are none"""
+        # subscribers which are up to date get the same bytes, encode them once per filter set
+        shared = event.setdefault("frames", {})
+        key = (self.subscription.key, self.version, self.encoding)
+        up_to_date = event["from"] == self._seen
+        if up_to_date and key in shared:
+            return shared[key]
+        rows = self.subscription.select(event["rows"], event["meta"], self._seen)
+        if not rows:
+            frame = None
+        elif self.encoding == JSON:
+            frame = json.dumps({"type": "delta", "from": self.version, "version": event["version"], "rows": rows})
+        else:
+            frame = encode_frame(self.encoding, DELTA, (self.version, event["version"]), [row_values(row) for row in rows])
+        if up_to_date:
+            shared[key] = frame
+        return frame
+
+    def _held_back(self, event) -> bool:
+        """True if sync frames must wait for a pending or running catch-up, which then covers the event"""
+        if self._outbox.behind:
+            return True # catch-up is sent once the outbox drains
+        if self._catching_up is None:
+            return False
+        if self._seen is None or event["version"] > self._seen:
+            # the running catch-up may have read history before these rows
+            self._catch_up(CLIENT_VERSION)
+        return True
+
+    async def sync_heartbeat(self, event):
+        """Handler for periodic heartbeat, catches up clients which missed a delta"""
+        if self._held_back(event):
+            return
+        if self.since is None:
+            if event["version"] > self._seen:
+                await self._send_legacy_history()
+            return
+        if event["version"] > self._seen:
+            self._catch_up(CLIENT_VERSION)
+            return
+        self._send_sync(json.dumps({"type": "heartbeat", "version": self.version}))
+
+    async def sync_retention(self, event):
+        """Handler for broadcast of a retention run, tells the client which rows are gone"""
+        get_snapshot().expire(event["run"], event["version"])
+        if self._catching_up:
+            # it may be sending rows read before the run, replace them all
+            self._catch_up(0)
+            return
+        if self.since is None:
+            await self._send_legacy_history()
+            return
+        if self.expire:
+            # same for every client, encoded once
+            if "frame" not in event:
+                event["frame"] = json.dumps({"type": "expire", "until": event["until"], "keep": event["keep"]})
+            # a catch-up carries no deletions, so this frame is never dropped
+            self._outbox.put(event["frame"], droppable=False)
+            return
+        # clients not knowing expire frames get their history again
+        if self.subscription.last:
+            await get_snapshot().refresh()
+            view = get_snapshot().view(self.subscription)
+            if view.ids and view.ids[0] > event["until"]:
+                return # rows the client keeps are all newer
+        # a snapshot replaces the client's rows up to its version
+        self._catch_up(0)
 
     async def sync_message(self, event):
         """Handler for group_send messages"""
-        await self.send(text_data=event["message"])
\ No newline at end of file
+        self._send_sync(event["message"])
+
+    @classmethod
+    def stats(cls) -> dict:
+        outboxes = [consumer._outbox for consumer in cls._live]
+        deepest = sorted(cls._live, key=lambda consumer: consumer._outbox.bytes, reverse=True)
+        return {
+            "connections": len(outboxes),
+            "queued": sum(outbox.depth for outbox in outboxes),
+            "queued_bytes": sum(outbox.bytes for outbox in outboxes),
+            "behind": sum(outbox.behind for outbox in outboxes),
+            "filtered": sum(consumer.subscription.filtered for consumer in cls._live),
+            "reaped_laggards": cls.reaped_laggards,
+            "reaped_idle": cls.reaped_idle,
+            "reaped_flooding": cls.reaped_flooding,
+            "deepest": [
+                {"client": "%s:%s" % tuple(consumer.scope.get("client") or ("", "")), **consumer._outbox.stats()}
+                for consumer in deepest[:STATS_TOP_CONNECTIONS]
+            ],
+        }
@@ -0,0 +1,53 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections
+
+
+class DatabaseThreads:
+    """
+    Runs ORM calls on long-lived threads. Django keeps a connection per
+    thread and ASGI gives every request a fresh one, so ORM calls made from
+    a view would open (and set up) a new SQLite connection per request.
+    Reads go to a pool of threads holding connections to the read-only
+    history alias, writes to one thread holding the default connection;
+    SQLite takes one writer at a time anyway, so writers wait here instead
+    of on the database lock
+
+    Parameters
+    ----------
+        readers (int): threads serving reads
+        read_alias (str): database alias reads use
+    """
+    def __init__(self, readers: int, read_alias: str):
+        self.read_alias = read_alias
+        self._reader = ThreadPoolExecutor(readers, thread_name_prefix="calc-db-read")
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="calc-db-write")
+
+    async def read(self, func, *args):
+        """Result of func(*args) run on a reader thread"""
+        return await self._run(self._reader, self.read_alias, func, args)
+
+    async def write(self, func, *args):
+        """Result of func(*args) run on the writer thread"""
+        return await self._run(self._writer, "default", func, args)
+
+    async def _run(self, executor, alias, func, args):
+        return await asyncio.get_running_loop().run_in_executor(executor, self._call, alias, func, args)
+
+    @staticmethod
+    def _call(alias, func, args):
+        # what close_old_connections() does per request: the thread's
+        # connection is kept unless it broke or outlived CONN_MAX_AGE
+        connections[alias].close_if_unusable_or_obsolete()
+        return func(*args)
+
+
+_database = None
+
+def get_database() -> DatabaseThreads:
+    """Returns process-wide database threads configured from settings"""
+    global _database
+    if _database is None:
+        _database = DatabaseThreads(settings.CALC_DB_READERS, settings.HISTORY_DB)
+    return _database
@@ -0,0 +1,132 @@
+import asyncio
+from channels.layers import get_channel_layer
+
+GROUP_REFRESH = 3600 # seconds between group_add renewals, channel layer groups expire
+MAX_PENDING = 256 # messages queued per subscriber, newer ones are dropped
+READ_BACKOFF = 0.5 # seconds before retrying a failed receive, doubled while it keeps failing
+MAX_READ_BACKOFF = 30
+
+
+class FanoutHub:
+    """
+    Joins a channel layer group once per process and hands every message
+    sent to the group to the local consumers subscribed to the hub, so a
+    broadcast costs the channel layer one delivery per process instead of
+    one per socket. Each subscriber has its own bounded queue and task
+    which dispatches messages to it in order, as its own channel would;
+    like a full channel, a full queue drops new messages. If the channel
+    layer fails (e.g. Redis restarts) the hub backs off and joins the group
+    again; messages sent meanwhile are lost, consumers notice the gap in
+    versions of the next delta and catch up
+
+    Parameters
+    ----------
+        group (str): channel layer group to join
+    """
+    def __init__(self, group: str):
+        self.group = group
+        self.channel = None # hub's channel while it has subscribers
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+        self.failing = False # last receive failed, the group is joined again after a backoff
+        self._subscribers = {} # consumer -> (queue, pump task)
+        self._tasks = ()
+        self._lock = asyncio.Lock()
+
+    async def subscribe(self, consumer):
+        """Starts delivering group messages to consumer.dispatch()"""
+        async with self._lock:
+            if self.channel is None:
+                await self._join()
+            queue = asyncio.Queue(MAX_PENDING)
+            self._subscribers[consumer] = (queue, asyncio.create_task(self._pump(consumer, queue)))
+
+    async def unsubscribe(self, consumer):
+        async with self._lock:
+            subscriber = self._subscribers.pop(consumer, None)
+            if subscriber is not None:
+                subscriber[1].cancel()
+            if not self._subscribers and self.channel is not None:
+                await self._leave()
+
+    async def _join(self):
+        layer = get_channel_layer()
+        self.channel = await layer.new_channel()
+        await layer.group_add(self.group, self.channel)
+        self._tasks = (
+            asyncio.create_task(self._read(layer, self.channel)),
+            asyncio.create_task(self._refresh(layer, self.channel)),
+        )
+
+    async def _leave(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await get_channel_layer().group_discard(self.group, self.channel)
+        self.channel = None
+        self._tasks = ()
+
+    async def _read(self, layer, channel: str):
+        backoff = READ_BACKOFF
+        while True:
+            try:
+                message = await layer.receive(channel)
+            except Exception as e:
+                print(e)
+                self.errors += 1
+                self.failing = True
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_READ_BACKOFF)
+                await self._rejoin(layer, channel)
+                continue
+            self.failing = False
+            backoff = READ_BACKOFF
+            self.received += 1
+            for queue, _ in self._subscribers.values():
+                try:
+                    queue.put_nowait(message)
+                    self.delivered += 1
+                except asyncio.QueueFull:
+                    self.dropped += 1
+
+    async def _refresh(self, layer, channel: str):
+        while True:
+            await asyncio.sleep(GROUP_REFRESH)
+            await self._rejoin(layer, channel)
+
+    async def _rejoin(self, layer, channel: str):
+        # the group may be gone with a restarted layer, adding twice is harmless
+        try:
+            await layer.group_add(self.group, channel)
+        except Exception as e:
+            print(e)
+
+    @staticmethod
+    async def _pump(consumer, queue: asyncio.Queue):
+        while True:
+            message = await queue.get()
+            try:
+                await consumer.dispatch(message)
+            except Exception as e:
+                print(e)
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self._subscribers),
+            "received": self.received,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "failing": self.failing,
+        }
+
+
+_hubs = {}
+
+def get_hub(group: str) -> FanoutHub:
+    """Returns process-wide hub of group"""
+    if group not in _hubs:
+        _hubs[group] = FanoutHub(group)
+    return _hubs[group]
@@ -0,0 +1,123 @@
+import os
+import uuid
+import fcntl
+import socket
+from django.conf import settings
+
+REDIS_KEY = "calc:sync-leader"
+RETENTION_REDIS_KEY = "calc:retention-leader"
+
+# take the lock if it is free, extend it if this process holds it
+ELECT_SCRIPT = """
+local owner = redis.call('get', KEYS[1])
+if owner == ARGV[1] then
+    redis.call('pexpire', KEYS[1], ARGV[2])
+    return 1
+end
+if not owner then
+    redis.call('set', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+RESIGN_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisLeaderLock:
+    """
+    Leadership shared by server processes on any host. The leader holds a
+    Redis key with a TTL and extends it on every elect(); if it dies the
+    key expires and the next process calling elect() takes over
+
+    Parameters
+    ----------
+        url (str): Redis server
+        ttl (float): seconds the lock outlives its last elect()
+        key (str): Redis key of the lock
+    """
+    def __init__(self, url: str, ttl: float, key: str = REDIS_KEY):
+        import redis.asyncio
+        self.client = redis.asyncio.from_url(url)
+        self.ttl_ms = int(ttl * 1000)
+        self.key = key
+        self.token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+        self.leader = False
+        self._elect = self.client.register_script(ELECT_SCRIPT)
+        self._resign = self.client.register_script(RESIGN_SCRIPT)
+
+    async def elect(self) -> bool:
+        """Takes or keeps leadership, returns whether this process is the leader"""
+        self.leader = bool(await self._elect(keys=[self.key], args=[self.token, self.ttl_ms]))
+        return self.leader
+
+    async def resign(self):
+        if self.leader:
+            self.leader = False
+            await self._resign(keys=[self.key], args=[self.token])
+
+
+class FileLeaderLock:
+    """
+    Leadership shared by server processes of a single host, held as an
+    exclusive flock(). The OS drops the lock together with a dead process,
+    so failover needs no TTL
+
+    Parameters
+    ----------
+        path (str): lock file, created if missing
+    """
+    def __init__(self, path):
+        self.path = path
+        self.leader = False
+        self._file = None
+
+    async def elect(self) -> bool:
+        if self.leader:
+            return True
+        if self._file is None:
+            self._file = open(self.path, "a")
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self.leader = True
+        return True
+
+    async def resign(self):
+        if self.leader:
+            self.leader = False
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+
+def make_leader_lock(redis_key: str, path):
+    """Lock of the SYNC_LEADER_LOCK kind, held in `redis_key` or in file `path`"""
+    if settings.SYNC_LEADER_LOCK == "redis":
+        return RedisLeaderLock(settings.SYNC_LEADER_REDIS_URL, settings.SYNC_LEADER_TTL, redis_key)
+    if settings.SYNC_LEADER_LOCK == "file":
+        return FileLeaderLock(path)
+    raise Exception(f"Unknown SYNC_LEADER_LOCK {settings.SYNC_LEADER_LOCK!r}")
+
+
+_leader_lock = None
+
+def get_leader_lock():
+    """Returns process-wide sync leader lock configured from settings"""
+    global _leader_lock
+    if _leader_lock is None:
+        _leader_lock = make_leader_lock(REDIS_KEY, settings.SYNC_LEADER_LOCK_PATH)
+    return _leader_lock
+
+
+_retention_lock = None
+
+def get_retention_lock():
+    """Returns process-wide lock electing the process which runs history retention"""
+    global _retention_lock
+    if _retention_lock is None:
+        _retention_lock = make_leader_lock(RETENTION_REDIS_KEY, settings.CALC_RETENTION_LOCK_PATH)
+    return _retention_lock
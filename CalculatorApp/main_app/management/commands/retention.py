@@ -0,0 +1,35 @@
+import asyncio
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main_app.retention import Retention, TABLE, FILE
+
+
+class Command(BaseCommand):
+    help = "Archives and deletes expired history rows once, policies default to CALC_RETENTION_* settings"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-age", type=float, default=settings.CALC_RETENTION_MAX_AGE, help="seconds a row is kept")
+        parser.add_argument("--max-rows", type=int, default=settings.CALC_RETENTION_MAX_ROWS, help="newest rows kept")
+        parser.add_argument("--keep-per-mode", type=int, default=settings.CALC_RETENTION_KEEP_PER_MODE, help="newest rows kept of each mode")
+        parser.add_argument("--archive", choices=[TABLE, FILE, "none"], default=settings.CALC_RETENTION_ARCHIVE or "none")
+        parser.add_argument("--batch-rows", type=int, default=settings.CALC_RETENTION_BATCH_ROWS, help="rows per transaction")
+
+    def handle(self, *args, **options):
+        retention = Retention(
+            options["max_age"],
+            options["max_rows"],
+            options["keep_per_mode"],
+            None if options["archive"] == "none" else options["archive"],
+            settings.CALC_RETENTION_ARCHIVE_PATH,
+            options["batch_rows"],
+            None,
+        )
+        if not retention.enabled:
+            self.stderr.write("No retention policy is set")
+            return
+        run = asyncio.run(retention.run())
+        self.stdout.write(
+            f"Deleted {run.deleted} rows, archived {run.archived} "
+            f"({run.archive or 'no archive'}) in {run.seconds:.3f}s"
+        )
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calculatedresult',
+            name='float_mode',
+            field=models.BooleanField(db_default=False, default=False),
+        ),
+        migrations.AddField(
+            model_name='calculatedresult',
+            name='session',
+            field=models.CharField(blank=True, db_default='', default='', max_length=64),
+        ),
+    ]
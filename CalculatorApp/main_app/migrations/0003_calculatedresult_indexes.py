@@ -0,0 +1,25 @@
+# Generated by Django 5.1.7 on 2026-10-17 06:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0002_calculatedresult_float_mode_session'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='calculatedresult',
+            index=models.Index(fields=['timestamp'], name='calc_result_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='calculatedresult',
+            index=models.Index(fields=['session'], name='calc_result_session_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='calculatedresult',
+            index=models.Index(fields=['float_mode'], name='calc_result_float_mode_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.1.7 on 2026-10-17 07:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0003_calculatedresult_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedResult',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('expression', models.TextField()),
+                ('result', models.TextField()),
+                ('timestamp', models.DateTimeField()),
+                ('float_mode', models.BooleanField()),
+                ('session', models.CharField(blank=True, max_length=64)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'calc_result_archive',
+            },
+        ),
+        migrations.CreateModel(
+            name='RetentionRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started', models.DateTimeField()),
+                ('seconds', models.FloatField()),
+                ('deleted', models.IntegerField()),
+                ('archived', models.IntegerField()),
+                ('archive', models.CharField(blank=True, max_length=16)),
+            ],
+            options={
+                'db_table': 'calc_retention_run',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-17 08:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0004_archivedresult_retentionrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='retentionrun',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -5,8 +5,42 @@ class CalculatedResult(models.Model):
     expression = models.TextField(max_length=1024)
     result = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    float_mode = models.BooleanField(default=False, db_default=False)
+    session = models.CharField(max_length=64, blank=True, default='', db_default='') # client given tag, '' if none
 
     class Meta:
         verbose_name = 'calculated_result'
         verbose_name_plural = 'calculated_results'
-        db_table = 'calc_result'
\ No newline at end of file
+        db_table = 'calc_result'
+        # id order comes free, SQLite indexes end with the rowid
+        indexes = [
+            models.Index(fields=['timestamp'], name='calc_result_timestamp_idx'),
+            models.Index(fields=['session'], name='calc_result_session_idx'),
+            models.Index(fields=['float_mode'], name='calc_result_float_mode_idx'),
+        ]
+
+class ArchivedResult(models.Model):
+    """calc_result row moved out by retention"""
+    id = models.BigIntegerField(primary_key=True) # id it had in calc_result
+    expression = models.TextField()
+    result = models.TextField()
+    timestamp = models.DateTimeField()
+    float_mode = models.BooleanField()
+    session = models.CharField(max_length=64, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'calc_result_archive'
+
+
+class RetentionRun(models.Model):
+    """One pass of history retention"""
+    started = models.DateTimeField()
+    seconds = models.FloatField()
+    deleted = models.IntegerField() # rows removed from calc_result
+    archived = models.IntegerField() # of them kept in the archive
+    archive = models.CharField(max_length=16, blank=True) # "table", "file" or '' if rows were only deleted
+    version = models.BigIntegerField(default=0) # history version when the run finished
+
+    class Meta:
+        db_table = 'calc_retention_run'
@@ -0,0 +1,117 @@
+import time
+import asyncio
+from collections import deque
+
+
+class Outbox:
+    """
+    Bounded outbound queue of a WebSocket connection, written by its own
+    task so handlers never wait for a slow client.
+
+    Sync frames are droppable: when unsent bytes would exceed `max_bytes`
+    all queued ones are dropped and the outbox is `behind` until the queue
+    drains, then `on_drained` is called once to send a single catch-up
+    instead. Other frames (calculation replies, pings) are always queued,
+    their number is bounded by the caller or, for long streams, by
+    awaiting writable() before each frame
+
+    Parameters
+    ----------
+        send (callable): coroutine function sending one frame, text for str and binary for bytes
+        on_drained (callable): function called when a behind outbox drains, must not wait for the writer
+        max_bytes (int): unsent bytes, one frame may always wait behind the one being sent
+    """
+    def __init__(self, send, on_drained, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.sent_version = None # version of the newest sync frame handed to send
+        self.behind = False
+        self.closed = False
+        self.bytes = 0 # unsent, including the frame being sent
+        self.replies = 0 # queued calculation replies
+        self.sent = 0
+        self.dropped = 0
+        self._send = send
+        self._on_drained = on_drained
+        self._frames = deque() # (text, droppable, version, enqueued at, reply)
+        self._sending = None # frame being sent
+        self._ready = asyncio.Event()
+        self._writable = asyncio.Event()
+
+    def put(self, text, droppable: bool = True, version: int = None, reply: bool = False) -> bool:
+        """Queues frame, returns False if it was dropped along with other sync frames"""
+        if self.closed:
+            return False
+        if self.behind and droppable:
+            self.dropped += 1
+            return False
+        if droppable and self._frames and self.bytes + len(text) > self.max_bytes:
+            self._drop()
+            self.dropped += 1
+            return False
+        self._frames.append((text, droppable, version, time.monotonic(), reply))
+        self.bytes += len(text)
+        self.replies += reply
+        self._ready.set()
+        return True
+
+    def _drop(self):
+        kept = deque(frame for frame in self._frames if not frame[1])
+        self.dropped += len(self._frames) - len(kept)
+        self._frames = kept
+        self.bytes = sum(len(frame[0]) for frame in kept) + (len(self._sending[0]) if self._sending else 0)
+        self.behind = True
+
+    def close(self):
+        """Frees queued frames and rejects new ones, the writer must be cancelled"""
+        self.closed = True
+        self._frames.clear()
+        self._sending = None
+        self.bytes = self.replies = 0
+        self._writable.set()
+
+    async def writable(self):
+        """Waits until unsent bytes fall to half of max_bytes or the outbox is closed"""
+        while not self.closed and self.bytes > self.max_bytes // 2:
+            self._writable.clear()
+            await self._writable.wait()
+
+    @property
+    def depth(self) -> int:
+        return len(self._frames) + (self._sending is not None)
+
+    def lag(self) -> float:
+        """Seconds the oldest unsent frame has waited"""
+        oldest = self._sending or (self._frames[0] if self._frames else None)
+        return time.monotonic() - oldest[3] if oldest else 0.0
+
+    async def run(self):
+        while True:
+            if not self._frames:
+                if self.behind:
+                    self.behind = False
+                    self._on_drained()
+                    continue
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            frame = self._sending = self._frames.popleft()
+            text, droppable, version, _, reply = frame
+            self.replies -= reply
+            if version is not None:
+                self.sent_version = version
+            await self._send(text)
+            self._sending = None
+            self.bytes -= len(text)
+            if self.bytes <= self.max_bytes // 2:
+                self._writable.set()
+            self.sent += 1
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.depth,
+            "bytes": self.bytes,
+            "lag_ms": round(self.lag() * 1000, 3),
+            "behind": self.behind,
+            "sent": self.sent,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,277 @@
+import os
+import gzip
+import json
+import time
+import asyncio
+import datetime
+import operator
+from functools import reduce
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from main_app.models import CalculatedResult, ArchivedResult, RetentionRun
+from main_app.utils import history, get_history_version
+from main_app.database import get_database
+from main_app.sync import publish_retention
+from main_app.leader import get_retention_lock
+
+TABLE = "table" # archive into calc_result_archive
+FILE = "file" # archive into gzipped NDJSON segments
+ARCHIVES = (TABLE, FILE, None)
+ARCHIVE_FIELDS = ("id", "expression", "result", "timestamp", "float_mode", "session")
+
+
+class Retention:
+    """
+    Expires history rows: older than `max_age` seconds, beyond the newest
+    `max_rows`, or beyond the newest `keep_per_mode` of their mode (any
+    policy set to None is off, a row expires if any policy expires it).
+    Policies become an id per mode, its rows up to that id expire: ages
+    go by id, so rows stored before the newest expired one go with it.
+    Expired rows are moved to the archive and deleted `batch_rows` at a
+    time, every chunk a short transaction of its own on the writer thread,
+    so writes of results go on in between. The archive is the
+    calc_result_archive table (rows move in the transaction deleting them)
+    or a gzipped NDJSON segment per run in `archive_path` (written and
+    synced before the rows are deleted, so a crash may archive a chunk
+    twice but never loses one)
+
+    Parameters
+    ----------
+        max_age (float): seconds a row is kept
+        max_rows (int): newest rows kept
+        keep_per_mode (int): newest rows kept of each mode
+        archive (str): "table", "file" or None to only delete
+        archive_path (str): directory of segment files
+        batch_rows (int): rows per transaction
+        period (float): seconds between background runs, None disables them
+    """
+    def __init__(self, max_age, max_rows, keep_per_mode, archive, archive_path, batch_rows: int, period):
+        if archive not in ARCHIVES:
+            raise Exception("Incorrect retention archive value")
+        self.max_age = max_age
+        self.max_rows = max_rows
+        self.keep_per_mode = keep_per_mode
+        self.archive = archive
+        self.archive_path = archive_path
+        self.batch_rows = batch_rows
+        self.period = period
+        self.runs = 0
+        self.deleted = 0
+        self.archived = 0
+        self.seconds = 0.0
+        self.last_run = None
+        self._last_start = None
+        self._task = None
+        self._periodic_task = None
+
+    def _boundaries(self) -> dict:
+        """
+        float_mode -> id its rows expire up to, None if no policy is on.
+        Boundaries are fixed here, later rows never expire in this run
+        """
+        if not self.enabled:
+            return None
+        expired = 0
+        if self.max_age is not None:
+            cutoff = timezone.now() - datetime.timedelta(seconds=self.max_age)
+            newest_old = history().filter(timestamp__lt=cutoff).order_by("-timestamp").values_list("id", flat=True)[:1]
+            expired = newest_old[0] if newest_old else 0
+        if self.max_rows is not None:
+            expired = max(expired, self._boundary(history(), self.max_rows))
+        boundaries = {}
+        for float_mode in (False, True):
+            boundaries[float_mode] = expired
+            if self.keep_per_mode is not None:
+                rows = history().filter(float_mode=float_mode)
+                boundaries[float_mode] = max(expired, self._boundary(rows, self.keep_per_mode))
+        return boundaries
+
+    @staticmethod
+    def _boundary(rows, keep: int) -> int:
+        """Newest id beyond the `keep` newest rows, 0 if there are no more"""
+        ids = rows.order_by("-id").values_list("id", flat=True)[keep:keep + 1]
+        return ids[0] if ids else 0
+
+    @staticmethod
+    def _expired(boundaries: dict) -> Q:
+        return reduce(operator.or_, (
+            Q(float_mode=float_mode, id__lte=until) for float_mode, until in boundaries.items()
+        ))
+
+    @staticmethod
+    def _kept(until: int) -> list:
+        """Ids up to `until` left after a run, rows of a mode expiring up to a lower id"""
+        return list(history().filter(id__lte=until).order_by("id").values_list("id", flat=True))
+
+    def _chunk(self, rows, expired) -> list:
+        """Next expired rows of a queryset, oldest first, as ARCHIVE_FIELDS tuples"""
+        return list(
+            rows.filter(expired).order_by("id")
+            .values_list(*ARCHIVE_FIELDS)[:self.batch_rows]
+        )
+
+    def _move_chunk(self, expired) -> list:
+        """Archives (into the table, if so) and deletes the next chunk in one transaction"""
+        with transaction.atomic():
+            rows = self._chunk(CalculatedResult.objects, expired)
+            if self.archive == TABLE:
+                ArchivedResult.objects.bulk_create(
+                    ArchivedResult(**dict(zip(ARCHIVE_FIELDS, row))) for row in rows
+                )
+            CalculatedResult.objects.filter(id__in=[row[0] for row in rows]).delete()
+        return rows
+
+    def _delete(self, ids: list):
+        CalculatedResult.objects.filter(id__in=ids).delete()
+
+    @staticmethod
+    def _write_segment(path: str, rows: list):
+        """Appends rows to a segment as a gzip member of its own and syncs it to disk"""
+        lines = "".join(
+            json.dumps(dict(zip(ARCHIVE_FIELDS, row)), default=datetime.datetime.isoformat) + "\n"
+            for row in rows
+        )
+        with open(path, "ab") as file:
+            with gzip.GzipFile(fileobj=file, mode="ab") as segment:
+                segment.write(lines.encode("utf-8"))
+            file.flush()
+            os.fsync(file.fileno())
+
+    async def run(self) -> RetentionRun:
+        """One pass over the history, returns its record"""
+        database = get_database()
+        started = timezone.now()
+        clock = time.monotonic()
+        boundaries = await database.read(self._boundaries)
+        deleted = 0
+        if boundaries is not None:
+            expired = self._expired(boundaries)
+            if self.archive == FILE:
+                os.makedirs(self.archive_path, exist_ok=True)
+                path = os.path.join(self.archive_path, f"calc_result-{started:%Y%m%dT%H%M%S}.ndjson.gz")
+            while True:
+                if self.archive == FILE:
+                    # file work stays outside of the write lock
+                    rows = await database.read(lambda: self._chunk(history(), expired))
+                    if rows:
+                        await asyncio.to_thread(self._write_segment, path, rows)
+                        await database.write(self._delete, [row[0] for row in rows])
+                else:
+                    rows = await database.write(self._move_chunk, expired)
+                if not rows:
+                    break
+                deleted += len(rows)
+        record = RetentionRun(
+            started=started,
+            seconds=time.monotonic() - clock,
+            deleted=deleted,
+            archived=deleted if self.archive else 0,
+            archive=self.archive or "",
+            # clients at an older version may hold deleted rows
+            version=await get_history_version() if deleted else 0,
+        )
+        await database.write(record.save)
+        self.runs += 1
+        self.deleted += record.deleted
+        self.archived += record.archived
+        self.seconds += record.seconds
+        self.last_run = {
+            "started": record.started.isoformat(),
+            "seconds": round(record.seconds, 3),
+            "deleted": record.deleted,
+            "archived": record.archived,
+        }
+        if deleted:
+            until = max(boundaries.values())
+            await publish_retention(record.id, record.version, until, await database.read(self._kept, until))
+        return record
+
+    @property
+    def enabled(self) -> bool:
+        return (self.max_age, self.max_rows, self.keep_per_mode) != (None, None, None)
+
+    def tick(self):
+        """Starts a background run if `period` passed since the previous one started"""
+        if not self.enabled or self.period is None or self._task is not None:
+            return
+        now = time.monotonic()
+        if self._last_start is not None and now - self._last_start < self.period:
+            return
+        self._last_start = now
+        self._task = asyncio.create_task(self._background())
+
+    def start(self):
+        """Starts background runs in the running event loop, once"""
+        if not self.enabled or self.period is None or self._periodic_task is not None:
+            return
+        self._periodic_task = asyncio.create_task(self._periodic())
+
+    async def _periodic(self):
+        """
+        Every server process runs this, but only the one holding the
+        retention lock starts runs; the lock is renewed every SYNC_PERIOD,
+        including while a run goes on
+        """
+        lock = get_retention_lock()
+        while True:
+            try:
+                if await lock.elect():
+                    self.tick()
+            except Exception as e:
+                print(e)
+            await asyncio.sleep(settings.SYNC_PERIOD)
+
+    async def _background(self):
+        try:
+            await self.run()
+        except Exception as e:
+            print(e)
+        finally:
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "runs": self.runs,
+            "running": self._task is not None,
+            "leader": get_retention_lock().leader,
+            "deleted": self.deleted,
+            "archived": self.archived,
+            "seconds": round(self.seconds, 3),
+            "last_run": self.last_run,
+        }
+
+
+_retention = None
+
+def get_retention() -> Retention:
+    """Returns process-wide history retention configured from settings"""
+    global _retention
+    if _retention is None:
+        _retention = Retention(
+            settings.CALC_RETENTION_MAX_AGE,
+            settings.CALC_RETENTION_MAX_ROWS,
+            settings.CALC_RETENTION_KEEP_PER_MODE,
+            settings.CALC_RETENTION_ARCHIVE,
+            settings.CALC_RETENTION_ARCHIVE_PATH,
+            settings.CALC_RETENTION_BATCH_ROWS,
+            settings.CALC_RETENTION_PERIOD,
+        )
+    return _retention
+
+
+class StartRetention:
+    """
+    ASGI middleware starting background retention with the first scope of
+    any kind: daphne sends no lifespan events, and a server may only get
+    HTTP requests or only sockets
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        get_retention().start()
+        return await self.app(scope, receive, send)
@@ -1,12 +1,232 @@
 import os
+import re
+import time
+import ctypes
+import asyncio
 import subprocess
 from django.conf import settings
 
+from main_app.scheduler import CalcQueueFullError, INTERACTIVE, get_scheduler
+
 APP_NAME = settings.EXE_PATH
+LIB_NAME = settings.LIB_PATH
+MAX_RESULT_SIZE = 512 # matches MAX_RESULT_SIZE in calculator.h
 FLOAT_FLAG = "--float"
 INT_FLAG = ""
+SERVE_FLAG = "--serve"
 FLOAT_MODE = (FLOAT_FLAG, "FLOAT")
 INT_MODE = (INT_FLAG, "INT")
+WHITESPACE_RE = re.compile(rb"\s")
+
+
+# app exit codes, see README
+CALC_ERROR_MESSAGES = {
+    1: "Division by zero",
+    2: "Division by a number less than 0.0001",
+    3: "Invalid input",
+    4: "Not closed parenthesis",
+    5: "Out of memory",
+}
+INVALID_INPUT = 3
+
+
+class CalcError(Exception):
+    """
+    Raised when calculator rejects an expression
+
+    Parameters
+    ----------
+        code (int): app exit code (1-5, see README)
+    """
+    def __init__(self, code: int):
+        super().__init__(f"Calculator application exited with code {code}")
+        self.code = code
+
+    @property
+    def reason(self) -> str:
+        return CALC_ERROR_MESSAGES.get(self.code, "Runtime error occured")
+
+
+class CalcTimeoutError(Exception):
+    """Raised when evaluation does not finish before the per-request deadline"""
+    pass
+
+
+class CalcWorker:
+    """
+    Wrapper around a long-running `app.exe --serve` process.
+    Handles one request at a time: writes "<MODE> <expression>" line
+    and reads back "OK <result>" or "ERR <code>" line
+    """
+    def __init__(self):
+        self.process = None
+        self.served = 0
+        self.starts = 0
+        self.last_used = 0.0
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            APP_NAME, SERVE_FLAG,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        self.served = 0
+        self.starts += 1
+        self.last_used = time.monotonic()
+
+    async def stop(self):
+        if self.alive:
+            self.process.kill()
+            await self.process.wait()
+        self.process = None
+
+    async def request(self, mode_str: str, input_data: bytes) -> tuple[str, str]:
+        # frame is a single line, whitespace is insignificant for the parser
+        expression = WHITESPACE_RE.sub(b" ", input_data)
+        self.process.stdin.write(mode_str.encode("ascii") + b" " + expression + b"\n")
+        await self.process.stdin.drain()
+        line = await self.process.stdout.readline()
+        if not line:
+            raise ConnectionError("Calculator worker exited unexpectedly")
+        self.served += 1
+        self.last_used = time.monotonic()
+        status, _, payload = line.decode("utf-8").strip().partition(" ")
+        return status, payload
+
+    async def ping(self) -> bool:
+        try:
+            return await asyncio.wait_for(self.request(INT_MODE[1], b"0"), 1) == ("OK", "0")
+        except Exception:
+            return False
+
+
+class CalcWorkerPool:
+    """
+    Pool of persistent calculator workers. Each request checks out an
+    idle worker, so pool size also bounds concurrency. Workers are
+    restarted after crashing, after failing a health check and after
+    serving `max_requests` requests
+
+    Parameters
+    ----------
+        size (int): number of worker processes
+        max_requests (int): requests served by a worker before it is recycled
+        health_interval (float): seconds between health checks of idle workers
+    """
+    def __init__(self, size: int, max_requests: int, health_interval: float):
+        self.size = size
+        self.max_requests = max_requests
+        self.health_interval = health_interval
+        self._workers = [CalcWorker() for _ in range(size)]
+        self._idle = asyncio.Queue()
+        for worker in self._workers:
+            self._idle.put_nowait(worker)
+        self._health_task = None
+
+    async def _checkout(self) -> CalcWorker:
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+        worker = await self._idle.get()
+        try:
+            if worker.alive and worker.served >= self.max_requests:
+                await worker.stop()
+            if not worker.alive:
+                await worker.start()
+        except BaseException:
+            self._idle.put_nowait(worker)
+            raise
+        return worker
+
+    async def evaluate(self, mode_str: str, input_data: bytes) -> str:
+        worker = await self._checkout()
+        done = False
+        try:
+            status, payload = await worker.request(mode_str, input_data)
+            done = True
+        finally:
+            if not done:
+                # cancelled or crashed mid-request - pipe state is unknown
+                await worker.stop()
+            self._idle.put_nowait(worker)
+        if status != "OK":
+            raise CalcError(int(payload))
+        return payload
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            # only inspect workers idle since last check
+            for _ in range(self._idle.qsize()):
+                worker = self._idle.get_nowait()
+                try:
+                    stale = time.monotonic() - worker.last_used >= self.health_interval
+                    if worker.alive and stale and not await worker.ping():
+                        # dead worker is restarted on next checkout
+                        await worker.stop()
+                finally:
+                    self._idle.put_nowait(worker)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "idle": self._idle.qsize(),
+            "restarts": sum(max(worker.starts - 1, 0) for worker in self._workers),
+        }
+
+
+class CalcEngine:
+    """
+    In-process calculator: binds reentrant `calc_evaluate_to_string`
+    from libcalculator.so through ctypes. Each call uses its own
+    context, so it is safe to call from several threads at once
+    """
+    def __init__(self, lib_path=LIB_NAME):
+        self._lib = ctypes.CDLL(str(lib_path))
+        self._lib.calc_evaluate_to_string.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t
+        ]
+        self._lib.calc_evaluate_to_string.restype = ctypes.c_int
+
+    def evaluate(self, mode_str: str, input_data: bytes) -> str:
+        # c_char_p would end the expression at a NUL byte, app.exe rejects it
+        if b"\0" in input_data:
+            raise CalcError(INVALID_INPUT)
+        output = ctypes.create_string_buffer(MAX_RESULT_SIZE)
+        code = self._lib.calc_evaluate_to_string(
+            mode_str == FLOAT_MODE[1], input_data, output, MAX_RESULT_SIZE
+        )
+        if code != 0:
+            raise CalcError(code)
+        return output.value.decode("utf-8")
+
+
+_engine = None
+
+def get_engine() -> CalcEngine:
+    """Returns process-wide shared library binding"""
+    global _engine
+    if _engine is None:
+        _engine = CalcEngine()
+    return _engine
+
+
+_pool = None
+
+def get_pool() -> CalcWorkerPool:
+    """Returns process-wide worker pool configured from settings"""
+    global _pool
+    if _pool is None:
+        _pool = CalcWorkerPool(
+            settings.CALC_WORKERS,
+            settings.CALC_WORKER_MAX_REQUESTS,
+            settings.CALC_WORKER_HEALTH_INTERVAL,
+        )
+    return _pool
 
 
 class CalcManager:
@@ -17,14 +237,16 @@ class CalcManager:
     ----------
         float_mode (bool): whether to run calc in FLOAT_MODE
         input_data (str): arithmetic expression passed for app to evaluate
+        priority (str): scheduler class the evaluation waits in
     """
-    def __init__(self, float_mode: bool, input_data: str):
+    def __init__(self, float_mode: bool, input_data: str, priority: str = INTERACTIVE):
         self.mode_flag, self.mode_str = FLOAT_MODE if float_mode else INT_MODE
+        self.priority = priority
         # convert str to bytes to pipe in stdin
         self.input_data = input_data.encode("utf-8")
         if not self._ensure_bin():
             raise Exception("Server cannot access or build app binary")
-    
+
     def _ensure_bin(self) -> bool:
         # check if built binary exists
         if os.path.isfile(settings.EXE_PATH):
@@ -44,10 +266,13 @@ class CalcManager:
         # logger.error("Binary and Makefile not found in filesystem")
         return False
 
+    def _app_args(self) -> list:
+        return [APP_NAME, self.mode_flag] if self.mode_flag else [APP_NAME]
+
     def run_app(self) -> tuple[int, str]:
         # logger.info("Running calculator application", mode=self.mode_str)
         app_process = subprocess.Popen(
-            [APP_NAME, self.mode_flag],
+            self._app_args(),
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
@@ -56,7 +281,64 @@ class CalcManager:
         # process returns data in bytes - decode 'em and strip \n
         output = stdout.decode("utf-8").strip()
         if app_process.returncode != 0:
-            raise Exception(f"Calculator application exited with code {app_process.returncode}")
+            raise CalcError(app_process.returncode)
         self.result = output
         # logger.info("Calculator application finished with exit code 0", output=output)
         return self.result
+
+    async def run_app_async(self) -> str:
+        """
+        Non-blocking counterpart of run_app. Waits for a scheduler slot of
+        its priority class and runs the app under asyncio. The whole call, including time spent
+        in the wait queue, is bounded by CALC_TIMEOUT. The child process is
+        killed if the deadline expires or the awaiting task is cancelled
+        (e.g. the HTTP client disconnected)
+        """
+        try:
+            return await asyncio.wait_for(self._run_limited(), settings.CALC_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise CalcTimeoutError(f"Evaluation exceeded {settings.CALC_TIMEOUT}s deadline")
+
+    async def _run_limited(self) -> str:
+        if settings.CALC_BACKEND == "library":
+            return await self._run_library()
+        async with get_scheduler().slot(self.priority):
+            if settings.CALC_BACKEND == "pool":
+                self.result = await get_pool().evaluate(self.mode_str, self.input_data)
+                return self.result
+            app_process = await asyncio.create_subprocess_exec(
+                *self._app_args(),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                stdout, stderr = await app_process.communicate(input=self.input_data)
+            finally:
+                # deadline expired or client went away - don't leave orphans
+                if app_process.returncode is None:
+                    app_process.kill()
+                    await app_process.wait()
+        output = stdout.decode("utf-8").strip()
+        if app_process.returncode != 0:
+            raise CalcError(app_process.returncode)
+        self.result = output
+        return self.result
+
+    async def _run_library(self) -> str:
+        # ctypes releases the GIL, so threads evaluate in parallel; a running
+        # call cannot be killed, deadline only stops waiting for it and the
+        # slot stays taken until the thread is free again
+        scheduler = get_scheduler()
+        await scheduler.acquire(self.priority)
+        started_at = time.monotonic()
+        call = asyncio.ensure_future(asyncio.to_thread(get_engine().evaluate, self.mode_str, self.input_data))
+
+        def release(call):
+            if not call.cancelled():
+                call.exception() # nobody awaits an abandoned call
+            scheduler.classes[self.priority].record_service(time.monotonic() - started_at)
+            scheduler.release(self.priority)
+        call.add_done_callback(release)
+        self.result = await asyncio.shield(call)
+        return self.result
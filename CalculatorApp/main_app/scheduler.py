@@ -0,0 +1,174 @@
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from django.conf import settings
+
+INTERACTIVE = "interactive" # single requests from users, /calc and WebSocket frames
+BULK = "bulk" # batch, stream and vector work
+WAIT_SAMPLES = 1024 # recent wait times kept per class for percentiles
+SERVICE_TIME_ALPHA = 0.1 # weight of the newest sample in service time average
+
+
+class CalcQueueFullError(Exception):
+    """Raised when all evaluation slots are busy and the wait queue is full"""
+    pass
+
+
+class PriorityClass:
+    """
+    Queue and counters of a single priority class
+
+    Parameters
+    ----------
+        name (str): class name used in stats
+        weight (float): share of slots the class gets while others are busy too
+        max_concurrency (int): evaluations of this class running at once
+        max_waiting (int): requests of this class allowed to queue
+    """
+    def __init__(self, name: str, weight: float, max_concurrency: int, max_waiting: int):
+        self.name = name
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.running = 0
+        self.dispatched = 0
+        self.rejected = 0
+        self.finish_tag = 0.0 # virtual time its last dispatched request finishes at
+        self.service_time = 0.0 # moving average of seconds a slot is held
+        self.queue = deque() # (future, enqueued at)
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+
+    @property
+    def oldest_wait(self) -> float:
+        return time.monotonic() - self.queue[0][1] if self.queue else 0.0
+
+    def drain_time(self) -> float:
+        """Estimated seconds until current queue is served"""
+        return len(self.queue) * self.service_time / self.max_concurrency
+
+    def record_service(self, duration: float):
+        self.service_time += SERVICE_TIME_ALPHA * (duration - self.service_time)
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+        def percentile(p):
+            return round(waits[min(len(waits) - 1, int(len(waits) * p))] * 1000, 3) if waits else 0.0
+        return {
+            "weight": self.weight,
+            "max_concurrency": self.max_concurrency,
+            "max_waiting": self.max_waiting,
+            "running": self.running,
+            "waiting": len(self.queue),
+            "dispatched": self.dispatched,
+            "rejected": self.rejected,
+            "oldest_wait_ms": round(self.oldest_wait * 1000, 3),
+            "service_ms": round(self.service_time * 1000, 3),
+            "wait_p50_ms": percentile(0.5),
+            "wait_p99_ms": percentile(0.99),
+        }
+
+
+class CalcScheduler:
+    """
+    Hands out evaluation slots to priority classes with weighted fair
+    queuing: every dispatched request advances its class's finish tag by
+    1 / weight and the free slot goes to the class with the smallest tag,
+    so under contention classes share slots in proportion to their weights
+    however deep each queue is. A class returning from idle starts at the
+    current virtual time instead of spending credit saved while idle
+
+    Parameters
+    ----------
+        max_concurrency (int): evaluations running at once over all classes
+        classes (dict): name -> {"weight", "max_concurrency", "max_waiting"}
+    """
+    def __init__(self, max_concurrency: int, classes: dict):
+        self.max_concurrency = max_concurrency
+        self.running = 0
+        self.virtual_time = 0.0
+        self.classes = {
+            name: PriorityClass(name, **options)
+            for name, options in classes.items()
+        }
+
+    def _start(self, cls: PriorityClass, enqueued_at: float):
+        start_tag = max(cls.finish_tag, self.virtual_time)
+        self.virtual_time = start_tag
+        cls.finish_tag = start_tag + 1 / cls.weight
+        cls.running += 1
+        cls.dispatched += 1
+        cls.waits.append(time.monotonic() - enqueued_at)
+        self.running += 1
+
+    def _dispatch(self):
+        while self.running < self.max_concurrency:
+            eligible = [
+                cls for cls in self.classes.values()
+                if cls.queue and cls.running < cls.max_concurrency
+            ]
+            if not eligible:
+                return
+            cls = min(eligible, key=lambda cls: max(cls.finish_tag, self.virtual_time))
+            future, enqueued_at = cls.queue.popleft()
+            self._start(cls, enqueued_at)
+            future.set_result(None)
+
+    async def acquire(self, priority: str):
+        cls = self.classes[priority]
+        now = time.monotonic()
+        # waiters only remain queued while they cannot run, so an empty queue
+        # of this class and free capacity mean nobody is skipped
+        if not cls.queue and cls.running < cls.max_concurrency and self.running < self.max_concurrency:
+            self._start(cls, now)
+            return
+        if len(cls.queue) >= cls.max_waiting:
+            cls.rejected += 1
+            raise CalcQueueFullError(f"Evaluation queue of {priority} class is full")
+        future = asyncio.get_running_loop().create_future()
+        entry = (future, now)
+        cls.queue.append(entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # slot was granted right before cancellation - pass it on
+                self.release(priority)
+            else:
+                cls.queue.remove(entry)
+            raise
+
+    def release(self, priority: str):
+        self.classes[priority].running -= 1
+        self.running -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: str):
+        await self.acquire(priority)
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.classes[priority].record_service(time.monotonic() - started_at)
+            self.release(priority)
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "running": self.running,
+            "classes": {name: cls.stats() for name, cls in self.classes.items()},
+        }
+
+
+_scheduler = None
+
+def get_scheduler() -> CalcScheduler:
+    """Returns process-wide evaluation scheduler configured from settings"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = CalcScheduler(
+            settings.CALC_MAX_CONCURRENCY,
+            settings.CALC_SCHEDULER_CLASSES,
+        )
+    return _scheduler
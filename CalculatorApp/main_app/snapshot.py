@@ -0,0 +1,209 @@
+import asyncio
+import datetime
+from bisect import bisect_right
+from json.encoder import encode_basestring_ascii
+from django.conf import settings
+from django.utils import timezone
+
+from main_app.utils import history, get_history_version, get_retention_horizon
+from main_app.database import get_database
+from main_app.codec import JSON, SNAPSHOT, SNAPSHOT_CHUNK, SNAPSHOT_END, DELTA, encode_frame
+
+ROW_FIELDS = ("id", "expression", "result", "timestamp") # CalculatedResultSerializer fields
+META_FIELDS = ("float_mode", "session") # fields subscriptions filter on
+LOAD_PAGE = 5000 # rows per query while loading history
+MAX_VIEWS = 256 # filtered views kept, least recently used are dropped
+
+
+def encode_row(id: int, expression: str, result: str, timestamp) -> str:
+    """JSON of a history row, same bytes as json.dumps(CalculatedResultSerializer(row).data)"""
+    if timestamp is None:
+        timestamp = "null"
+    else:
+        # DRF DateTimeField in ISO 8601: current time zone with USE_TZ, naive UTC without
+        if settings.USE_TZ:
+            timestamp = timezone.localtime(timestamp) if timezone.is_aware(timestamp) else timezone.make_aware(timestamp)
+        elif timezone.is_aware(timestamp):
+            timestamp = timezone.make_naive(timestamp, datetime.timezone.utc)
+        timestamp = timestamp.isoformat()
+        if timestamp.endswith("+00:00"):
+            timestamp = timestamp[:-6] + "Z"
+        timestamp = encode_basestring_ascii(timestamp)
+    return '{"id": %d, "expression": %s, "result": %s, "timestamp": %s}' % (
+        id, encode_basestring_ascii(expression), encode_basestring_ascii(result), timestamp
+    )
+
+
+class HistoryView:
+    """
+    Rows of the history, or of the part a subscription takes, oldest
+    first, as JSON encoded once and as loaded values. Builds sync frames
+    in any encoding and caches full snapshot chunks, so clients syncing
+    the same version of the same view share the same frames
+
+    Parameters
+    ----------
+        chunk_rows (int): rows per sync frame
+    """
+    def __init__(self, chunk_rows: int):
+        self.chunk_rows = chunk_rows
+        self.version = 0
+        self.ids = []
+        self.rows = [] # encoded rows
+        self.values = [] # ROW_FIELDS and META_FIELDS values of every row
+        self.chunks = {} # (encoding, index) -> snapshot.chunk frame of a full chunk
+        self.legacy = None # (version, legacy list text)
+
+    def _rows(self, encoding: str) -> list:
+        return self.rows if encoding == JSON else self.values
+
+    def snapshot_frames(self, encoding: str = JSON):
+        """
+        Yields (frame, version) of a snapshot of current version: a
+        snapshot frame, then snapshot.chunk frames and snapshot.end if it
+        has more rows than a frame takes. Version is None until the end
+        """
+        version, rows, chunks, size = self.version, self._rows(encoding), self.chunks, self.chunk_rows
+        count = len(rows)
+        more = count > size
+        yield encode_frame(encoding, SNAPSHOT, (version, more), rows[:size]), None if more else version
+        if not more:
+            return
+        for start in range(size, count, size):
+            key = (encoding, start // size)
+            if start + size <= count:
+                if key not in chunks:
+                    chunks[key] = encode_frame(encoding, SNAPSHOT_CHUNK, (), rows[start:start + size])
+                yield chunks[key], None
+            else:
+                yield encode_frame(encoding, SNAPSHOT_CHUNK, (), rows[start:count]), None
+        yield encode_frame(encoding, SNAPSHOT_END, (version,)), version
+
+    def delta_frames(self, since: int, encoding: str = JSON):
+        """Yields (frame, version) of consecutive deltas from since to current version, at least one"""
+        ids, rows, size = self.ids, self._rows(encoding), self.chunk_rows
+        count = len(rows)
+        start = bisect_right(ids, since, 0, count)
+        while True:
+            end = min(start + size, count)
+            # rows the view leaves out up to current version are covered by the last delta
+            version = self.version if end == count else ids[end - 1]
+            yield encode_frame(encoding, DELTA, (since, version), rows[start:end]), version
+            if end == count:
+                return
+            since, start = version, end
+
+    def legacy_text(self) -> str:
+        """Rows as the plain JSON list legacy clients get"""
+        if self.legacy is None or self.legacy[0] != self.version:
+            self.legacy = (self.version, "[" + ", ".join(self.rows) + "]")
+        return self.legacy[1]
+
+
+class HistorySnapshot:
+    """
+    Whole history kept encoded, shared by every consumer of the process.
+    Rows are read with values_list() and encoded once by encode_row();
+    refresh() appends rows stored since the last call, so a new version
+    costs only its new rows. Filtered subscriptions get views picking
+    their rows from it, one per distinct filter set, brought up to date
+    when asked for
+
+    Parameters
+    ----------
+        chunk_rows (int): rows per sync frame
+    """
+    def __init__(self, chunk_rows: int):
+        self.chunk_rows = chunk_rows
+        self.rebuilds = 0
+        self.retention_run = None # latest retention run the rows reflect
+        self.horizon = None # history version at that run, older versions get snapshots
+        self._all = HistoryView(chunk_rows)
+        self._views = {} # subscription key -> HistoryView, least recently used first
+        self._lock = asyncio.Lock()
+
+    @property
+    def version(self) -> int:
+        return self._all.version
+
+    async def refresh(self) -> int:
+        """Brings snapshot up to the newest row, returns its version"""
+        async with self._lock:
+            if self.horizon is None:
+                self.horizon = await get_retention_horizon()
+            version = await get_history_version()
+            if version < self.version:
+                # history was cleared, ids started over
+                self.clear()
+            view = self._all
+            while view.version < version:
+                rows = await get_database().read(lambda after=view.version: list(
+                    history().filter(id__gt=after, id__lte=version)
+                    .order_by("id").values_list(*ROW_FIELDS, *META_FIELDS)[:LOAD_PAGE]
+                ))
+                if not rows:
+                    break
+                view.ids.extend(row[0] for row in rows)
+                view.rows.extend(encode_row(*row[:4]) for row in rows)
+                view.values.extend(rows)
+                view.version = rows[-1][0]
+            view.version = version
+            return version
+
+    def expire(self, run: int, version: int):
+        """Drops rows once per retention run, they are loaded again without the deleted ones"""
+        self.horizon = max(self.horizon or 0, version)
+        if run != self.retention_run:
+            self.retention_run = run
+            self.clear()
+
+    def clear(self):
+        # new lists, frames being streamed keep the old ones
+        self._all = HistoryView(self.chunk_rows)
+        self._views = {}
+        self.rebuilds += 1
+
+    def view(self, subscription=None) -> HistoryView:
+        """View of the rows subscription takes, whole history without filters"""
+        if subscription is None or not subscription.filtered:
+            return self._all
+        view = self._views.pop(subscription.key, None) or HistoryView(self.chunk_rows)
+        self._views[subscription.key] = view
+        if len(self._views) > MAX_VIEWS:
+            del self._views[next(iter(self._views))]
+        if view.version == self.version:
+            return view
+        ids, rows, values = self._all.ids, self._all.rows, self._all.values
+        for i in range(bisect_right(ids, view.version), len(ids)):
+            row = values[i]
+            if subscription.matches(row[4], row[5], row[3]):
+                view.ids.append(ids[i])
+                view.rows.append(rows[i])
+                view.values.append(row)
+        if subscription.last and len(view.ids) > subscription.last:
+            # new lists, frames being streamed keep the old ones
+            view.ids = view.ids[-subscription.last:]
+            view.rows = view.rows[-subscription.last:]
+            view.values = view.values[-subscription.last:]
+            view.chunks = {}
+        view.version = self.version
+        return view
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "rows": len(self._all.rows),
+            "cached_chunks": len(self._all.chunks),
+            "views": len(self._views),
+            "rebuilds": self.rebuilds,
+        }
+
+
+_snapshot = None
+
+def get_snapshot() -> HistorySnapshot:
+    """Returns process-wide history snapshot"""
+    global _snapshot
+    if _snapshot is None:
+        _snapshot = HistorySnapshot(settings.CALC_SYNC_CHUNK_ROWS)
+    return _snapshot
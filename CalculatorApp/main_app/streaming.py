@@ -0,0 +1,249 @@
+import re
+import json
+import asyncio
+from urllib.parse import parse_qs
+from django.conf import settings
+
+from main_app.models import CalculatedResult
+from main_app.writebehind import store_results
+from main_app.scheduler import BULK
+from main_app.admission import admit_scope, RATE_LIMITED
+from main_app.utils import validate_float_mode, validate_session, validate_batch_item, evaluate_expression, evaluation_error
+
+INPUT_ORDER = "input"
+COMPLETION_ORDER = "completion"
+
+
+class CalcStreamApp:
+    """
+    Raw ASGI endpoint for POST /calc/stream. Django buffers whole request
+    bodies before calling a view, so this app sits in front of it and
+    works on the body as the server hands it over. Daphne does so only
+    once the whole body is received; servers streaming request bodies
+    (uvicorn, hypercorn) let answers start during the upload.
+
+    Every non-empty NDJSON line is either a JSON string (evaluated in the
+    mode given by `?float=`) or an `{expression, float}` object. Each one
+    gets an NDJSON answer `{index, expression, result}` or
+    `{index, error[, code]}`, in input order (`?order=input`, default) or
+    as soon as it is ready (`?order=completion`).
+
+    At most CALC_STREAM_WINDOW lines are in flight, counting answers held
+    back for ordering, and CALC_BATCH_CONCURRENCY of them are evaluated at
+    once; reading pauses while the window is full, so memory stays
+    constant however long the stream is. Successful rows are stored
+    in batches of CALC_STREAM_FLUSH_ROWS rows, tagged with `?session=`
+    if given.
+
+    Every line after the first costs a token of the client's rate limit.
+    A line that is rejected gets `{index, error, retry_after}` and the
+    rest of the body is not evaluated
+    """
+    async def __call__(self, scope, receive, send):
+        if scope["method"] != "POST":
+            await self._send_plain(send, 405, b"Method not allowed")
+            return
+        params = parse_qs(scope["query_string"].decode("latin-1"))
+        try:
+            float_mode = validate_float_mode(params.get("float", ["false"])[0])
+            session = validate_session(params.get("session", [""])[0])
+            order = params.get("order", [INPUT_ORDER])[0]
+            if order not in (INPUT_ORDER, COMPLETION_ORDER):
+                raise Exception("Incorrect order value")
+        except Exception as e:
+            await self._send_plain(send, 400, str(e).encode("utf-8"))
+            return
+        if rejection := admit_scope(scope, BULK):
+            status, retry_after = rejection
+            await self._send_plain(send, status, b"Request rejected", ((b"retry-after", str(retry_after).encode()),))
+            return
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/x-ndjson")],
+        })
+        stream = CalcStream(scope, send, float_mode, order, session)
+        work = asyncio.create_task(stream.run(receive))
+        try:
+            await work
+        finally:
+            # client went away or server is shutting down
+            if not work.done():
+                work.cancel()
+            stream.cancel()
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    @staticmethod
+    async def _send_plain(send, status: int, body: bytes, headers: tuple = ()):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/plain; charset=utf-8"), *headers],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+class CalcStream:
+    """State of a single /calc/stream request"""
+    def __init__(self, scope, send, float_mode: bool, order: str, session: str = ""):
+        self.scope = scope
+        self.send = send
+        self.float_mode = float_mode
+        self.order = order
+        self.session = session
+        self.window = asyncio.Semaphore(settings.CALC_STREAM_WINDOW)
+        # keep stream from flooding shared evaluation queue
+        self.evaluating = asyncio.Semaphore(settings.CALC_BATCH_CONCURRENCY)
+        self.tasks = set()
+        self.ready = {} # index -> (answer, row), held back for input order
+        self.next_index = 0 # index of next line read
+        self.next_emit = 0 # index of next answer sent in input order
+        self.rows = []
+        self.disconnected = asyncio.Event()
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def run(self, receive):
+        body_done = asyncio.create_task(self._read_body(receive))
+        disconnect = asyncio.create_task(self.disconnected.wait())
+        try:
+            done, _ = await asyncio.wait({body_done, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnect in done:
+                return
+            body_done.result()
+            # body is read, wait for answers while watching for disconnect
+            watcher = asyncio.create_task(self._watch_disconnect(receive))
+            try:
+                while self.tasks and not self.disconnected.is_set():
+                    await asyncio.wait(self.tasks | {disconnect}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                watcher.cancel()
+        finally:
+            body_done.cancel()
+            disconnect.cancel()
+            # answered rows are stored even if the client went away
+            await self._flush_rows()
+
+    async def _watch_disconnect(self, receive):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                self.disconnected.set()
+                return
+
+    async def _read_body(self, receive):
+        max_line = settings.CALC_STREAM_MAX_LINE
+        buffer = b""
+        skipping = False # inside a line that is already too long
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                self.disconnected.set()
+                return
+            chunk = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if not more_body:
+                chunk += b"\n" # last line may lack a newline
+            start = 0
+            while (end := chunk.find(b"\n", start)) != -1:
+                if skipping:
+                    skipping = False
+                elif not await self._schedule(buffer + chunk[start:end]):
+                    return
+                buffer = b""
+                start = end + 1
+            if not skipping:
+                buffer += chunk[start:]
+                if len(buffer) > max_line:
+                    buffer = b""
+                    skipping = True
+                    if not await self._schedule(None):
+                        return
+
+    async def _schedule(self, line) -> bool:
+        """Starts answering a line, False if it was rejected and reading must stop"""
+        if line is not None and not line.strip():
+            return True
+        await self.window.acquire()
+        index = self.next_index
+        self.next_index += 1
+        # first line was paid for by admission of the request
+        rejection = admit_scope(self.scope, BULK) if index else None
+        if rejection:
+            task = asyncio.create_task(self._reject(index, *rejection))
+        else:
+            task = asyncio.create_task(self._evaluate(index, line))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return rejection is None
+
+    async def _reject(self, index: int, status: int, retry_after: int):
+        await self._emit(index, {
+            "index": index,
+            "error": "Too many requests" if status == RATE_LIMITED else "Server is overloaded",
+            "retry_after": retry_after,
+        }, None)
+
+    async def _evaluate(self, index: int, line):
+        answer, row = {"index": index}, None
+        try:
+            if line is None:
+                raise Exception(f"Line exceeds {settings.CALC_STREAM_MAX_LINE} bytes")
+            item = json.loads(line)
+            if isinstance(item, str):
+                float_mode, expression = self.float_mode, item
+            else:
+                float_mode, expression = validate_batch_item(item, self.float_mode)
+        except Exception as e:
+            answer["error"] = str(e)
+        else:
+            # app.exe decides what whitespace means, only the stored form is stripped
+            answer["expression"] = re.sub(r"\s", "", expression)
+            try:
+                async with self.evaluating:
+                    answer["result"] = await evaluate_expression(float_mode, expression, BULK)
+                row = CalculatedResult(
+                    expression=answer["expression"], result=answer["result"], float_mode=float_mode, session=self.session,
+                )
+            except Exception as e:
+                answer.update(evaluation_error(e))
+        await self._emit(index, answer, row)
+
+    async def _emit(self, index: int, answer: dict, row):
+        if self.order == COMPLETION_ORDER:
+            await self._send_answer(answer, row)
+            return
+        self.ready[index] = (answer, row)
+        # only the task completing the head of the line sends, others wait in `ready`
+        if index != self.next_emit:
+            return
+        while self.next_emit in self.ready:
+            answer, row = self.ready.pop(self.next_emit)
+            self.next_emit += 1
+            await self._send_answer(answer, row)
+
+    async def _send_answer(self, answer: dict, row):
+        await self.send({
+            "type": "http.response.body",
+            "body": json.dumps(answer).encode("utf-8") + b"\n",
+            "more_body": True,
+        })
+        self.window.release()
+        if row is not None:
+            self.rows.append(row)
+            if len(self.rows) >= settings.CALC_STREAM_FLUSH_ROWS:
+                await self._flush_rows()
+
+    async def _flush_rows(self):
+        rows, self.rows = self.rows, []
+        if not rows:
+            return
+        try:
+            await store_results(rows)
+        except Exception as e:
+            # answers are already sent, a failed insert must not end the stream
+            print(e)
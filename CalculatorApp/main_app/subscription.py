@@ -0,0 +1,63 @@
+import datetime
+
+from main_app.utils import validate_session, validate_mode, validate_timestamp
+
+
+class Subscription:
+    """
+    Part of the history a /ws/sync client wants, from its query string:
+    `last=<N>` newest N rows, `after=<ISO timestamp>` rows stored since
+    then, `own=true` rows tagged with its `session=<id>`, `mode=int|float`
+    rows of one evaluation mode. `session` also tags calculations sent on
+    the socket. Subscriptions with the same filters have the same `key`,
+    subscribers share encoded frames by it
+
+    Parameters
+    ----------
+        params (dict): parsed query string, as parse_qs() returns it
+    """
+    def __init__(self, params: dict):
+        param = lambda name: params.get(name, [None])[0]
+        self.session = validate_session(param("session") or "")
+        self.last = self._parse_last(param("last"))
+        after = param("after")
+        self.after = validate_timestamp(after, "after") if after is not None else None
+        own = param("own") or "false"
+        if own not in ("false", "true"):
+            raise Exception("Incorrect own value")
+        self.own = own == "true"
+        if self.own and not self.session:
+            raise Exception("own=true needs a session")
+        mode = param("mode")
+        self.float_mode = validate_mode(mode) if mode is not None else None
+        self.key = (self.last, self.after, self.session if self.own else None, self.float_mode)
+        self.filtered = self.key != (None, None, None, None)
+
+    @staticmethod
+    def _parse_last(last):
+        if last is None:
+            return None
+        if not last.isdigit() or int(last) == 0:
+            raise Exception("Incorrect last value")
+        return int(last)
+
+    def matches(self, float_mode: bool, session: str, timestamp) -> bool:
+        """Whether a row passes the filters, `last` aside"""
+        if self.float_mode is not None and float_mode != self.float_mode:
+            return False
+        if self.own and session != self.session:
+            return False
+        return self.after is None or timestamp >= self.after
+
+    def select(self, rows: list, meta: list, after_id: int) -> list:
+        """
+        Serialized rows of a delta broadcast newer than after_id which pass
+        the filters, `[float_mode, session]` of each is in meta
+        """
+        rows = [
+            row for row, (float_mode, session) in zip(rows, meta)
+            if row["id"] > after_id and self.matches(
+                float_mode, session, self.after and datetime.datetime.fromisoformat(row["timestamp"])
+            )
+        ]
+        return rows[-self.last:] if self.last else rows
@@ -0,0 +1,181 @@
+import sqlite3
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from main_app.database import get_database
+from main_app.serializers import CalculatedResultSerializer
+from main_app.utils import get_history_version, get_history_page, get_retention_run
+
+SYNC_GROUP = "sync_group"
+MAX_ANNOUNCED = 256 # deltas after a gap kept until the gap is announced too
+
+
+class HistoryWatcher:
+    """
+    Cheap check whether history may have changed since the last call.
+    On SQLite it compares `PRAGMA data_version` of a private connection,
+    which moves whenever another connection (any process) commits and
+    needs no table read; on other databases it compares history version.
+    The pragma waits like any query while the database is busy, so it runs
+    on a reader thread
+    """
+    def __init__(self):
+        self.version = None # newest row up to which every row was published, by any process
+        self._announced = {} # from -> version of deltas received past a gap
+        self._data_version = None
+        self._conn = None
+        database = settings.DATABASES["default"]
+        if database["ENGINE"] == "django.db.backends.sqlite3":
+            self._conn = sqlite3.connect(str(database["NAME"]), check_same_thread=False)
+
+    async def changed(self) -> bool:
+        if self._conn is not None:
+            data_version = await get_database().read(self._read_data_version)
+            changed = data_version != self._data_version
+            self._data_version = data_version
+            return changed
+        return await get_history_version() != self.version
+
+    def _read_data_version(self) -> int:
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def seen(self, version: int):
+        self.version = max(self.version or 0, version)
+
+    def announced(self, start: int, version: int):
+        """Records a delta of rows after start up to version broadcast by any process"""
+        if self.version is None:
+            return # first heartbeat starts from the newest row
+        if start > self.version:
+            # rows of the gap may still come, until then the heartbeat publishes them
+            self._announced[start] = max(version, self._announced.get(start, 0))
+            if len(self._announced) > MAX_ANNOUNCED:
+                del self._announced[min(self._announced)]
+            return
+        self.seen(version)
+        while self._announced:
+            start = min(self._announced)
+            if start > self.version:
+                return
+            self.seen(self._announced.pop(start))
+
+    def reset(self):
+        """Forgets version, next heartbeat starts from the newest row"""
+        self.version = None
+        self._announced.clear()
+
+
+class LatestVersion:
+    """
+    Newest history version and retention run for pollers, read again only
+    after its own HistoryWatcher saw a commit, so on SQLite an unchanged
+    history costs no query
+    """
+    def __init__(self):
+        self.version = None
+        self.retention = None
+        self._watcher = HistoryWatcher()
+
+    async def get(self) -> tuple:
+        """(version, retention run)"""
+        if await self._watcher.changed() or self.version is None:
+            self.version = await get_history_version()
+            self.retention = await get_retention_run()
+            self._watcher.seen(self.version)
+        return (self.version, self.retention)
+
+
+_watcher = None
+
+def get_watcher() -> HistoryWatcher:
+    """Returns process-wide history watcher"""
+    global _watcher
+    if _watcher is None:
+        _watcher = HistoryWatcher()
+    return _watcher
+
+
+_latest = None
+
+def get_latest_version() -> LatestVersion:
+    """Returns process-wide latest version cache"""
+    global _latest
+    if _latest is None:
+        _latest = LatestVersion()
+    return _latest
+
+
+async def publish_rows(rows: list, meta: list):
+    """
+    Broadcasts serialized rows (oldest first) as a delta right after they
+    are stored. Ids are allocated contiguously, so the delta starts right
+    before the first row; consumers which are further behind catch up
+    from the database. `meta` gives `[float_mode, session]` of every row,
+    subscribers filter on it
+    """
+    if not rows:
+        return
+    version = rows[-1]["id"]
+    get_watcher().seen(version)
+    try:
+        await get_channel_layer().group_send(
+            SYNC_GROUP,
+            {
+                "type": "sync.delta",
+                "from": rows[0]["id"] - 1,
+                "version": version,
+                "rows": [dict(row) for row in rows],
+                "meta": meta,
+            }
+        )
+    except Exception as e:
+        # rows are stored already, consumers catch up on next heartbeat
+        print(e)
+
+
+async def publish_retention(run: int, version: int, until: int, keep: list):
+    """
+    Tells every process that retention run `run`, finished at history
+    `version`, deleted rows, every row up to `until` but the ids in
+    `keep`, so snapshots drop them and clients drop them too or get their
+    history again
+    """
+    try:
+        await get_channel_layer().group_send(
+            SYNC_GROUP,
+            {"type": "sync.retention", "run": run, "version": version, "until": until, "keep": keep},
+        )
+    except Exception as e:
+        # snapshots keep deleted rows until the next run reaches them
+        print(e)
+
+
+async def publish_results(results: list):
+    """publish_rows() for freshly created CalculatedResult objects"""
+    results = sorted(results, key=lambda obj: obj.id)
+    await publish_rows(
+        CalculatedResultSerializer(results, many=True).data,
+        [[obj.float_mode, obj.session] for obj in results],
+    )
+
+
+async def heartbeat():
+    """
+    One tick of the sync heartbeat: publishes rows written by other
+    processes which no delta announced (only if the watcher saw a commit,
+    e.g. the writer crashed before broadcasting) and tells consumers the
+    newest version so they can detect missed deltas
+    """
+    watcher = get_watcher()
+    if watcher.version is None:
+        # rows stored before this process started are covered by initial sync
+        watcher.seen(await get_history_version())
+        await watcher.changed()
+    elif await watcher.changed():
+        version = await get_history_version()
+        while rows := await get_history_page(watcher.version, version, settings.CALC_SYNC_CHUNK_ROWS):
+            await publish_results(rows)
+    await get_channel_layer().group_send(
+        SYNC_GROUP,
+        {"type": "sync.heartbeat", "version": watcher.version},
+    )
@@ -2,10 +2,20 @@ from django.urls import path
 
 from . import views
 from . import consumers
+from . import streaming
 
 urlpatterns = [
     path('health', views.healthcheck_view),
-    path('calc', views.calculate_view)
+    path('calc', views.calculate_view),
+    path('calc/batch', views.calculate_batch_view),
+    path('calc/vector', views.calculate_vector_view),
+    path('history', views.history_view),
+    path('stats', views.stats_view),
+]
+
+# raw ASGI apps routed ahead of Django in asgi.py
+stream_urlpatterns = [
+    path("calc/stream", streaming.CalcStreamApp()),
 ]
 
 websocket_urlpatterns = [
@@ -1,30 +1,191 @@
+import re
 import json
-from asgiref.sync import sync_to_async
+import datetime
+from django.conf import settings
+from django.utils import timezone
+from django.db.models import Max
 
-from main_app.models import CalculatedResult
+from main_app.models import CalculatedResult, RetentionRun
+from main_app.database import get_database
 from main_app.serializers import CalculatedResultSerializer
+from main_app.runner import CalcManager, CalcError, CalcQueueFullError, CalcTimeoutError, FLOAT_MODE, INT_MODE
+from main_app.cache import get_cache, OK, ERR
+from main_app.scheduler import INTERACTIVE
+
+SESSION_RE = re.compile(r"[\w-]{0,64}", re.ASCII)
+MODES = {"int": False, "float": True} # mode= values -> float_mode
+
+def history():
+    """Rows as history queries see them, through the read-only alias"""
+    return CalculatedResult.objects.using(settings.HISTORY_DB)
 
 async def get_result_history():
-    async_get_data = sync_to_async(lambda: 
-        CalculatedResultSerializer(
-            CalculatedResult.objects.all(), # returns new queryset so non-blocking
-            many=True
-        ).data
+    return await get_database().read(lambda:
+        CalculatedResultSerializer(history().all(), many=True).data
     )
-    
-    return await async_get_data() # await coroutine
 
-async def validate_request(request):
-    #float-mode validation
-    float_mode = request.GET.get('float', 'false')
+async def get_history_version() -> int:
+    """History version is the id of the newest row, ids are never reused"""
+    return await get_database().read(lambda:
+        history().aggregate(version=Max('id'))['version'] or 0
+    )
+
+async def get_retention_run() -> int:
+    """Id of the latest retention run which deleted rows, 0 if none did"""
+    return await get_database().read(lambda:
+        RetentionRun.objects.using(settings.HISTORY_DB).filter(deleted__gt=0).aggregate(run=Max('id'))['run'] or 0
+    )
+
+async def get_retention_horizon() -> int:
+    """History version at the latest retention run which deleted rows, 0 if none did"""
+    return await get_database().read(lambda:
+        RetentionRun.objects.using(settings.HISTORY_DB).filter(deleted__gt=0).aggregate(version=Max('version'))['version'] or 0
+    )
+
+async def get_history_rows(after_id: int, until: int, limit: int, filters: dict) -> list:
+    """
+    (id, expression, result, timestamp) of rows with after_id < id <= until
+    passing filters, oldest first, at most limit of them. Seeks by primary
+    key, so a page costs the same however deep it is
+    """
+    return await get_database().read(lambda: list(
+        history().filter(id__gt=after_id, id__lte=until, **filters)
+        .order_by('id').values_list('id', 'expression', 'result', 'timestamp')[:limit]
+    ))
+
+async def get_history_page(after: int, until: int, limit: int) -> list:
+    """
+    Rows with after < id <= until, oldest first, at most limit of them.
+    Pages are separate queries, so reading history page by page holds no
+    cursor (and no SQLite read lock) between them
+    """
+    return await get_database().read(lambda: list(
+        history().filter(id__gt=after, id__lte=until).order_by('id')[:limit]
+    ))
+
+def validate_float_mode(float_mode) -> bool:
+    # query string gives 'true'/'false', JSON bodies may give booleans
+    if isinstance(float_mode, bool):
+        return float_mode
     if float_mode not in ['false','true']:
         raise Exception("Incorrect float value")
-    float_mode = True if float_mode == "true" else False    
+    return True if float_mode == "true" else False
+
+def validate_session(session) -> str:
+    # optional client tag stored with results, sync subscribers may filter by it
+    if not isinstance(session, str) or not SESSION_RE.fullmatch(session):
+        raise Exception("Incorrect session value")
+    return session
+
+def validate_mode(mode) -> bool:
+    """float_mode of an `int` or `float` mode value"""
+    if mode not in MODES:
+        raise Exception("Incorrect mode value")
+    return MODES[mode]
+
+def validate_timestamp(timestamp, name: str) -> datetime.datetime:
+    """ISO 8601 query value, comparable with stored timestamps"""
+    try:
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        raise Exception(f"Incorrect {name} value")
+    if settings.USE_TZ and timezone.is_naive(timestamp):
+        return timezone.make_aware(timestamp)
+    if not settings.USE_TZ and timezone.is_aware(timestamp):
+        return timezone.make_naive(timestamp)
+    return timestamp
+
+def validate_expression(body) -> str:
+    if not isinstance(body, str):
+        raise Exception(f"Incorrect input data {body!r}")
+    return body
+
+async def validate_request(request):
+    #float-mode validation
+    float_mode = validate_float_mode(request.GET.get('float', 'false'))
     #request data validation
     if not request.body:
         raise Exception("Empty request body")
     body = json.loads(request.body.decode('utf-8'))
-    if not isinstance(body, str):
-        raise Exception("Incorrect input data ", input=body)
-    return (float_mode, body)
-    
\ No newline at end of file
+    return (float_mode, validate_expression(body))
+
+def validate_batch_item(item, float_default: bool = False):
+    """Validates one `{expression, float}` item of a batch or stream request"""
+    if not isinstance(item, dict):
+        raise Exception(f"Incorrect batch item {item!r}")
+    float_mode = validate_float_mode(item.get('float', float_default))
+    return (float_mode, validate_expression(item.get('expression')))
+
+async def validate_batch_request(request) -> list:
+    if not request.body:
+        raise Exception("Empty request body")
+    items = json.loads(request.body.decode('utf-8'))
+    if not isinstance(items, list):
+        raise Exception("Batch request body must be a JSON array")
+    if len(items) > settings.CALC_BATCH_MAX_ITEMS:
+        raise Exception(f"Batch is limited to {settings.CALC_BATCH_MAX_ITEMS} items")
+    return items
+
+def validate_history_request(request):
+    """Returns (after_id, limit, filters) of a GET /history request"""
+    after_id = request.GET.get('after_id', '0')
+    if not after_id.isdigit():
+        raise Exception("Incorrect after_id value")
+    limit = request.GET.get('limit', str(settings.CALC_HISTORY_PAGE_ROWS))
+    if not limit.isdigit() or not 0 < int(limit) <= settings.CALC_HISTORY_MAX_ROWS:
+        raise Exception(f"limit must be between 1 and {settings.CALC_HISTORY_MAX_ROWS}")
+    filters = {}
+    if 'after' in request.GET:
+        filters['timestamp__gte'] = validate_timestamp(request.GET['after'], 'after')
+    if 'before' in request.GET:
+        filters['timestamp__lt'] = validate_timestamp(request.GET['before'], 'before')
+    if 'mode' in request.GET:
+        filters['float_mode'] = validate_mode(request.GET['mode'])
+    return (int(after_id), int(limit), filters)
+
+async def validate_vector_request(request):
+    float_mode = validate_float_mode(request.GET.get('float', 'false'))
+    if not request.body:
+        raise Exception("Empty request body")
+    body = json.loads(request.body.decode('utf-8'))
+    if not isinstance(body, dict):
+        raise Exception("Vector request body must be a JSON object")
+    return (float_mode, validate_expression(body.get('expression')), body.get('variables', {}))
+
+async def evaluate_expression(float_mode: bool, expression: str, priority: str = INTERACTIVE) -> str:
+    """
+    Evaluates expression through the result cache, falls back to
+    CalcManager on a miss, which waits in `priority` scheduler class.
+    Raises CalcError for rejected expressions, cached or not
+    """
+    _, mode_str = FLOAT_MODE if float_mode else INT_MODE
+    cache = get_cache()
+    key = cache.make_key(mode_str, expression)
+    outcome = cache.get(key) if key is not None else None
+    if outcome is None:
+        runner = CalcManager(
+            float_mode=float_mode,
+            input_data=expression,
+            priority=priority,
+        )
+        try:
+            outcome = (OK, await runner.run_app_async())
+        except CalcError as e:
+            outcome = (ERR, str(e.code))
+        if key is not None:
+            cache.put(key, outcome)
+    status, payload = outcome
+    if status != OK:
+        raise CalcError(int(payload))
+    return payload
+
+def evaluation_error(e: Exception) -> dict:
+    """Describes a failed evaluation as a per-item `{error[, code]}` object"""
+    if isinstance(e, CalcError):
+        return {"error": e.reason, "code": e.code}
+    if isinstance(e, CalcQueueFullError):
+        return {"error": "Server is busy"}
+    if isinstance(e, CalcTimeoutError):
+        return {"error": "Evaluation timed out"}
+    print(e)
+    return {"error": "Runtime error occured"}
@@ -0,0 +1,294 @@
+import string
+from functools import lru_cache
+import numpy as np
+
+from main_app.runner import CalcError
+
+FLOAT_PRECISION = 1e-4 # same as calculator.h
+INT_DIV_BY_ZERO = 1
+FLOAT_DIV_BY_ZERO = 2
+INVALID_INPUT = 3
+PARENTHESIS = 4
+
+SPACES = " \t\n\v\f\r" # C isspace()
+DIGITS = string.digits
+NAME_START = string.ascii_letters + "_"
+NAME_CHARS = NAME_START + DIGITS
+OPERATORS = "+-*/"
+VALID_CHARS = frozenset(SPACES + NAME_CHARS + OPERATORS + "()")
+
+# previous token, as TokenKind in calculator.h
+START, OPERAND, OPERATOR, OPEN, CLOSE = range(5)
+
+# program node kinds besides operators
+NUMBER = "n"
+VARIABLE = "v"
+
+
+class _Frame:
+    """Parenthesis level being parsed, mirrors CalcFrame"""
+    __slots__ = ("sum", "product", "sum_op", "product_op")
+
+    def __init__(self):
+        self.sum = None
+        self.product = None
+        self.sum_op = "+"
+        self.product_op = "*"
+
+
+class VectorProgram:
+    """
+    Expression compiled once and evaluated over whole arrays. Nodes are
+    `(kind, a, b)` tuples where children always precede their parent:
+    `("n", value, None)` literal, `("v", name, None)` variable or
+    `(operator, left, right)` with indexes of operand nodes
+
+    Parameters
+    ----------
+        nodes (tuple): program in evaluation order, last node is the result
+        variables (frozenset): variable names used by the expression
+        float_mode (bool): FLOAT or INT arithmetic
+    """
+    def __init__(self, nodes: tuple, variables: frozenset, float_mode: bool):
+        self.nodes = nodes
+        self.variables = variables
+        self.float_mode = float_mode
+        self.dtype = np.float64 if float_mode else np.int64
+
+    def evaluate(self, arrays: dict):
+        """
+        Evaluates program over 1-D arrays (or scalars) of the same length.
+        Returns (values, mask) where mask marks elements which divide by
+        zero; their values are meaningless
+        """
+        length = max((np.size(array) for array in arrays.values()), default=1)
+        mask = np.zeros(length, dtype=bool)
+        values = [None] * len(self.nodes)
+        with np.errstate(all="ignore"):
+            for i, (kind, a, b) in enumerate(self.nodes):
+                if kind == NUMBER:
+                    values[i] = self.dtype(a)
+                elif kind == VARIABLE:
+                    values[i] = arrays[a]
+                else:
+                    left, right = values[a], values[b]
+                    # every node has a single parent, drop operands as they are used
+                    values[a] = values[b] = None
+                    if kind == "+":
+                        values[i] = left + right
+                    elif kind == "-":
+                        values[i] = left - right
+                    elif kind == "*":
+                        values[i] = left * right
+                    else:
+                        values[i], zero = (self._float_divide if self.float_mode else self._int_divide)(left, right)
+                        mask |= zero
+            result = np.broadcast_to(np.asarray(values[-1], dtype=self.dtype), (length,))
+        return result, mask
+
+    @staticmethod
+    def _int_divide(left, right):
+        # C division truncates, numpy floor_divide rounds towards -inf
+        zero = right == 0
+        minus_one = right == -1
+        divisor = np.where(zero | minus_one, 1, right)
+        quotient = np.floor_divide(left, divisor)
+        quotient = quotient + ((np.remainder(left, divisor) != 0) & ((left < 0) != (divisor < 0)))
+        # x / -1 is a wrapping negation, as in apply_operation
+        return np.where(minus_one, np.negative(left), quotient), zero
+
+    @staticmethod
+    def _float_divide(left, right):
+        zero = np.abs(right) < FLOAT_PRECISION
+        return left / np.where(zero, 1.0, right), zero
+
+    def format(self, values) -> np.ndarray:
+        """Formats results as calc_format_result does ("%ld" / "%.4f")"""
+        if not self.float_mode:
+            return values.astype(str)
+        # glibc prints NaN with its sign bit
+        return np.where(np.isnan(values) & np.signbit(values), "-nan", np.char.mod("%.4f", values))
+
+
+def _to_int64(value: int) -> int:
+    """Wraps accumulated digits the way long overflow does"""
+    value &= 0xFFFFFFFFFFFFFFFF
+    return value - (1 << 64) if value >> 63 else value
+
+
+@lru_cache(maxsize=256)
+def compile_expression(expression: str, float_mode: bool) -> VectorProgram:
+    """
+    Compiles expression with named variables into VectorProgram. Grammar,
+    literal parsing and error priority follow calc_stream_feed: variables
+    are operands just like numbers. Raises CalcError with the code scalar
+    evaluation would give; deferred structural errors (implicit
+    multiplication, empty parenthesis) reject the whole expression even
+    where scalar evaluation would stop at an earlier division by zero
+    """
+    nodes = []
+    variables = set()
+    frames = [_Frame()]
+    error = 0 # first deferred error, as CalcContext.error
+    prev = START
+    space_after_operand = False
+    unbalanced = False
+    number = 0
+    name = None # name of current operand if it is a variable
+
+    def fail(code):
+        nonlocal error
+        if not error:
+            error = code
+
+    def add(kind, a, b=None) -> int:
+        nodes.append((kind, a, b))
+        return len(nodes) - 1
+
+    def push_operand(frame, operand):
+        if frame.product is None:
+            frame.product = operand
+        else:
+            frame.product = add(frame.product_op, frame.product, operand)
+
+    def fold_product(frame):
+        if frame.sum is None:
+            frame.sum = frame.product
+        else:
+            frame.sum = add(frame.sum_op, frame.sum, frame.product)
+        frame.product = None
+
+    def finish_operand():
+        if prev == OPERAND:
+            if name is not None:
+                variables.add(name)
+                push_operand(frames[-1], add(VARIABLE, name))
+            else:
+                push_operand(frames[-1], add(NUMBER, number if float_mode else _to_int64(number)))
+
+    for c in expression:
+        if c not in VALID_CHARS:
+            raise CalcError(INVALID_INPUT)
+
+        if c in SPACES:
+            if prev == OPERAND:
+                space_after_operand = True
+            continue
+
+        if c in NAME_CHARS:
+            if prev == OPERAND:
+                # two operands separated by spaces, or a number running into a name
+                if space_after_operand or (name is None and c in NAME_START):
+                    raise CalcError(INVALID_INPUT)
+                if name is not None:
+                    name += c
+                elif float_mode:
+                    number = number * 10 + int(c)
+                else:
+                    number = (number * 10 + int(c)) & 0xFFFFFFFFFFFFFFFF
+            else:
+                # operand right after closing parenthesis is implicit multiplication
+                if prev == CLOSE:
+                    fail(INVALID_INPUT)
+                if c in NAME_START:
+                    name = c
+                else:
+                    name = None
+                    number = float(int(c)) if float_mode else int(c)
+            prev = OPERAND
+            space_after_operand = False
+            continue
+
+        finish_operand()
+        space_after_operand = False
+        if unbalanced:
+            # structure is broken already, only look for invalid operators
+            if c in OPERATORS:
+                if prev in (OPERATOR, OPEN):
+                    raise CalcError(INVALID_INPUT)
+                prev = OPERATOR
+            else:
+                prev = OPEN if c == "(" else CLOSE
+            continue
+
+        frame = frames[-1]
+        if c in OPERATORS:
+            if prev in (START, OPERATOR, OPEN):
+                raise CalcError(INVALID_INPUT)
+            if c in "+-":
+                fold_product(frame)
+                frame.sum_op = c
+            else:
+                frame.product_op = c
+            prev = OPERATOR
+        elif c == "(":
+            if prev in (OPERAND, CLOSE):
+                fail(INVALID_INPUT)
+            frames.append(_Frame())
+            prev = OPEN
+        else: # ")"
+            if len(frames) == 1:
+                unbalanced = True
+            else:
+                # empty parenthesis or operator right before ")"
+                if prev not in (OPERAND, CLOSE):
+                    fail(PARENTHESIS)
+                    if frame.product is None:
+                        frame.product = add(NUMBER, 0)
+                fold_product(frame)
+                frames.pop()
+                push_operand(frames[-1], frame.sum)
+            prev = CLOSE
+
+    if unbalanced or len(frames) != 1:
+        raise CalcError(PARENTHESIS)
+    if prev == OPERATOR:
+        raise CalcError(INVALID_INPUT)
+    finish_operand()
+    if error:
+        raise CalcError(error)
+
+    frame = frames[0]
+    if frame.product is None:
+        # empty expression evaluates to zero
+        add(NUMBER, 0)
+    else:
+        fold_product(frame)
+    return VectorProgram(tuple(nodes), frozenset(variables), float_mode)
+
+
+def prepare_variables(program: VectorProgram, variables: dict, max_elements: int) -> dict:
+    """
+    Converts request variables (numbers or lists of numbers) into arrays
+    of program's dtype. Lists must share one length; integers are
+    required in INT mode
+    """
+    if not isinstance(variables, dict):
+        raise Exception("Variables must be an object")
+    missing = program.variables - variables.keys()
+    if missing:
+        raise Exception(f"Missing variables: {', '.join(sorted(missing))}")
+    kinds = "if" if program.float_mode else "i"
+    arrays = {}
+    length = None
+    for name in program.variables:
+        array = np.asarray(variables[name])
+        if array.ndim > 1 or (array.size and array.dtype.kind not in kinds):
+            kind = "a number" if program.float_mode else "an integer"
+            raise Exception(f"Variable {name} must be {kind} or a list of them")
+        if array.ndim == 1:
+            if length is not None and array.size != length:
+                raise Exception("Variable lists must have the same length")
+            length = array.size
+        arrays[name] = array.astype(program.dtype)
+    if length is not None and length > max_elements:
+        raise Exception(f"Variable lists are limited to {max_elements} elements")
+    return arrays
+
+
+def evaluate_program(program: VectorProgram, arrays: dict) -> dict:
+    """Runs program and builds `{results, mask}` response data, masked results are None"""
+    values, mask = program.evaluate(arrays)
+    mask = mask.tolist()
+    results = [None if masked else value for value, masked in zip(program.format(values).tolist(), mask)]
+    return {"results": results, "mask": mask}
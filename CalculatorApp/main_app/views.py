@@ -1,42 +1,189 @@
 import re
+import math
+import asyncio
 from django.http import JsonResponse, HttpResponse, HttpResponseNotAllowed, HttpResponseServerError, HttpResponseBadRequest
+from django.conf import settings
+from django.utils.http import parse_etags
+from django.views.decorators.gzip import gzip_page
 
-from .utils import validate_request
-from .runner import CalcManager
+from asgiref.sync import sync_to_async
+
+from .utils import validate_request, validate_session, validate_batch_request, validate_batch_item, validate_vector_request, validate_history_request, get_history_rows, evaluate_expression, evaluation_error
+from .runner import CalcError, CalcQueueFullError, CalcTimeoutError, get_pool
+from .scheduler import INTERACTIVE, BULK, get_scheduler
+from .admission import admit, get_admission, rejection_response, OVERLOADED
+from .cache import get_cache
 from .models import CalculatedResult
 from .serializers import CalculatedResultSerializer
+from .sync import SYNC_GROUP, get_latest_version
+from .fanout import get_hub
+from .leader import get_leader_lock
+from .consumers import SyncConsumer
+from .snapshot import get_snapshot, encode_row
+from .writebehind import get_write_buffer, store_results
+from .retention import get_retention
+from .vector import compile_expression, prepare_variables, evaluate_program
 
 async def healthcheck_view(request):
     if request.method != "GET":
-        return HttpResponseNotAllowed()
+        return HttpResponseNotAllowed(["GET"])
+    retry_after = get_admission().degraded()
+    if retry_after:
+        # load balancers should route around this instance while it sheds
+        return rejection_response(OVERLOADED, math.ceil(retry_after))
     return HttpResponse()
 
+async def stats_view(request):
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    data = {
+        "scheduler": get_scheduler().stats(),
+        "admission": get_admission().stats(),
+        "cache": get_cache().stats(),
+        "fanout": get_hub(SYNC_GROUP).stats(),
+        "sync_leader": get_leader_lock().leader,
+        "websockets": SyncConsumer.stats(),
+        "snapshot": get_snapshot().stats(),
+        "retention": get_retention().stats(),
+        "write_behind": get_write_buffer().stats() if get_write_buffer() is not None else None,
+    }
+    if settings.CALC_BACKEND == "pool":
+        data["pool"] = get_pool().stats()
+    return JsonResponse(data)
+
+@gzip_page
+async def history_view(request):
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    try:
+        after_id, limit, filters = validate_history_request(request)
+    except Exception as e:
+        print(e)
+        return HttpResponseBadRequest(e)
+    # ids are never reused, so the newest one tags every page of the history
+    # until retention deletes rows
+    version, retention = await get_latest_version().get()
+    etag = f'"{version}.{retention}"'
+    if etag in (tag.removeprefix("W/") for tag in parse_etags(request.headers.get("If-None-Match", ""))):
+        response = HttpResponse(status=304)
+    else:
+        # one extra row tells whether another page follows
+        rows = await get_history_rows(after_id, version, limit + 1, filters)
+        more = len(rows) > limit
+        rows = rows[:limit]
+        body = '{"version": %d, "rows": [%s], "next_after_id": %s}' % (
+            version,
+            ", ".join(encode_row(*row) for row in rows),
+            rows[-1][0] if more else "null",
+        )
+        response = HttpResponse(body, content_type="application/json")
+    response["ETag"] = etag
+    # cache, but ask again every time
+    response["Cache-Control"] = "no-cache"
+    return response
+
 async def calculate_view(request):
     if request.method != "POST":
-        return HttpResponseNotAllowed()
+        return HttpResponseNotAllowed(["POST"])
+    if rejection := admit(request, INTERACTIVE):
+        return rejection
     try:
         float_mode, body = await validate_request(request)        
+        session = validate_session(request.GET.get('session', ''))
     except Exception as e:        
         print(e)
         return HttpResponseBadRequest(e)
     # perform calculations
     try:
-        runner = CalcManager(
-            float_mode=float_mode,
-            input_data=body
-        )
-        result = runner.run_app() # got to be async too
+        result = await evaluate_expression(float_mode, body)
         # log result if everything is ok
         body = re.sub(r"\s", "", body)
-        res_obj = await CalculatedResult.objects.acreate(
+        res_obj = CalculatedResult(
             expression=body,
             result=result,
+            float_mode=float_mode,
+            session=session,
             # auto timestamp
         )
-        data = CalculatedResultSerializer(res_obj).data
-        return JsonResponse(data)
+        await store_results([res_obj])
+        return JsonResponse(CalculatedResultSerializer(res_obj).data)
+    except CalcQueueFullError as e:
+        print(e)
+        return HttpResponse("Server is busy", status=503)
+    except CalcTimeoutError as e:
+        print(e)
+        return HttpResponse("Evaluation timed out", status=504)
+    except Exception as e:
+        print(e)
+        return HttpResponseServerError("Runtime error occured")
+
+async def calculate_batch_view(request):
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    try:
+        items = await validate_batch_request(request)
+        session = validate_session(request.GET.get('session', ''))
+    except Exception as e:
+        print(e)
+        return HttpResponseBadRequest(e)
+    if rejection := admit(request, BULK, len(items)):
+        return rejection
+    # keep batch from flooding shared evaluation queue
+    semaphore = asyncio.Semaphore(settings.CALC_BATCH_CONCURRENCY)
+
+    async def evaluate_item(item):
+        try:
+            float_mode, expression = validate_batch_item(item)
+        except Exception as e:
+            return {"error": str(e)}
+        try:
+            async with semaphore:
+                result = await evaluate_expression(float_mode, expression, BULK)
+        except Exception as e:
+            return evaluation_error(e)
+        return CalculatedResult(
+            expression=re.sub(r"\s", "", expression),
+            result=result,
+            float_mode=float_mode,
+            session=session,
+        )
+
+    outcomes = await asyncio.gather(*(evaluate_item(item) for item in items))
+    # one INSERT for the whole batch, ids are filled in by bulk_create
+    rows = [outcome for outcome in outcomes if isinstance(outcome, CalculatedResult)]
+    try:
+        await store_results(rows)
     except Exception as e:
         print(e)
         return HttpResponseServerError("Runtime error occured")
-    
+    data = [
+        CalculatedResultSerializer(outcome).data if isinstance(outcome, CalculatedResult) else outcome
+        for outcome in outcomes
+    ]
+    return JsonResponse(data, safe=False)
 
+async def calculate_vector_view(request):
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    if rejection := admit(request, BULK):
+        return rejection
+    try:
+        float_mode, expression, variables = await validate_vector_request(request)
+        program = compile_expression(expression, float_mode)
+        arrays = prepare_variables(program, variables, settings.CALC_VECTOR_MAX_ELEMENTS)
+    except CalcError as e:
+        return JsonResponse(evaluation_error(e), status=400)
+    except Exception as e:
+        print(e)
+        return HttpResponseBadRequest(e)
+    try:
+        # numpy kernels and formatting are CPU-bound, keep them off the event loop
+        async with get_scheduler().slot(BULK):
+            data = await sync_to_async(evaluate_program, thread_sensitive=False)(program, arrays)
+    except CalcQueueFullError as e:
+        print(e)
+        return HttpResponse("Server is busy", status=503)
+    except Exception as e:
+        print(e)
+        return HttpResponseServerError("Runtime error occured")
+    return JsonResponse(data)
@@ -0,0 +1,276 @@
+import time
+import fcntl
+import atexit
+import asyncio
+from collections import deque
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from main_app.models import CalculatedResult
+from main_app.database import get_database
+from main_app.sync import publish_results
+
+FLUSH_SAMPLES = 1024 # recent flushes kept for percentiles
+
+
+def reserve_ids(count: int) -> tuple:
+    """
+    Moves the AUTOINCREMENT counter of the history table `count` ids ahead,
+    returns (first, last) of the ids skipped, which are the caller's to use:
+    SQLite never hands out ids up to the counter again
+    """
+    table = CalculatedResult._meta.db_table
+    with transaction.atomic(), connections["default"].cursor() as cursor:
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+        row = cursor.fetchone()
+        start = row[0] if row else 0
+        if row:
+            cursor.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = %s", [start + count, table])
+        else:
+            cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, start + count])
+    return (start + 1, start + count)
+
+
+def release_ids(last_used: int, last: int):
+    """Gives back the unused end of a reserved block, unless ids after it were taken since"""
+    with connections["default"].cursor() as cursor:
+        cursor.execute(
+            "UPDATE sqlite_sequence SET seq = %s WHERE name = %s AND seq = %s",
+            [last_used, CalculatedResult._meta.db_table, last],
+        )
+
+
+def insert_rows(rows: list):
+    """
+    Inserts rows as they are in one transaction, rows without ids get the
+    next ones. bulk_create() would overwrite the timestamps callers were
+    already given with auto_now_add
+    """
+    connection = connections["default"]
+    fields = CalculatedResult._meta.concrete_fields
+    quote = connection.ops.quote_name
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        quote(CalculatedResult._meta.db_table),
+        ", ".join(quote(field.column) for field in fields),
+        ", ".join(["%s"] * len(fields)),
+    )
+    with transaction.atomic(), connection.cursor() as cursor:
+        if rows[0].id is None:
+            # the write lock is held from here on, so ids follow commit order
+            first, _ = reserve_ids(len(rows))
+            for offset, row in enumerate(rows):
+                row.id = first + offset
+        cursor.executemany(sql, [
+            [field.get_db_prep_save(getattr(row, field.attname), connection) for field in fields]
+            for row in rows
+        ])
+
+
+class WriteBehindBuffer:
+    """
+    Stores results in batches. save() gives rows their timestamps at once
+    and buffers them; the buffer is written in one transaction when it
+    holds `batch_rows` rows or its oldest row waited `delay` seconds, then
+    the batch is published to sync clients. With `wait` save() returns
+    once the batch holding its rows is committed (group commit), and rows
+    get their ids in that transaction. Otherwise save() returns right away
+    with ids given from a block reserved in advance, rows still buffered
+    are lost if the process dies without shutting down, and as such ids
+    follow commit order only within one process, the buffer holds a lock
+    next to the database which keeps other processes from starting one
+
+    Parameters
+    ----------
+        batch_rows (int): buffered rows starting a flush
+        delay (float): seconds a buffered row waits for a flush at most
+        max_rows (int): buffered rows before save() waits for a flush
+        id_block (int): ids reserved at a time
+        wait (bool): save() returns once its rows are committed
+    """
+    def __init__(self, batch_rows: int, delay: float, max_rows: int, id_block: int, wait: bool):
+        if connections["default"].vendor != "sqlite":
+            raise Exception("Write-behind needs SQLite")
+        self._lock_file = None
+        if not wait:
+            self._lock_file = open(f"{connections['default'].settings_dict['NAME']}-write-behind", "a")
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._lock_file.close()
+                raise Exception("Write-behind without waiting needs a single server process")
+        self.batch_rows = batch_rows
+        self.delay = delay
+        self.max_rows = max_rows
+        self.id_block = id_block
+        self.wait = wait
+        self.rows = []
+        self.max_depth = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.failed_rows = 0
+        self.largest_batch = 0
+        self.id_blocks = 0
+        self.flush_times = deque(maxlen=FLUSH_SAMPLES)
+        self._next_id = 1
+        self._last_id = 0 # end of the reserved block
+        self._oldest = None # when the oldest buffered row came
+        self._full = asyncio.Event()
+        self._done = None # future of the batch being buffered
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    async def save(self, rows: list):
+        """Gives rows timestamps (and ids, without waiting) and buffers them"""
+        if not rows:
+            return
+        while len(self.rows) >= self.max_rows:
+            self._full.set()
+            await asyncio.wait([self._done])
+        async with self._lock:
+            now = timezone.now()
+            for row in rows:
+                row.timestamp = now
+                if self.wait:
+                    continue # ids are given at flush
+                if self._next_id > self._last_id:
+                    self._next_id, self._last_id = await get_database().write(reserve_ids, self.id_block)
+                    self.id_blocks += 1
+                row.id = self._next_id
+                self._next_id += 1
+            if not self.rows:
+                self._oldest = time.monotonic()
+                self._done = asyncio.get_running_loop().create_future()
+            self.rows.extend(rows)
+            self.max_depth = max(self.max_depth, len(self.rows))
+            done = self._done
+        if len(self.rows) >= self.batch_rows:
+            self._full.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._flusher())
+        if self.wait:
+            await done
+
+    async def _flusher(self):
+        try:
+            while self.rows:
+                if len(self.rows) < self.batch_rows:
+                    try:
+                        await asyncio.wait_for(self._full.wait(), self._oldest + self.delay - time.monotonic())
+                    except asyncio.TimeoutError:
+                        pass
+                await self._flush()
+        finally:
+            self._task = None
+
+    async def _flush(self):
+        rows, self.rows = self.rows, []
+        done, self._done = self._done, None
+        self._full.clear()
+        started = time.monotonic()
+        try:
+            await get_database().write(insert_rows, rows)
+        except Exception as e:
+            print(e)
+            self.failed_rows += len(rows)
+            # savers which were answered already can't be told any more
+            if self.wait:
+                done.set_exception(e)
+                # waiting for room in the buffer is not a failure
+                done.exception()
+            else:
+                done.set_result(None)
+            return
+        self.flush_times.append(time.monotonic() - started)
+        self.flushes += 1
+        self.flushed_rows += len(rows)
+        self.largest_batch = max(self.largest_batch, len(rows))
+        done.set_result(None)
+        await publish_results(rows)
+
+    async def close(self):
+        """Writes buffered rows and gives back unused ids, for graceful shutdown"""
+        while self._task is not None:
+            self._full.set()
+            await self._task
+        async with self._lock:
+            if self._next_id <= self._last_id:
+                await get_database().write(release_ids, self._next_id - 1, self._last_id)
+                self._last_id = self._next_id - 1
+
+    def close_at_exit(self):
+        """close() for an interpreter exiting after its event loop stopped"""
+        rows, self.rows = self.rows, []
+        try:
+            if rows:
+                insert_rows(rows)
+            if self._next_id <= self._last_id:
+                release_ids(self._next_id - 1, self._last_id)
+        except Exception as e:
+            print(e)
+            self.failed_rows += len(rows)
+        finally:
+            connections.close_all()
+
+    def stats(self) -> dict:
+        times = sorted(self.flush_times)
+        def percentile(p):
+            return round(times[min(len(times) - 1, int(len(times) * p))] * 1000, 3) if times else 0.0
+        return {
+            "wait": self.wait,
+            "buffered": len(self.rows),
+            "max_buffered": self.max_depth,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "failed_rows": self.failed_rows,
+            "average_batch": round(self.flushed_rows / self.flushes, 1) if self.flushes else 0.0,
+            "largest_batch": self.largest_batch,
+            "flush_p50_ms": percentile(0.5),
+            "flush_p99_ms": percentile(0.99),
+            "id_blocks": self.id_blocks,
+        }
+
+
+_buffer = None
+
+def get_write_buffer():
+    """Returns process-wide write-behind buffer, None if CALC_WRITE_BEHIND is off"""
+    global _buffer
+    if _buffer is None and settings.CALC_WRITE_BEHIND:
+        _buffer = WriteBehindBuffer(
+            settings.CALC_WRITE_BEHIND_ROWS,
+            settings.CALC_WRITE_BEHIND_DELAY,
+            settings.CALC_WRITE_BEHIND_MAX_ROWS,
+            settings.CALC_WRITE_BEHIND_ID_BLOCK,
+            settings.CALC_WRITE_BEHIND_WAIT,
+        )
+        # daphne sends no lifespan events, it only runs atexit handlers
+        atexit.register(_buffer.close_at_exit)
+    return _buffer
+
+
+async def store_results(results: list):
+    """
+    Stores freshly created CalculatedResult objects and publishes them to
+    sync clients, through the write-behind buffer when it is on
+    """
+    buffer = get_write_buffer()
+    if buffer is not None:
+        await buffer.save(results)
+        return
+    await get_database().write(CalculatedResult.objects.bulk_create, results)
+    await publish_results(results)
+
+
+class Lifespan:
+    """ASGI lifespan app, writes out the write-behind buffer on shutdown"""
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if _buffer is not None:
+                    await _buffer.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
@@ -0,0 +1,145 @@
+"""
+Channel layer cost of a sync_group broadcast with and without the fanout hub
+
+Every client either joins the group with its own channel (as consumers did
+before the hub) or subscribes to the process-wide FanoutHub. For each client
+count the script prints Redis commands per broadcast (from INFO commandstats,
+commands run by Lua scripts included), messages the channel layer delivered
+per broadcast and wall time per broadcast.
+
+    REDIS_URL=redis://localhost:6380 python3 benchmarks/bench_fanout.py
+    python3 benchmarks/bench_fanout.py --memory   # no Redis, deliveries only
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "CalculatorApp"))
+
+import django
+from django.conf import settings
+
+GROUP = "bench_group"
+
+
+class Subscriber:
+    """Stands in for a consumer, counts dispatched messages"""
+    def __init__(self, expected: int, done: asyncio.Event, counter: list):
+        self.received = 0
+        self.expected = expected
+        self.done = done
+        self.counter = counter
+
+    async def dispatch(self, message):
+        self.received += 1
+        if self.received == self.expected:
+            self.counter[0] -= 1
+            if not self.counter[0]:
+                self.done.set()
+
+
+async def redis_commands(client) -> int:
+    if client is None:
+        return 0
+    stats = await client.info("commandstats")
+    return sum(entry["calls"] for entry in stats.values())
+
+
+async def bench_direct(layer, clients: int, broadcasts: int):
+    """One group member per client, each reading its own channel"""
+    channels = [await layer.new_channel() for _ in range(clients)]
+    for channel in channels:
+        await layer.group_add(GROUP, channel)
+    done = asyncio.Event()
+    remaining = [clients]
+    deliveries = [0]
+
+    async def read(channel):
+        for _ in range(broadcasts):
+            await layer.receive(channel)
+            deliveries[0] += 1
+        remaining[0] -= 1
+        if not remaining[0]:
+            done.set()
+
+    readers = [asyncio.create_task(read(channel)) for channel in channels]
+    try:
+        yield
+        for i in range(broadcasts):
+            await layer.group_send(GROUP, {"type": "sync.message", "message": str(i)})
+        await done.wait()
+        yield deliveries[0]
+    finally:
+        for reader in readers:
+            reader.cancel()
+        for channel in channels:
+            await layer.group_discard(GROUP, channel)
+
+
+async def bench_hub(layer, clients: int, broadcasts: int):
+    """One group member for the process, clients subscribed to the hub"""
+    from main_app.fanout import FanoutHub
+    hub = FanoutHub(GROUP)
+    done = asyncio.Event()
+    remaining = [clients]
+    subscribers = [Subscriber(broadcasts, done, remaining) for _ in range(clients)]
+    for subscriber in subscribers:
+        await hub.subscribe(subscriber)
+    try:
+        yield
+        for i in range(broadcasts):
+            await layer.group_send(GROUP, {"type": "sync.message", "message": str(i)})
+        await done.wait()
+        yield hub.received
+    finally:
+        for subscriber in subscribers:
+            await hub.unsubscribe(subscriber)
+
+
+async def run(mode, layer, redis, clients: int, broadcasts: int):
+    bench = mode(layer, clients, broadcasts)
+    await bench.__anext__() # set up outside of measurement
+    commands = await redis_commands(redis)
+    started = time.perf_counter()
+    deliveries = await bench.__anext__()
+    elapsed = time.perf_counter() - started
+    # the INFO call itself is counted as well
+    commands = await redis_commands(redis) - commands - 1
+    await bench.aclose()
+    return commands / broadcasts, deliveries / broadcasts, elapsed / broadcasts * 1000
+
+
+async def main(args):
+    from channels.layers import get_channel_layer
+    layer = get_channel_layer()
+    redis = None
+    if not args.memory:
+        import redis.asyncio
+        redis = redis.asyncio.from_url(args.redis)
+    print(f"{'clients':>8} {'mode':>7} {'redis cmds':>11} {'deliveries':>11} {'ms':>8}   (per broadcast)")
+    for clients in args.clients:
+        for name, mode in (("direct", bench_direct), ("hub", bench_hub)):
+            commands, deliveries, ms = await run(mode, layer, redis, clients, args.broadcasts)
+            shown = "-" if redis is None else f"{commands:.1f}"
+            print(f"{clients:>8} {name:>7} {shown:>11} {deliveries:>11.1f} {ms:>8.3f}")
+    if redis is not None:
+        await redis.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--broadcasts", type=int, default=100)
+    parser.add_argument("--redis", default=os.environ.get("REDIS_URL", "redis://localhost:6379"))
+    parser.add_argument("--memory", action="store_true", help="use in-memory channel layer")
+    args = parser.parse_args()
+    if args.memory:
+        backend = {"BACKEND": "channels.layers.InMemoryChannelLayer", "CONFIG": {"capacity": 100000}}
+    else:
+        # default capacity would drop messages of a burst to a slow reader
+        backend = {"BACKEND": "channels_redis.core.RedisChannelLayer", "CONFIG": {"hosts": [args.redis], "capacity": 100000}}
+    settings.configure(CHANNEL_LAYERS={"default": backend})
+    django.setup()
+    asyncio.run(main(args))
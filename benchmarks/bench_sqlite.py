@@ -0,0 +1,181 @@
+"""
+History read and write throughput of SQLite before and after tuning
+
+Runs the same concurrent load against two database files. `baseline` is
+the schema and settings before indexes were added: rollback journal, full
+sync, and a new connection per operation, as ASGI requests get one each.
+`tuned` is the current setup: WAL, NORMAL sync, mmap and page cache set
+by SQLITE_PRAGMAS, indexes, and main_app.database threads keeping their
+connections, with writes on one thread and reads on the read-only
+history alias. Writer clients store rows one per transaction like /calc.
+Reader clients fetch /history pages: the newest version, then 100 rows
+after a random id, half of them filtered by mode. Prints operations per
+second, latency percentiles and failed operations (database is locked).
+
+    python3 benchmarks/bench_sqlite.py
+    python3 benchmarks/bench_sqlite.py --writers 8 --readers 32 --seconds 10
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "CalculatorApp"))
+
+import django
+from django.conf import settings
+
+PAGE_ROWS = 100
+
+
+def insert(alias: str):
+    from main_app.models import CalculatedResult
+    CalculatedResult.objects.using(alias).create(expression="2+2", result="4", float_mode=random.random() < 0.5)
+
+
+def read_page(alias: str):
+    from django.db.models import Max
+    from main_app.models import CalculatedResult
+    rows = CalculatedResult.objects.using(alias)
+    version = rows.aggregate(version=Max("id"))["version"] or 0
+    filters = {"float_mode": True} if random.random() < 0.5 else {}
+    return list(
+        rows.filter(id__gt=random.randint(0, max(0, version - PAGE_ROWS)), id__lte=version, **filters)
+        .order_by("id").values_list("id", "expression", "result", "timestamp")[:PAGE_ROWS]
+    )
+
+
+class Baseline:
+    """Every operation on a thread of its own connection, closed afterwards"""
+    def __init__(self, clients: int):
+        self._executor = ThreadPoolExecutor(clients)
+
+    @staticmethod
+    def _call(func):
+        from django.db import connections
+        try:
+            return func("baseline")
+        finally:
+            connections["baseline"].close()
+
+    async def read(self, func):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, func)
+
+    write = read
+
+
+class Tuned:
+    """Operations through main_app.database threads"""
+    def __init__(self, readers: int):
+        from main_app.database import DatabaseThreads
+        self._threads = DatabaseThreads(readers, "history")
+
+    async def read(self, func):
+        return await self._threads.read(func, "history")
+
+    async def write(self, func):
+        return await self._threads.write(func, "default")
+
+
+def prefill(alias: str, rows: int):
+    from main_app.models import CalculatedResult
+    CalculatedResult.objects.using(alias).bulk_create(
+        CalculatedResult(expression=f"{i}+{i}", result=str(2 * i), float_mode=i % 2 == 0) for i in range(rows)
+    )
+
+
+async def load(setup, writers: int, readers: int, seconds: float):
+    latencies = {"write": [], "read": []}
+    failed = {"write": 0, "read": 0}
+    deadline = time.perf_counter() + seconds
+
+    async def client(kind, run, func):
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                await run(func)
+            except Exception:
+                failed[kind] += 1
+            else:
+                latencies[kind].append(time.perf_counter() - started)
+
+    await asyncio.gather(
+        *(client("write", setup.write, insert) for _ in range(writers)),
+        *(client("read", setup.read, read_page) for _ in range(readers)),
+    )
+    return latencies, failed
+
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] * 1000
+
+
+def main(args):
+    from django.core.management import call_command
+    # the schema before indexes were added
+    call_command("migrate", "main_app", "0002", database="baseline", verbosity=0)
+    call_command("migrate", "main_app", database="default", verbosity=0)
+    prefill("baseline", args.rows)
+    prefill("default", args.rows)
+    print(f"{'setup':>9} {'op':>6} {'ops/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'failed':>7}")
+    for name, setup in (("baseline", Baseline(args.writers + args.readers)), ("tuned", Tuned(args.db_readers))):
+        latencies, failed = asyncio.run(load(setup, args.writers, args.readers, args.seconds))
+        for op in ("write", "read"):
+            done = latencies[op]
+            print(
+                f"{name:>9} {op:>6} {len(done) / args.seconds:>9.0f} "
+                f"{percentile(done, 0.5):>8.2f} {percentile(done, 0.99):>8.2f} {failed[op]:>7}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--writers", type=int, default=4, help="concurrent writing clients")
+    parser.add_argument("--readers", type=int, default=16, help="concurrent reading clients")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--rows", type=int, default=100000, help="rows stored before the load")
+    parser.add_argument("--db-readers", type=int, default=4, help="reader threads of the tuned setup")
+    args = parser.parse_args()
+    from CalculatorApp.settings import SQLITE_PRAGMAS
+    directory = tempfile.mkdtemp(prefix="bench-sqlite-")
+    tuned = os.path.join(directory, "tuned.sqlite3")
+    settings.configure(
+        INSTALLED_APPS=["main_app"],
+        DATABASES={
+            "default": {
+                "ENGINE": "django.db.backends.sqlite3",
+                "NAME": tuned,
+                "CONN_MAX_AGE": None,
+                "OPTIONS": {"init_command": SQLITE_PRAGMAS, "transaction_mode": "IMMEDIATE"},
+            },
+            "history": {
+                "ENGINE": "django.db.backends.sqlite3",
+                "NAME": tuned,
+                "CONN_MAX_AGE": None,
+                "OPTIONS": {"init_command": SQLITE_PRAGMAS + "; PRAGMA query_only=ON"},
+            },
+            "baseline": {
+                "ENGINE": "django.db.backends.sqlite3",
+                "NAME": os.path.join(directory, "baseline.sqlite3"),
+            },
+        },
+        DEFAULT_AUTO_FIELD="django.db.models.BigAutoField",
+        USE_TZ=False,
+        # read by main_app.runner on import, no calculator runs here
+        EXE_PATH="",
+        LIB_PATH="",
+    )
+    django.setup()
+    try:
+        main(args)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,116 @@
+"""
+Bytes and time per history sync in each /ws/sync encoding
+
+Builds a synthetic history in a HistoryView (no database) and encodes it
+as a full snapshot and as deltas of a few rows, the way SyncConsumer
+sends them, in JSON, binary and binary-zlib. JSON compressed by
+permessage-deflate (raw deflate per frame, no context takeover) is shown
+for comparison. Prints bytes, size relative to JSON, server encoding time
+(snapshot chunks are cached, so that is the first client's cost) and
+client decoding time.
+
+    python3 benchmarks/bench_sync_encoding.py
+    python3 benchmarks/bench_sync_encoding.py --rows 100000 --delta-rows 1 10
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import argparse
+import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "CalculatorApp"))
+sys.path.insert(0, ROOT)
+
+import django
+from django.conf import settings
+
+DEFLATE = "json+deflate"
+
+
+def expression(rng: random.Random) -> str:
+    terms = [str(rng.randint(1, 9999)) for _ in range(rng.randint(2, 6))]
+    out = terms[0]
+    for term in terms[1:]:
+        out += rng.choice("+-*/") + term
+    return f"({out})" if rng.random() < 0.3 else out
+
+
+def build_view(rows: int, chunk_rows: int):
+    from main_app.snapshot import HistoryView, encode_row
+    rng = random.Random(1)
+    view = HistoryView(chunk_rows)
+    stamp = datetime.datetime(2026, 1, 1)
+    for id in range(1, rows + 1):
+        stamp += datetime.timedelta(microseconds=rng.randint(1000, 5_000_000))
+        float_mode = rng.random() < 0.5
+        result = f"{rng.uniform(-1e4, 1e4):.4f}" if float_mode else str(rng.randint(-10**6, 10**6))
+        values = (id, expression(rng), result, stamp, float_mode, "")
+        view.ids.append(id)
+        view.rows.append(encode_row(*values[:4]))
+        view.values.append(values)
+    view.version = rows
+    return view
+
+
+def deflate(frame: str) -> bytes:
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(frame.encode("utf-8")) + compressor.flush(zlib.Z_SYNC_FLUSH)[:-4]
+
+
+def measure(frames_of, encoding: str):
+    """Bytes, encoding ms and decoding ms of the frames one sync sends"""
+    from client.controller.codec import decode_frame
+    started = time.perf_counter()
+    frames = [frame for frame, _ in frames_of("json" if encoding == DEFLATE else encoding)]
+    if encoding == DEFLATE:
+        frames = [deflate(frame) for frame in frames]
+    encoded = time.perf_counter() - started
+    started = time.perf_counter()
+    for frame in frames:
+        if encoding == DEFLATE:
+            json.loads(zlib.decompressobj(-zlib.MAX_WBITS).decompress(frame + b"\x00\x00\xff\xff"))
+        elif isinstance(frame, bytes):
+            decode_frame(frame)
+        else:
+            json.loads(frame)
+    decoded = time.perf_counter() - started
+    size = sum(len(frame.encode("utf-8") if isinstance(frame, str) else frame) for frame in frames)
+    return size, encoded * 1000, decoded * 1000
+
+
+def main(args):
+    from main_app.codec import ENCODINGS
+    view = build_view(args.rows, args.chunk_rows)
+    cases = [(f"snapshot {args.rows}", lambda encoding: view.snapshot_frames(encoding))]
+    for rows in args.delta_rows:
+        cases.append((f"delta {rows}", lambda encoding, since=args.rows - rows: view.delta_frames(since, encoding)))
+    print(f"{'sync':>16} {'encoding':>13} {'bytes':>10} {'x smaller':>10} {'encode ms':>10} {'decode ms':>10}")
+    for name, frames_of in cases:
+        json_size = None
+        for encoding in (*ENCODINGS, DEFLATE):
+            # fresh chunk cache, every encoding pays for its first client
+            view.chunks = {}
+            size, encoded, decoded = measure(frames_of, encoding)
+            json_size = json_size or size
+            print(f"{name:>16} {encoding:>13} {size:>10} {json_size / size:>10.1f} {encoded:>10.2f} {decoded:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--delta-rows", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--chunk-rows", type=int, default=500)
+    args = parser.parse_args()
+    settings.configure(
+        INSTALLED_APPS=["main_app"],
+        DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}},
+        # read by main_app.runner on import, no calculator runs here
+        EXE_PATH="",
+        LIB_PATH="",
+    )
+    django.setup()
+    main(args)
@@ -0,0 +1,100 @@
+import zlib
+import datetime
+
+# binary sync frame kinds, low bits of the first byte
+SNAPSHOT = 1
+SNAPSHOT_CHUNK = 2
+SNAPSHOT_END = 3
+DELTA = 4
+KIND_MASK = 0x0f
+PACKED_EXPRESSIONS = 0x10 # expressions are packed two symbols a byte
+PACKED_RESULTS = 0x20 # results are packed two symbols a byte
+MORE = 0x40 # snapshot continues in chunks
+ZLIB = 0x80 # rows are zlib compressed
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# symbols of packed columns in nibble order, as main_app.codec packs them
+EXPRESSION_SYMBOLS = "0123456789+-*/()"
+RESULT_SYMBOLS = "0123456789-.naif"
+HEX_DIGITS = "0123456789abcdef"
+PACKINGS = ((PACKED_EXPRESSIONS, str.maketrans(HEX_DIGITS, EXPRESSION_SYMBOLS)), (PACKED_RESULTS, str.maketrans(HEX_DIGITS, RESULT_SYMBOLS)))
+
+
+class Reader:
+    """Reads varints and bytes from a buffer"""
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def varint(self) -> int:
+        value, shift = 0, 0
+        while True:
+            byte = self.data[self.pos]
+            self.pos += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def take(self, length: int) -> bytes:
+        chunk = self.data[self.pos:self.pos + length]
+        self.pos += length
+        return chunk
+
+
+def decode_rows(data: bytes, base_id: int = 0, flags: int = 0) -> list:
+    """
+    Columnar rows of a binary frame as the dicts JSON frames carry, ids of
+    delta rows count from its from, flags of the first byte tell packed columns
+    """
+    reader = Reader(data)
+    count = reader.varint()
+    ids, previous = [], base_id
+    for _ in range(count):
+        previous += reader.varint()
+        ids.append(previous)
+    timestamps, previous = [], 0
+    for _ in range(count):
+        zigzag = reader.varint()
+        previous += zigzag >> 1 if not zigzag & 1 else ~(zigzag >> 1)
+        timestamps.append((EPOCH + datetime.timedelta(microseconds=previous)).isoformat())
+    columns = []
+    for packed, from_hex in PACKINGS:
+        lengths = [reader.varint() for _ in range(count)]
+        if not flags & packed:
+            columns.append([reader.take(length).decode("utf-8") for length in lengths])
+            continue
+        total = sum(lengths)
+        text = reader.take((total + 1) // 2).hex()[:total].translate(from_hex)
+        values, start = [], 0
+        for length in lengths:
+            values.append(text[start:start + length])
+            start += length
+        columns.append(values)
+    return [
+        {"id": id, "expression": expression, "result": result, "timestamp": timestamp}
+        for id, expression, result, timestamp in zip(ids, columns[0], columns[1], timestamps)
+    ]
+
+
+def decode_frame(data: bytes) -> dict:
+    """Binary sync frame (server's `?encoding=binary` or `binary-zlib`) as the same dict its JSON form gives"""
+    first = data[0]
+    kind = first & KIND_MASK
+    reader = Reader(data)
+    reader.pos = 1
+    if kind == SNAPSHOT:
+        frame = {"type": "snapshot", "version": reader.varint(), "more": bool(first & MORE)}
+    elif kind == SNAPSHOT_CHUNK:
+        frame = {"type": "snapshot.chunk"}
+    elif kind == SNAPSHOT_END:
+        return {"type": "snapshot.end", "version": reader.varint()}
+    elif kind == DELTA:
+        start = reader.varint()
+        frame = {"type": "delta", "from": start, "version": start + reader.varint()}
+    else:
+        raise ValueError(f"Unknown frame kind {kind}")
+    body = data[reader.pos:]
+    frame["rows"] = decode_rows(zlib.decompress(body) if first & ZLIB else body, frame.get("from", 0), first)
+    return frame
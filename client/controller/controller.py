@@ -1,11 +1,12 @@
 import re
+import uuid
 import random
 import logging
 from PySide6.QtWidgets import QApplication
 from PySide6.QtCore import QTimer, QThread, Slot
 from PySide6.QtWidgets import QApplication
 
-from client.controller.networking import WebSocketClient, HTTPSender, HTTPSenderError
+from client.controller.networking import WebSocketClient, HTTPSender, HTTPSenderError, NOT_CONNECTED
 from client.model.manager import DatabaseManager
 
 logger = logging.getLogger()
@@ -48,8 +49,11 @@ class AppFSM:
         
         # networking
         self.pending_request = None
+        self.request_id = 0 # id of last calculation frame sent over WS
+        self.session = uuid.uuid4().hex # tags results of this run on the server
+        self.ws_connected = False
         self.http_sender = HTTPSender("0.0.0.0", 8000)
-        self.ws_client = WebSocketClient("ws://0.0.0.0:8000/ws/sync", self.history_manager)
+        self.ws_client = WebSocketClient("ws://0.0.0.0:8000/ws/sync", self.history_manager, self.session)
         self.sync_thread = QThread()
         self.ws_client.moveToThread(self.sync_thread)
         self.sync_thread.started.connect(self.ws_client.connect_to_server) # init WS connection
@@ -57,6 +61,7 @@ class AppFSM:
 
         self.ws_client.connected.connect(self._on_connect)
         self.ws_client.disconnected.connect(self._on_disconnect)
+        self.ws_client.calc_result.connect(self._on_calc_result)
 
         self.sync_thread.start()
         
@@ -65,13 +70,19 @@ class AppFSM:
     
     @Slot()
     def _on_connect(self):
+        self.ws_connected = True
         if self.pending_request is None:
             self.transition_to_input_wait()
         self.window.connection_success.emit()
         
     @Slot()
     def _on_disconnect(self):
+        self.ws_connected = False
         self.transition_to_response_wait()
+        if self.pending_request is not None and "id" in self.pending_request:
+            # reply to WS frame is lost with the socket, go over HTTP instead
+            self.pending_request.pop("id")
+            self._send_request()
         if(self.is_server_reachable):
             self.window.set_server_status("Connection failed.", "red") 
 
@@ -122,10 +133,41 @@ class AppFSM:
             float_mode = self.window.float_mode_checkbox.isChecked()
             float_param = "true" if float_mode else "false"
             self.pending_request = {
-                "url":f"/calc?float={float_param}",
+                "url":f"/calc?float={float_param}&session={self.session}",
                 "expression": expression,
+                "float": float_mode,
             }
+            if self.ws_connected:
+                self._send_ws_request()
+            else:
+                self._send_request()
+
+    def _send_ws_request(self):
+        """Sends pending request as a calculation frame over existing WS connection"""
+        self.request_id += 1
+        self.pending_request["id"] = self.request_id
+        self.ws_client.calc_requested.emit({
+            "id": self.request_id,
+            "expression": self.pending_request.get("expression"),
+            "float": self.pending_request.get("float"),
+        })
+
+    @Slot(dict)
+    def _on_calc_result(self, reply):
+        if self.pending_request is None or reply.get("id") != self.pending_request.get("id"):
+            logger.warning(f"FSM: Dropping reply to stale request {reply.get('id')}")
+            return
+        if reply.get("error") == NOT_CONNECTED:
+            self.pending_request.pop("id")
             self._send_request()
+            return
+        self.pending_request = None
+        if "result" in reply:
+            self._add_calculation_entry(reply["result"])
+            self.window.show_feedback("Success", "lime")
+        else:
+            self.window.show_feedback(f"Error: {reply.get('error')}", "red")
+        QTimer.singleShot(self.window.cooldown, self.transition_to_input_wait)
 
     def _send_request(self):
         try:
@@ -1,31 +1,43 @@
 import json
 import logging
 import http.client
-from PySide6.QtCore import QTimer, Signal, Slot, QUrl, QObject
+from PySide6.QtCore import QTimer, Signal, Slot, QUrl, QObject, QByteArray
 from PySide6.QtWebSockets import QWebSocket
 from PySide6.QtNetwork import QAbstractSocket
 
+from client.controller.codec import decode_frame
+
 logger = logging.getLogger()
 
+# error of a calculation reply produced locally when socket is down
+NOT_CONNECTED = "Not connected"
+
 
 class WebSocketClient(QObject):
     connected = Signal()
     disconnected = Signal()
     error_occurred = Signal(str)
+    calc_requested = Signal(dict) # emitted from other threads, handled on socket's thread
+    calc_result = Signal(dict)
     
-    def __init__(self, url, db_manager):
+    def __init__(self, url, db_manager, session=""):
         super().__init__()
         self.is_active = False
         self.reconnect_interval = 5000 # ms   
         self.db_manager = db_manager
+        self.session = session # tags calculation frames sent on the socket
+        self.encoding = "binary-zlib" # history frames come binary, see codec.decode_frame()
         self.url = QUrl(url)   
         self.reconnect_timer = QTimer(self)
         self.reconnect_timer.timeout.connect(self.connect_to_server)    
+        self.calc_requested.connect(self._send_calculation)
+        self.db_manager.resync_needed.connect(self._request_resync)
 
     def _connect_signals(self):        
         self.ws.connected.connect(self._on_connected)
         self.ws.disconnected.connect(self._on_disconnected)
         self.ws.textMessageReceived.connect(self._on_message_received)
+        self.ws.binaryMessageReceived.connect(self._on_binary_message_received)
         self.ws.errorOccurred.connect(self._on_error)
 
     def connect_to_server(self):
@@ -33,7 +45,13 @@ class WebSocketClient(QObject):
         self.ws = QWebSocket(parent=self)  
         self._connect_signals()
         self.is_active = True
-        self.ws.open(self.url)
+        # ask only for rows local history doesn't have yet, and only for the newest ones
+        url = QUrl(self.url)
+        url.setQuery(
+            f"since={self.db_manager.synced_version}&last={self.db_manager.history_rows}"
+            f"&session={self.session}&encoding={self.encoding}&expire=true"
+        )
+        self.ws.open(url)
     
 
     def close(self):
@@ -73,10 +91,42 @@ class WebSocketClient(QObject):
         try:
             data = json.loads(message)
             if isinstance(data, list):
+                # server without versioned sync
                 self.db_manager.enqueue_operation('sync', data)
+            elif isinstance(data, dict) and data.get("type") == "ping":
+                self.ws.sendTextMessage(json.dumps({"type": "pong"}))
+            elif isinstance(data, dict) and data.get("type") in ("snapshot", "snapshot.chunk", "snapshot.end", "delta", "heartbeat", "expire"):
+                self.db_manager.enqueue_operation(data["type"], data)
+            elif isinstance(data, dict) and "id" in data:
+                # reply to a calculation frame
+                self.calc_result.emit(data)
         except json.JSONDecodeError as e:
             self.error_occurred.emit(f"Invalid JSON: {str(e)}")
 
+    @Slot(QByteArray)
+    def _on_binary_message_received(self, message):
+        """Process binary history frames"""
+        logger.debug("WS: Received binary message")
+        try:
+            data = decode_frame(message.data())
+            self.db_manager.enqueue_operation(data["type"], data)
+        except Exception as e:
+            self.error_occurred.emit(f"Invalid binary frame: {str(e)}")
+
+    @Slot(dict)
+    def _send_calculation(self, frame):
+        """Send `{id, expression, float}` calculation frame"""
+        if self.ws.state() != QAbstractSocket.ConnectedState:
+            self.calc_result.emit({"id": frame["id"], "error": NOT_CONNECTED})
+            return
+        self.ws.sendTextMessage(json.dumps(frame))
+
+    @Slot(int)
+    def _request_resync(self, since):
+        """Ask server for rows after since, local history has a gap"""
+        if self.ws.state() == QAbstractSocket.ConnectedState:
+            self.ws.sendTextMessage(json.dumps({"type": "resync", "since": since}))
+
     @Slot(str)
     def _on_error(self, error):
         """Handle WebSocket errors"""
@@ -9,10 +9,13 @@ class DatabaseManager(QObject):
     """SQLite3 manager class. Runs in separate thread and uses Queue and Mutex to ensure thread-safe operations"""
     update_trigger = Signal(list)  # signal to notify model of changes
     operation_available = Signal(str, dict) # signal for queue operations
+    resync_needed = Signal(int) # local history misses server rows after given version
 
-    def __init__(self):
+    def __init__(self, history_rows=200):
         super().__init__()
         self.running = True
+        self.synced_version = 0 # server history version local table is synced to
+        self.history_rows = history_rows # newest server rows kept locally
         self.operation_available.connect(self.process_request)
     
     def setup_database(self):
@@ -25,7 +28,14 @@ class DatabaseManager(QObject):
                 result TEXT,
                 timestamp DATETIME
             )''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS sync_state (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            )''')
         self.conn.commit()
+        row = self.conn.execute("SELECT value FROM sync_state WHERE key = 'version'").fetchone()
+        self.synced_version = row[0] if row else 0
         # initial UI
         self._emit_all_data()
 
@@ -38,6 +48,18 @@ class DatabaseManager(QObject):
                 self._local_insert(data)
             elif op_type == 'sync':
                 self._sync_data(data)
+            elif op_type == 'snapshot':
+                self._apply_snapshot(data)
+            elif op_type == 'snapshot.chunk':
+                self._apply_snapshot_chunk(data)
+            elif op_type == 'snapshot.end':
+                self._finish_snapshot(data)
+            elif op_type == 'delta':
+                self._apply_delta(data)
+            elif op_type == 'heartbeat':
+                self._check_heartbeat(data)
+            elif op_type == 'expire':
+                self._apply_expire(data)
             logger.debug(f"DB: Executed {op_type}")
         except Exception as e:
             logger.error(f"DB: Operation failed: {e}")
@@ -88,6 +110,80 @@ class DatabaseManager(QObject):
         self.conn.commit()
         self._emit_all_data()
     
+    def _upsert_rows(self, cursor, rows):
+        cursor.executemany('''
+            INSERT INTO history (id, expression, result, timestamp)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                expression = excluded.expression,
+                result = excluded.result,
+                timestamp = excluded.timestamp
+        ''', [(row['id'], row['expression'], row['result'], row['timestamp']) for row in rows])
+        # server sends only the newest rows, drop older ones as new ones come
+        cursor.execute('''
+            DELETE FROM history WHERE id NOT IN (
+                SELECT id FROM history ORDER BY id DESC LIMIT ?
+            )''', (self.history_rows,))
+
+    def _set_synced_version(self, cursor, version):
+        self.synced_version = version
+        cursor.execute('''
+            INSERT INTO sync_state (key, value) VALUES ('version', ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        ''', (version,))
+
+    def _apply_snapshot(self, snapshot):
+        """Replace history up to snapshot version with its rows, more may follow in chunks"""
+        cursor = self.conn.cursor()
+        # rows newer than snapshot came from own requests, keep them
+        cursor.execute('DELETE FROM history WHERE id <= ?', (snapshot['version'],))
+        self._upsert_rows(cursor, snapshot['rows'])
+        # an unfinished snapshot can't be continued after reconnect
+        self._set_synced_version(cursor, 0 if snapshot.get('more') else snapshot['version'])
+        self.conn.commit()
+        self._emit_all_data()
+
+    def _apply_snapshot_chunk(self, chunk):
+        """Add rows of a snapshot as they arrive"""
+        cursor = self.conn.cursor()
+        self._upsert_rows(cursor, chunk['rows'])
+        self.conn.commit()
+        self._emit_all_data()
+
+    def _finish_snapshot(self, end):
+        cursor = self.conn.cursor()
+        self._set_synced_version(cursor, end['version'])
+        self.conn.commit()
+
+    def _apply_delta(self, delta):
+        """Add rows of a delta which continues local version"""
+        if delta['from'] > self.synced_version:
+            logger.warning(f"DB: Sync gap between {self.synced_version} and {delta['from']}")
+            self.resync_needed.emit(self.synced_version)
+            return
+        if delta['version'] <= self.synced_version:
+            return
+        cursor = self.conn.cursor()
+        self._upsert_rows(cursor, delta['rows'])
+        self._set_synced_version(cursor, delta['version'])
+        self.conn.commit()
+        self._emit_all_data()
+
+    def _apply_expire(self, expire):
+        """Drop rows server retention deleted: all up to `until` but those in `keep`"""
+        cursor = self.conn.cursor()
+        keep = set(expire['keep'])
+        rows = cursor.execute('SELECT id FROM history WHERE id <= ?', (expire['until'],)).fetchall()
+        cursor.executemany('DELETE FROM history WHERE id = ?', [row for row in rows if row[0] not in keep])
+        self.conn.commit()
+        self._emit_all_data()
+
+    def _check_heartbeat(self, heartbeat):
+        """Request missed rows if server is ahead of local version"""
+        if heartbeat['version'] > self.synced_version:
+            logger.warning(f"DB: Behind server version {heartbeat['version']}")
+            self.resync_needed.emit(self.synced_version)
+
     def _emit_all_data(self):
         """Uses signal mechanism to emit current db state"""
         cursor = self.conn.execute('''
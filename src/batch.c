@@ -0,0 +1,133 @@
+#define _POSIX_C_SOURCE 200809L
+
+#include "batch.h"
+#include <errno.h>
+#include <fcntl.h>
+#include <pthread.h>
+#include <stdatomic.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+// lines taken by a worker thread at once
+#define BATCH_BLOCK 1024
+
+typedef struct {
+    CalcStatus status;
+    NumberType value;
+} LineResult;
+
+typedef struct {
+    const char* data;
+    const size_t* line_starts; // line i spans [line_starts[i], line_starts[i + 1] - 1)
+    size_t lines;
+    Mode mode;
+    LineResult* results;
+    atomic_size_t next_line;
+} BatchJob;
+
+static void* batch_worker(void* arg)
+{
+    BatchJob* job = arg;
+    size_t first;
+
+    while ((first = atomic_fetch_add(&job->next_line, BATCH_BLOCK)) < job->lines) {
+        size_t last = first + BATCH_BLOCK < job->lines ? first + BATCH_BLOCK : job->lines;
+        for (size_t i = first; i < last; ++i) {
+            // every line is followed by '\n' or by end of file
+            size_t start = job->line_starts[i];
+            size_t len = job->line_starts[i + 1] - start - 1;
+            CalcStream stream;
+            calc_stream_init(&stream, job->mode);
+            calc_stream_feed(&stream, job->data + start, len);
+            job->results[i].status = calc_stream_finish(&stream, &job->results[i].value);
+            calc_stream_free(&stream);
+        }
+    }
+    return NULL;
+}
+
+// returns number of lines and their starts, a missing final newline is implied
+static size_t index_lines(const char* data, size_t size, size_t** line_starts)
+{
+    size_t lines = 0;
+    for (const char* p = data; p < data + size && (p = memchr(p, '\n', data + size - p)); ++p) {
+        ++lines;
+    }
+    if (size > 0 && data[size - 1] != '\n') ++lines;
+
+    *line_starts = malloc((lines + 1) * sizeof(size_t));
+    if (!*line_starts) return 0;
+
+    size_t line = 0;
+    (*line_starts)[0] = 0;
+    for (size_t i = 0; i < size; ++i) {
+        if (data[i] == '\n') (*line_starts)[++line] = i + 1;
+    }
+    (*line_starts)[lines] = size + (size > 0 && data[size - 1] != '\n');
+    return lines;
+}
+
+int run_batch(const char* input_path, FILE* output, Mode mode, int threads)
+{
+    int fd = open(input_path, O_RDONLY);
+    if (fd < 0) return errno;
+
+    struct stat st;
+    if (fstat(fd, &st) != 0) {
+        int err = errno;
+        close(fd);
+        return err;
+    }
+
+    size_t size = st.st_size;
+    const char* data = NULL;
+    if (size > 0) {
+        data = mmap(NULL, size, PROT_READ, MAP_PRIVATE, fd, 0);
+        if (data == MAP_FAILED) {
+            int err = errno;
+            close(fd);
+            return err;
+        }
+        posix_madvise((void*)data, size, POSIX_MADV_SEQUENTIAL);
+    }
+    close(fd);
+
+    size_t* line_starts = NULL;
+    size_t lines = index_lines(data, size, &line_starts);
+    LineResult* results = line_starts ? malloc((lines ? lines : 1) * sizeof(LineResult)) : NULL;
+    if (!results) {
+        free(line_starts);
+        if (data) munmap((void*)data, size);
+        return ENOMEM;
+    }
+
+    BatchJob job = {data, line_starts, lines, mode, results, 0};
+    if (threads < 1) threads = 1;
+    pthread_t* workers = malloc(threads * sizeof(pthread_t));
+    int started = 0;
+    while (workers && started < threads && pthread_create(&workers[started], NULL, batch_worker, &job) == 0) {
+        ++started;
+    }
+    // current thread takes part too, also covers failed thread creation
+    batch_worker(&job);
+    for (int i = 0; i < started; ++i) {
+        pthread_join(workers[i], NULL);
+    }
+    free(workers);
+
+    char formatted[MAX_RESULT_SIZE];
+    for (size_t i = 0; i < lines; ++i) {
+        if (results[i].status == CALC_OK) {
+            calc_format_result(mode, results[i].value, formatted, sizeof(formatted));
+            fprintf(output, "OK %s\n", formatted);
+        } else {
+            fprintf(output, "ERR %d\n", results[i].status);
+        }
+    }
+
+    free(results);
+    free(line_starts);
+    if (data) munmap((void*)data, size);
+    return fflush(output) == 0 ? 0 : errno;
+}
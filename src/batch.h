@@ -0,0 +1,11 @@
+#ifndef BATCH_H
+#define BATCH_H
+
+#include "calculator.h"
+
+// evaluates every line of input_path (memory-mapped) on `threads` threads and
+// writes "OK <result>" or "ERR <exit code>" per line to output in input order
+// returns 0 on success or errno-like non-zero value if files could not be used
+int run_batch(const char* input_path, FILE* output, Mode mode, int threads);
+
+#endif
@@ -1,27 +1,24 @@
 #include "calculator.h"
 
-static int global_pos = 0;
-static Mode currentMode = INT_MODE;
+// context behind the legacy global API
+static CalcContext global_ctx = {0, INT_MODE, CALC_OK};
 
-int set_global_pos(int new_pos)
+void calc_init(CalcContext* ctx, Mode mode)
 {
-    global_pos = new_pos;
-    return global_pos;
+    ctx->pos = 0;
+    ctx->mode = mode;
+    ctx->error = CALC_OK;
 }
 
-int get_global_pos() { return global_pos; }
-
-Mode set_mode(Mode new_mode)
+// remembers first error only, later ones are consequences of it
+static void calc_fail(CalcContext* ctx, CalcStatus code)
 {
-    currentMode = new_mode;
-    return currentMode;
+    if (ctx->error == CALC_OK) ctx->error = code;
 }
 
-Mode get_mode() { return currentMode; }
-
-int is_valid_char(char c) { return isdigit(c) || strchr("()*+-/", c) || isspace(c); }
+int is_valid_char(char c) { return isdigit((unsigned char)c) || strchr("()*+-/", c) || isspace((unsigned char)c); }
 
-void validate_and_strip_input(char* buffer)
+CalcStatus calc_validate_and_strip(CalcContext* ctx, char* buffer)
 {
     char* old = buffer; // iterator, goes all way through buffer
     char* new = buffer; // iterator, copies non-whitespaces in buffer
@@ -33,17 +30,21 @@ void validate_and_strip_input(char* buffer)
     int prev_char_was_close_paren = 0; // Track if the previous character was a closing parenthesis
 
     for (; *old != 0; ++old) {
-        if (!is_valid_char(*old)) exit(3);
+        if (!is_valid_char(*old)) {
+            calc_fail(ctx, CALC_ERR_INVALID_INPUT);
+            return ctx->error;
+        }
 
-        if (isspace(*old)) {
+        if (isspace((unsigned char)*old)) {
             space_count++;
             continue;
         }
 
-        if (isdigit(*old)) {
+        if (isdigit((unsigned char)*old)) {
             if (prev_char_was_digit && space_count > 0) {
                 // Two numbers separated by spaces without an operator
-                exit(3);
+                calc_fail(ctx, CALC_ERR_INVALID_INPUT);
+                return ctx->error;
             }
             prev_char_was_digit = 1;
         } else {
@@ -55,7 +56,8 @@ void validate_and_strip_input(char* buffer)
         if (strchr("+-*/", *old)) {
             // Check for invalid unary operators
             if ((prev_char_was_operator || prev_char_was_open_paren || new == buffer) && !prev_char_was_close_paren) {
-                exit(3);
+                calc_fail(ctx, CALC_ERR_INVALID_INPUT);
+                return ctx->error;
             }
             prev_char_was_operator = 1;
         } else {
@@ -80,32 +82,37 @@ void validate_and_strip_input(char* buffer)
     }
     *new = 0; // add \0
 
-    if (parenthesis != 0) exit(4);
-    if (prev_char_was_operator) exit(3);
+    if (parenthesis != 0) calc_fail(ctx, CALC_ERR_PARENTHESIS);
+    if (prev_char_was_operator) calc_fail(ctx, CALC_ERR_INVALID_INPUT);
+    return ctx->error;
 }
 
 // retrieves either next number or result of calculated expression in parenthesis
-NumberType get_operand(char* buffer)
+NumberType calc_get_operand(CalcContext* ctx, const char* buffer)
 {
     NumberType num;
+    num.intValue = 0;
     // if parenthesis met, calculate sub-expression and return its value
-    if (buffer[global_pos] == ')') exit(4);
-    if (buffer[global_pos] == '(') {
-        global_pos++;
-        num = calculate_expression(buffer);
-        global_pos++;
+    if (buffer[ctx->pos] == ')') {
+        calc_fail(ctx, CALC_ERR_PARENTHESIS);
+        return num;
+    }
+    if (buffer[ctx->pos] == '(') {
+        ctx->pos++;
+        num = calc_expression(ctx, buffer);
+        ctx->pos++;
         return num;
     }
     // construct a number if no parenthesis met
-    if (currentMode == INT_MODE) {
+    if (ctx->mode == INT_MODE) {
         num.intValue = 0;
-        while (isdigit(buffer[global_pos])) {
-            num.intValue = num.intValue * 10 + (buffer[global_pos++] - '0');
+        while (isdigit((unsigned char)buffer[ctx->pos])) {
+            num.intValue = num.intValue * 10 + (buffer[ctx->pos++] - '0');
         }
     } else { // FLOAT_MODE
         num.floatValue = 0.0;
-        while (isdigit(buffer[global_pos])) {
-            num.floatValue = num.floatValue * 10 + (buffer[global_pos++] - '0');
+        while (isdigit((unsigned char)buffer[ctx->pos])) {
+            num.floatValue = num.floatValue * 10 + (buffer[ctx->pos++] - '0');
         }
     }
 
@@ -113,28 +120,35 @@ NumberType get_operand(char* buffer)
 }
 
 // returns product of subsequent multiplications(divisions)
-NumberType get_product(char* buffer)
+NumberType calc_get_product(CalcContext* ctx, const char* buffer)
 {
     // get first operand considering parenthesis
-    NumberType res = get_operand(buffer);
+    NumberType res = calc_get_operand(ctx, buffer);
     // multiply while there are multiplication symbols
-    while (buffer[global_pos] == '*' || buffer[global_pos] == '/') {
-        char operation = buffer[global_pos];
-        ++global_pos;
-        NumberType x = get_operand(buffer);
+    while (ctx->error == CALC_OK && (buffer[ctx->pos] == '*' || buffer[ctx->pos] == '/')) {
+        char operation = buffer[ctx->pos];
+        ++ctx->pos;
+        NumberType x = calc_get_operand(ctx, buffer);
+        if (ctx->error != CALC_OK) break;
 
         if (operation == '*') {
-            if (currentMode == INT_MODE) {
+            if (ctx->mode == INT_MODE) {
                 res.intValue *= x.intValue;
             } else {
                 res.floatValue *= x.floatValue;
             }
         } else {
-            if (currentMode == INT_MODE) {
-                if (x.intValue == 0) exit(1);
+            if (ctx->mode == INT_MODE) {
+                if (x.intValue == 0) {
+                    calc_fail(ctx, CALC_ERR_INT_DIV_BY_ZERO);
+                    break;
+                }
                 res.intValue /= x.intValue;
             } else {
-                if (fabs(x.floatValue) < FLOAT_PRECISION) exit(2);
+                if (fabs(x.floatValue) < FLOAT_PRECISION) {
+                    calc_fail(ctx, CALC_ERR_FLOAT_DIV_BY_ZERO);
+                    break;
+                }
                 res.floatValue /= x.floatValue;
             }
         }
@@ -142,24 +156,25 @@ NumberType get_product(char* buffer)
     return res;
 }
 
-NumberType calculate_expression(char* buffer)
+NumberType calc_expression(CalcContext* ctx, const char* buffer)
 {
     // get first operand considering multiplication
-    NumberType res = get_product(buffer);
+    NumberType res = calc_get_product(ctx, buffer);
     // sum two values while there are sum symbols
-    while (buffer[global_pos] == '+' || buffer[global_pos] == '-') {
-        char operation = buffer[global_pos];
-        ++global_pos;
-        NumberType x = get_product(buffer);
+    while (ctx->error == CALC_OK && (buffer[ctx->pos] == '+' || buffer[ctx->pos] == '-')) {
+        char operation = buffer[ctx->pos];
+        ++ctx->pos;
+        NumberType x = calc_get_product(ctx, buffer);
+        if (ctx->error != CALC_OK) break;
 
         if (operation == '+') {
-            if (currentMode == INT_MODE) {
+            if (ctx->mode == INT_MODE) {
                 res.intValue += x.intValue;
             } else {
                 res.floatValue += x.floatValue;
             }
         } else {
-            if (currentMode == INT_MODE) {
+            if (ctx->mode == INT_MODE) {
                 res.intValue -= x.intValue;
             } else {
                 res.floatValue -= x.floatValue;
@@ -168,4 +183,306 @@ NumberType calculate_expression(char* buffer)
     }
 
     return res;
-}
\ No newline at end of file
+}
+
+// Streaming evaluator
+
+// applies binary operation, reports division by zero to ctx
+static NumberType apply_operation(CalcContext* ctx, NumberType left, char operation, NumberType right)
+{
+    if (ctx->mode == INT_MODE) {
+        switch (operation) {
+            case '+': left.intValue += right.intValue; break;
+            case '-': left.intValue -= right.intValue; break;
+            case '*': left.intValue *= right.intValue; break;
+            case '/':
+                if (right.intValue == 0) {
+                    calc_fail(ctx, CALC_ERR_INT_DIV_BY_ZERO);
+                } else if (right.intValue == -1) {
+                    // LONG_MIN / -1 traps, negation wraps instead
+                    left.intValue = (long)(0UL - (unsigned long)left.intValue);
+                } else {
+                    left.intValue /= right.intValue;
+                }
+                break;
+        }
+    } else {
+        switch (operation) {
+            case '+': left.floatValue += right.floatValue; break;
+            case '-': left.floatValue -= right.floatValue; break;
+            case '*': left.floatValue *= right.floatValue; break;
+            case '/':
+                if (fabs(right.floatValue) < FLOAT_PRECISION) {
+                    calc_fail(ctx, CALC_ERR_FLOAT_DIV_BY_ZERO);
+                } else {
+                    left.floatValue /= right.floatValue;
+                }
+                break;
+        }
+    }
+    return left;
+}
+
+static void frame_init(CalcFrame* frame)
+{
+    frame->sum.intValue = 0;
+    frame->product.intValue = 0;
+    frame->has_sum = 0;
+    frame->has_product = 0;
+    frame->sum_op = '+';
+    frame->product_op = '*';
+}
+
+// completed operand (number or parenthesis) joins current product
+static void frame_push_operand(CalcContext* ctx, CalcFrame* frame, NumberType value)
+{
+    if (!frame->has_product) {
+        frame->product = value;
+        frame->has_product = 1;
+    } else if (ctx->error == CALC_OK) {
+        frame->product = apply_operation(ctx, frame->product, frame->product_op, value);
+    }
+}
+
+// folds current product into sum, first product is taken as is
+static void frame_fold_product(CalcContext* ctx, CalcFrame* frame)
+{
+    if (!frame->has_sum) {
+        frame->sum = frame->product;
+        frame->has_sum = 1;
+    } else if (ctx->error == CALC_OK) {
+        frame->sum = apply_operation(ctx, frame->sum, frame->sum_op, frame->product);
+    }
+    frame->has_product = 0;
+}
+
+static void stream_finish_number(CalcStream* stream)
+{
+    if (stream->prev == TOKEN_NUMBER) {
+        frame_push_operand(&stream->ctx, &stream->frames[stream->depth], stream->number);
+    }
+}
+
+static CalcStatus stream_syntax_error(CalcStream* stream, CalcStatus code)
+{
+    stream->syntax_error = code;
+    return code;
+}
+
+void calc_stream_init(CalcStream* stream, Mode mode)
+{
+    calc_init(&stream->ctx, mode);
+    stream->syntax_error = CALC_OK;
+    stream->unbalanced = 0;
+    stream->prev = TOKEN_START;
+    stream->space_after_number = 0;
+    stream->number.intValue = 0;
+    stream->depth = 0;
+    stream->capacity = 16;
+    stream->frames = malloc(stream->capacity * sizeof(CalcFrame));
+    if (!stream->frames) {
+        stream->capacity = 0;
+        stream->syntax_error = CALC_ERR_NO_MEMORY;
+        return;
+    }
+    frame_init(&stream->frames[0]);
+}
+
+// Error priority follows the former two-pass evaluator: invalid symbols
+// win over everything, unbalanced parenthesis and trailing operator are
+// reported at the end, evaluation errors only when input is well-formed
+CalcStatus calc_stream_feed(CalcStream* stream, const char* data, size_t len)
+{
+    CalcContext* ctx = &stream->ctx;
+
+    for (size_t i = 0; i < len && stream->syntax_error == CALC_OK; ++i) {
+        char c = data[i];
+
+        if (!is_valid_char(c) || c == 0) return stream_syntax_error(stream, CALC_ERR_INVALID_INPUT);
+
+        if (isspace((unsigned char)c)) {
+            if (stream->prev == TOKEN_NUMBER) stream->space_after_number = 1;
+            continue;
+        }
+
+        if (isdigit((unsigned char)c)) {
+            if (stream->prev == TOKEN_NUMBER) {
+                // Two numbers separated by spaces without an operator
+                if (stream->space_after_number) return stream_syntax_error(stream, CALC_ERR_INVALID_INPUT);
+            } else {
+                // number right after closing parenthesis is implicit multiplication
+                if (stream->prev == TOKEN_CLOSE) calc_fail(ctx, CALC_ERR_INVALID_INPUT);
+                stream->number.intValue = 0;
+                if (ctx->mode == FLOAT_MODE) stream->number.floatValue = 0.0;
+            }
+            if (ctx->mode == INT_MODE) {
+                stream->number.intValue = stream->number.intValue * 10 + (c - '0');
+            } else {
+                stream->number.floatValue = stream->number.floatValue * 10 + (c - '0');
+            }
+            stream->prev = TOKEN_NUMBER;
+            stream->space_after_number = 0;
+            continue;
+        }
+
+        stream_finish_number(stream);
+        stream->space_after_number = 0;
+        if (stream->unbalanced) {
+            // structure is broken already, only look for invalid symbols and operators
+            if (strchr("+-*/", c)) {
+                if (stream->prev == TOKEN_OPERATOR || stream->prev == TOKEN_OPEN) {
+                    return stream_syntax_error(stream, CALC_ERR_INVALID_INPUT);
+                }
+                stream->prev = TOKEN_OPERATOR;
+            } else {
+                stream->prev = c == '(' ? TOKEN_OPEN : TOKEN_CLOSE;
+            }
+            continue;
+        }
+
+        CalcFrame* frame = &stream->frames[stream->depth];
+        if (strchr("+-*/", c)) {
+            // Check for invalid unary operators
+            if (stream->prev == TOKEN_START || stream->prev == TOKEN_OPERATOR || stream->prev == TOKEN_OPEN) {
+                return stream_syntax_error(stream, CALC_ERR_INVALID_INPUT);
+            }
+            if (c == '+' || c == '-') {
+                frame_fold_product(ctx, frame);
+                frame->sum_op = c;
+            } else {
+                frame->product_op = c;
+            }
+            stream->prev = TOKEN_OPERATOR;
+        } else if (c == '(') {
+            // implicit multiplication is not supported
+            if (stream->prev == TOKEN_NUMBER || stream->prev == TOKEN_CLOSE) calc_fail(ctx, CALC_ERR_INVALID_INPUT);
+            if (stream->depth + 1 == stream->capacity) {
+                CalcFrame* frames = realloc(stream->frames, 2 * stream->capacity * sizeof(CalcFrame));
+                if (!frames) return stream_syntax_error(stream, CALC_ERR_NO_MEMORY);
+                stream->frames = frames;
+                stream->capacity *= 2;
+            }
+            frame_init(&stream->frames[++stream->depth]);
+            stream->prev = TOKEN_OPEN;
+        } else { // ')'
+            if (stream->depth == 0) {
+                stream->unbalanced = 1;
+            } else {
+                // empty parenthesis or operator right before ')'
+                if (stream->prev != TOKEN_NUMBER && stream->prev != TOKEN_CLOSE) calc_fail(ctx, CALC_ERR_PARENTHESIS);
+                frame_fold_product(ctx, frame);
+                --stream->depth;
+                frame_push_operand(ctx, &stream->frames[stream->depth], frame->sum);
+            }
+            stream->prev = TOKEN_CLOSE;
+        }
+    }
+    return stream->syntax_error;
+}
+
+CalcStatus calc_stream_finish(CalcStream* stream, NumberType* result)
+{
+    if (stream->syntax_error != CALC_OK) return stream->syntax_error;
+    if (stream->unbalanced || stream->depth != 0) return CALC_ERR_PARENTHESIS;
+    if (stream->prev == TOKEN_OPERATOR) return CALC_ERR_INVALID_INPUT;
+
+    stream_finish_number(stream);
+    stream->prev = TOKEN_CLOSE;
+    if (stream->ctx.error != CALC_OK) return stream->ctx.error;
+
+    CalcFrame* frame = &stream->frames[0];
+    if (!frame->has_product) {
+        // empty expression evaluates to zero
+        result->intValue = 0;
+        if (stream->ctx.mode == FLOAT_MODE) result->floatValue = 0.0;
+        return CALC_OK;
+    }
+    frame_fold_product(&stream->ctx, frame);
+    *result = frame->sum;
+    return CALC_OK;
+}
+
+void calc_stream_free(CalcStream* stream)
+{
+    free(stream->frames);
+    stream->frames = NULL;
+    stream->capacity = 0;
+}
+
+CalcStatus calc_evaluate(Mode mode, const char* buffer, NumberType* result)
+{
+    CalcStream stream;
+    calc_stream_init(&stream, mode);
+    calc_stream_feed(&stream, buffer, strlen(buffer));
+    CalcStatus status = calc_stream_finish(&stream, result);
+    calc_stream_free(&stream);
+    return status;
+}
+
+int calc_format_result(Mode mode, NumberType result, char* out, size_t size)
+{
+    if (mode == FLOAT_MODE) {
+        return snprintf(out, size, "%.4f", result.floatValue);
+    }
+    return snprintf(out, size, "%ld", result.intValue);
+}
+
+CalcStatus calc_evaluate_to_string(int float_mode, const char* buffer, char* out, size_t size)
+{
+    Mode mode = float_mode ? FLOAT_MODE : INT_MODE;
+    NumberType result;
+    CalcStatus status = calc_evaluate(mode, buffer, &result);
+    if (status == CALC_OK) calc_format_result(mode, result, out, size);
+    return status;
+}
+
+// Legacy API
+
+// exits with first error recorded in global context
+static void exit_on_error()
+{
+    if (global_ctx.error != CALC_OK) exit(global_ctx.error);
+}
+
+int set_global_pos(int new_pos)
+{
+    global_ctx.pos = new_pos;
+    return global_ctx.pos;
+}
+
+int get_global_pos() { return global_ctx.pos; }
+
+Mode set_mode(Mode new_mode)
+{
+    global_ctx.mode = new_mode;
+    return global_ctx.mode;
+}
+
+Mode get_mode() { return global_ctx.mode; }
+
+void validate_and_strip_input(char* buffer)
+{
+    calc_validate_and_strip(&global_ctx, buffer);
+    exit_on_error();
+}
+
+NumberType get_operand(char* buffer)
+{
+    NumberType num = calc_get_operand(&global_ctx, buffer);
+    exit_on_error();
+    return num;
+}
+
+NumberType get_product(char* buffer)
+{
+    NumberType res = calc_get_product(&global_ctx, buffer);
+    exit_on_error();
+    return res;
+}
+
+NumberType calculate_expression(char* buffer)
+{
+    NumberType res = calc_expression(&global_ctx, buffer);
+    exit_on_error();
+    return res;
+}
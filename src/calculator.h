@@ -1,3 +1,6 @@
+#ifndef CALCULATOR_H
+#define CALCULATOR_H
+
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
@@ -5,10 +8,24 @@
 #include <math.h>
 
 #define MAX_BUFFER_SIZE 1024
+// bytes read from input at once by streaming readers
+#define CHUNK_SIZE 65536
 #define FLOAT_PRECISION 1e-4
+// enough for "%.4f" of any double
+#define MAX_RESULT_SIZE 512
 
 typedef enum { INT_MODE, FLOAT_MODE } Mode;
 
+// evaluation outcome, non-zero values match app.exe exit codes
+typedef enum {
+    CALC_OK = 0,
+    CALC_ERR_INT_DIV_BY_ZERO = 1,
+    CALC_ERR_FLOAT_DIV_BY_ZERO = 2,
+    CALC_ERR_INVALID_INPUT = 3,
+    CALC_ERR_PARENTHESIS = 4,
+    CALC_ERR_NO_MEMORY = 5
+} CalcStatus;
+
 // union lets us interpret one piece of a memory as a different types
 // they are both take 8 bytes in UNIX
 typedef union {
@@ -16,6 +33,73 @@ typedef union {
     double floatValue;
 } NumberType;
 
+// caller-owned parser state, lets several evaluations run at once
+typedef struct {
+    int pos;
+    Mode mode;
+    CalcStatus error;
+} CalcContext;
+
+// one level of parenthesis nesting in streaming evaluator:
+// sum (+ -) chain and product (* /) chain being accumulated
+typedef struct {
+    NumberType sum;
+    NumberType product;
+    char sum_op;     // operator that folds product into sum
+    char product_op; // operator waiting for next operand
+    int has_sum;
+    int has_product;
+} CalcFrame;
+
+typedef enum { TOKEN_START, TOKEN_NUMBER, TOKEN_OPERATOR, TOKEN_OPEN, TOKEN_CLOSE } TokenKind;
+
+// single-pass evaluator state: input is fed in arbitrary chunks,
+// memory grows with nesting depth only, not with input length
+typedef struct {
+    CalcContext ctx; // mode and first evaluation error
+    CalcStatus syntax_error;
+    int unbalanced;
+    TokenKind prev;
+    int space_after_number;
+    NumberType number;
+    CalcFrame* frames; // frames[depth] is innermost open parenthesis
+    size_t depth;
+    size_t capacity;
+} CalcStream;
+
+// Reentrant API: errors are stored in ctx->error instead of exiting
+
+void calc_init(CalcContext* ctx, Mode mode);
+
+CalcStatus calc_validate_and_strip(CalcContext* ctx, char* buffer);
+
+NumberType calc_get_operand(CalcContext* ctx, const char* buffer);
+
+NumberType calc_get_product(CalcContext* ctx, const char* buffer);
+
+NumberType calc_expression(CalcContext* ctx, const char* buffer);
+
+void calc_stream_init(CalcStream* stream, Mode mode);
+
+// validates and evaluates next piece of input, stops early on syntax error
+CalcStatus calc_stream_feed(CalcStream* stream, const char* data, size_t len);
+
+// returns final status, result is written only on CALC_OK
+CalcStatus calc_stream_finish(CalcStream* stream, NumberType* result);
+
+void calc_stream_free(CalcStream* stream);
+
+// validates and evaluates null-terminated expression in a single pass
+CalcStatus calc_evaluate(Mode mode, const char* buffer, NumberType* result);
+
+// writes result the way app.exe prints it, returns snprintf result
+int calc_format_result(Mode mode, NumberType result, char* out, size_t size);
+
+// one-call entry point for FFI users: float_mode is 0 or 1
+CalcStatus calc_evaluate_to_string(int float_mode, const char* buffer, char* out, size_t size);
+
+// Legacy API: works on a single global context and exits on error
+
 int set_global_pos(int new_pos);
 
 int get_global_pos();
@@ -33,3 +117,5 @@ void validate_and_strip_input(char* buffer);
 NumberType get_operand(char* buffer);
 
 NumberType get_product(char* buffer);
+
+#endif
@@ -1,28 +1,150 @@
+#define _POSIX_C_SOURCE 200809L
+
 #include "calculator.h"
+#include "batch.h"
+#include <unistd.h>
+
+// returned by batch mode when arguments or files are unusable
+#define BATCH_USAGE_ERROR 6
+
+// fgets() returning the length read, so a NUL byte can't hide the end of a line
+static size_t read_chunk(char* chunk, size_t size, int* end_of_line)
+{
+    size_t len = 0;
+    int c;
+
+    *end_of_line = 0;
+    while (len < size && (c = getc_unlocked(stdin)) != EOF) {
+        chunk[len++] = (char)c;
+        if (c == '\n') {
+            *end_of_line = 1;
+            break;
+        }
+    }
+    return len;
+}
+
+// long-running mode: reads "<INT|FLOAT> <expression>" lines from stdin and
+// answers every line with "OK <result>" or "ERR <exit code>"
+// lines are fed to evaluator chunk by chunk, so their length is not limited
+static int serve()
+{
+    char chunk[CHUNK_SIZE];
+    char output[MAX_RESULT_SIZE];
+
+    size_t len;
+    int end_of_line;
+
+    while ((len = read_chunk(chunk, sizeof(chunk), &end_of_line)) > 0) {
+        CalcStream stream;
+        CalcStatus status = CALC_ERR_INVALID_INPUT;
+        size_t offset = 0;
+        int valid_mode = 1;
+        Mode mode = INT_MODE;
+
+        if (len >= 4 && memcmp(chunk, "INT ", 4) == 0) {
+            offset = 4;
+        } else if (len >= 6 && memcmp(chunk, "FLOAT ", 6) == 0) {
+            mode = FLOAT_MODE;
+            offset = 6;
+        } else {
+            valid_mode = 0;
+        }
+
+        calc_stream_init(&stream, mode);
+        if (valid_mode) calc_stream_feed(&stream, chunk + offset, len - offset);
+        // rest of the line, also drained when line is rejected
+        while (!end_of_line && (len = read_chunk(chunk, sizeof(chunk), &end_of_line)) > 0) {
+            if (valid_mode) calc_stream_feed(&stream, chunk, len);
+        }
+
+        NumberType result;
+        if (valid_mode) status = calc_stream_finish(&stream, &result);
+        calc_stream_free(&stream);
+
+        if (status == CALC_OK) {
+            calc_format_result(mode, result, output, sizeof(output));
+            printf("OK %s\n", output);
+        } else {
+            printf("ERR %d\n", status);
+        }
+        fflush(stdout);
+    }
+
+    return 0;
+}
+
+// offline mode: app.exe --batch <input> [--output <file>] [--threads <n>] [--float]
+static int batch(int argc, char* argv[])
+{
+    const char* output_path = NULL;
+    long threads = sysconf(_SC_NPROCESSORS_ONLN);
+    Mode mode = INT_MODE;
+
+    for (int i = 3; i < argc; ++i) {
+        if (strcmp(argv[i], "--float") == 0) {
+            mode = FLOAT_MODE;
+        } else if (strcmp(argv[i], "--output") == 0 && i + 1 < argc) {
+            output_path = argv[++i];
+        } else if (strcmp(argv[i], "--threads") == 0 && i + 1 < argc) {
+            threads = strtol(argv[++i], NULL, 10);
+        } else {
+            fprintf(stderr, "Unknown batch option: %s\n", argv[i]);
+            return BATCH_USAGE_ERROR;
+        }
+    }
+    if (argc < 3) {
+        fprintf(stderr, "Usage: %s --batch <input> [--output <file>] [--threads <n>] [--float]\n", argv[0]);
+        return BATCH_USAGE_ERROR;
+    }
+
+    FILE* output = output_path ? fopen(output_path, "w") : stdout;
+    if (!output) {
+        perror(output_path);
+        return BATCH_USAGE_ERROR;
+    }
+    int err = run_batch(argv[2], output, mode, threads > 0 ? (int)threads : 1);
+    if (output != stdout) fclose(output);
+    if (err != 0) {
+        fprintf(stderr, "%s: %s\n", argv[2], strerror(err));
+        return BATCH_USAGE_ERROR;
+    }
+    return 0;
+}
 
 int main(int argc, char* argv[])
 {
-    char buffer[MAX_BUFFER_SIZE];
-    int len = 0;
-    int space_left = sizeof(buffer);
+    char chunk[CHUNK_SIZE];
+    char output[MAX_RESULT_SIZE];
+    size_t len;
+    Mode mode = INT_MODE;
 
-    if (argc > 1 && strcmp(argv[1], "--float") == 0) {
-        set_mode(FLOAT_MODE);
+    if (argc > 1 && strcmp(argv[1], "--serve") == 0) {
+        return serve();
     }
 
-    while (fgets(buffer + len, space_left, stdin)) {
-        len += strlen(buffer + len);
-        space_left -= len;
+    if (argc > 1 && strcmp(argv[1], "--batch") == 0) {
+        return batch(argc, argv);
     }
-    validate_and_strip_input(buffer);
 
-    NumberType result = calculate_expression(buffer);
+    if (argc > 1 && strcmp(argv[1], "--float") == 0) {
+        mode = FLOAT_MODE;
+    }
 
-    if (get_mode() == FLOAT_MODE) {
-        printf("%.4f\n", result.floatValue);
-    } else {
-        printf("%ld\n", result.intValue);
+    // input is evaluated while it is read, its size is not limited
+    CalcStream stream;
+    calc_stream_init(&stream, mode);
+    while ((len = fread(chunk, 1, sizeof(chunk), stdin)) > 0) {
+        if (calc_stream_feed(&stream, chunk, len) != CALC_OK) break;
     }
 
+    NumberType result;
+    CalcStatus status = calc_stream_finish(&stream, &result);
+    calc_stream_free(&stream);
+    if (status != CALC_OK) return status;
+
+    calc_format_result(mode, result, output, sizeof(output));
+    printf("%s\n", output);
+
     return 0;
 }
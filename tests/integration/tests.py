@@ -86,3 +86,70 @@ def test_unary_operators():
     assert return_code != 0
     return_code, output, error = run_calculator("(/10*3)", True)
     assert return_code != 0
+
+# Test input longer than former 1KiB buffer and deep nesting
+def test_long_input():
+    return_code, output, error = run_calculator("+".join(["(12*3-4/2)"] * 10000))
+    assert return_code == 0
+    assert output == "340000"
+    return_code, output, error = run_calculator("(" * 10000 + "5/2" + ")" * 10000, True)
+    assert return_code == 0
+    assert output == "2.5000"
+
+# Test long-running serve mode
+def run_serve(lines):
+    proc = subprocess.Popen(
+        ["./build/app.exe", "--serve"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    stdout, stderr = proc.communicate(input="".join(line + "\n" for line in lines))
+    return proc.returncode, stdout.splitlines()
+
+def test_serve_mode():
+    return_code, output = run_serve([
+        "INT 2+3*4",
+        "FLOAT 5/2",
+        "INT 5/0",
+        "FLOAT 5/0",
+        "INT 2+a",
+        "INT (2+3",
+        "INT  7 - 4 +3*(5 + 9*8 - (7+3) / 10) * 2",
+        "BAD 1+1",
+        "INT " + "+".join(["1"] * 100000),
+    ])
+    assert return_code == 0
+    assert output == ["OK 14", "OK 2.5000", "ERR 1", "ERR 2", "ERR 3", "ERR 4", "OK 459", "ERR 3", "OK 100000"]
+
+# A NUL byte is invalid input and doesn't hide the end of its line
+def test_serve_mode_nul_byte():
+    return_code, output = run_serve(["INT 1+\0junk", "INT 2+2", "INT 3+3"])
+    assert return_code == 0
+    assert output == ["ERR 3", "OK 4", "OK 6"]
+
+# Test batch file mode
+def test_batch_mode(tmp_path):
+    input_file = tmp_path / "input.txt"
+    output_file = tmp_path / "output.txt"
+    expressions = ["2+3*4", "5/0", "(2+3", "2+a", "10/3"] * 1000
+    input_file.write_text("\n".join(expressions))
+    proc = subprocess.run(
+        ["./build/app.exe", "--batch", str(input_file), "--output", str(output_file), "--threads", "4"],
+        capture_output=True,
+        text=True
+    )
+    assert proc.returncode == 0
+    assert output_file.read_text().splitlines() == ["OK 14", "ERR 1", "ERR 4", "ERR 3", "OK 3"] * 1000
+
+def test_batch_mode_float(tmp_path):
+    input_file = tmp_path / "input.txt"
+    input_file.write_text("5/2\n5/0\n")
+    proc = subprocess.run(
+        ["./build/app.exe", "--batch", str(input_file), "--float"],
+        capture_output=True,
+        text=True
+    )
+    assert proc.returncode == 0
+    assert proc.stdout.splitlines() == ["OK 2.5000", "ERR 2"]
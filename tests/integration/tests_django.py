@@ -0,0 +1,1170 @@
+import os
+import sys
+import json
+import shutil
+import asyncio
+import tempfile
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, os.path.join(ROOT, "CalculatorApp"))
+sys.path.append(ROOT) # client package
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "CalculatorApp.settings")
+
+import django
+from django.conf import settings
+
+TMP_DIR = tempfile.mkdtemp(prefix="calc-tests-")
+
+@pytest.fixture(autouse=True, scope="session")
+def django_app():
+    if not os.path.isfile(os.path.join(ROOT, "build", "app.exe")):
+        pytest.exit("Missing executable. Compile first!", returncode=1)
+    # one throwaway database and no Redis
+    db_path = os.path.join(TMP_DIR, "db.sqlite3")
+    settings.DATABASES["default"]["NAME"] = db_path
+    settings.DATABASES[settings.HISTORY_DB]["NAME"] = db_path
+    settings.CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+    settings.CALC_BACKEND = "process"
+    settings.CALC_CACHE_SHARED_PATH = None
+    settings.SYNC_LEADER_LOCK = "file"
+    settings.SYNC_LEADER_LOCK_PATH = os.path.join(TMP_DIR, "leader.lock")
+    settings.CALC_RETENTION_LOCK_PATH = os.path.join(TMP_DIR, "retention.lock")
+    django.setup()
+    from django.core.management import call_command
+    call_command("migrate", verbosity=0)
+    yield
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+@pytest.fixture
+def clean_history(django_app):
+    from main_app import snapshot
+    from main_app.models import CalculatedResult, ArchivedResult, RetentionRun
+    for model in (CalculatedResult, ArchivedResult, RetentionRun):
+        model.objects.all().delete()
+    # rows deleted outside of retention stay in a loaded snapshot
+    snapshot._snapshot = None
+
+
+def run_stream(lines: list, query: str = "") -> list:
+    """Answers of POST /calc/stream for NDJSON lines"""
+    from main_app.streaming import CalcStreamApp
+    scope = {"type": "http", "method": "POST", "query_string": query.encode(), "headers": [], "client": ("127.0.0.1", 1)}
+    body = "".join(json.dumps(line) + "\n" for line in lines).encode()
+    sent = []
+    async def receive():
+        nonlocal body
+        if body is None:
+            await asyncio.Event().wait()
+        message, body = {"type": "http.request", "body": body, "more_body": False}, None
+        return message
+    async def send(message):
+        sent.append(message)
+    asyncio.run(CalcStreamApp()(scope, receive, send))
+    assert sent[0]["status"] == 200
+    return [json.loads(line) for message in sent[1:] for line in message.get("body", b"").splitlines()]
+
+def test_stream_keeps_whitespace_meaning(clean_history):
+    from main_app.models import CalculatedResult
+    answers = run_stream(["2 * 7 8", " 2 * 78 "])
+    assert answers[0]["index"] == 0 and answers[0]["code"] == 3 and "result" not in answers[0]
+    assert answers[1] == {"index": 1, "expression": "2*78", "result": "156"}
+    assert list(CalculatedResult.objects.values_list("expression", "result")) == [("2*78", "156")]
+
+def test_stream_answers_while_body_arrives(clean_history, monkeypatch):
+    from main_app.streaming import CalcStreamApp
+    monkeypatch.setattr(settings, "CALC_STREAM_WINDOW", 1)
+    scope = {"type": "http", "method": "POST", "query_string": b"", "headers": [], "client": ("127.0.0.1", 1)}
+    chunks = [b'"1+1"\n', b'"2+2"\n', b'"3+3"\n']
+    events = []
+    async def receive():
+        # a server streaming request bodies hands over each line at once
+        if not chunks:
+            await asyncio.Event().wait()
+        events.append(f"line {3 - len(chunks)}")
+        return {"type": "http.request", "body": chunks.pop(0), "more_body": bool(chunks)}
+    async def send(message):
+        for line in message.get("body", b"").splitlines():
+            events.append(f"answer {json.loads(line)['index']}")
+    asyncio.run(asyncio.wait_for(CalcStreamApp()(scope, receive, send), 10))
+    # the second line fills the window, the last one is read after the first answer
+    assert events.index("answer 0") < events.index("line 2")
+    assert sorted(event for event in events if event.startswith("answer")) == ["answer 0", "answer 1", "answer 2"]
+
+def test_stream_stores_answered_rows_after_disconnect(clean_history):
+    from main_app.models import CalculatedResult
+    from main_app.streaming import CalcStreamApp
+    scope = {"type": "http", "method": "POST", "query_string": b"", "headers": [], "client": ("127.0.0.1", 1)}
+    messages = [{"type": "http.request", "body": b'"1+1"\n"2+2"\n', "more_body": True}]
+    sent = []
+    async def receive():
+        if messages:
+            return messages.pop()
+        # client leaves once both answers arrived, before the body ends
+        while len(sent) < 3:
+            await asyncio.sleep(0.01)
+        return {"type": "http.disconnect"}
+    async def send(message):
+        sent.append(message)
+    asyncio.run(CalcStreamApp()(scope, receive, send))
+    assert sorted(CalculatedResult.objects.values_list("result", flat=True)) == ["2", "4"]
+
+def test_stream_reports_failed_store(clean_history, monkeypatch, capsys):
+    from main_app import streaming
+    async def store_results(rows):
+        raise Exception("database is locked")
+    monkeypatch.setattr(streaming, "store_results", store_results)
+    monkeypatch.setattr(settings, "CALC_STREAM_FLUSH_ROWS", 1)
+    answers = run_stream(["1+1", "2+2"])
+    assert [answer["result"] for answer in answers] == ["2", "4"]
+    assert capsys.readouterr().out.count("database is locked") == 2
+
+def test_stream_lines_cost_rate_limit_tokens(clean_history, monkeypatch):
+    from main_app import admission
+    monkeypatch.setattr(settings, "CALC_RATE_LIMIT", 0.5)
+    monkeypatch.setattr(settings, "CALC_RATE_BURST", 3)
+    monkeypatch.setattr(admission, "_admission", None)
+    answers = run_stream(["1+1"] * 6)
+    # admission of the request paid for the first line
+    assert [answer.get("result") for answer in answers[:3]] == ["2", "2", "2"]
+    assert answers[3:] == [{"index": 3, "error": "Too many requests", "retry_after": 2}]
+
+@pytest.mark.parametrize("backend", ["pool", "library", "process"])
+def test_nul_byte_is_invalid_input(backend, monkeypatch):
+    from main_app import runner
+    monkeypatch.setattr(settings, "CALC_BACKEND", backend)
+    async def evaluate():
+        pool = runner.CalcWorkerPool(1, 100, 60)
+        monkeypatch.setattr(runner, "_pool", pool)
+        outcomes = []
+        try:
+            for expression in ("2+2\0junk", "3+3"):
+                try:
+                    outcomes.append(await runner.CalcManager(False, expression).run_app_async())
+                except runner.CalcError as e:
+                    outcomes.append(e.code)
+        finally:
+            for worker in pool._workers:
+                await worker.stop()
+        return outcomes
+    assert asyncio.run(evaluate()) == [3, "6"]
+
+def test_write_behind_ids_follow_commit_order(clean_history):
+    from main_app.models import CalculatedResult
+    from main_app.writebehind import WriteBehindBuffer
+    def results(expression):
+        return [CalculatedResult(expression=expression, result=expression, float_mode=False) for _ in range(3)]
+    async def store():
+        # two buffers stand for two server processes, the later one commits first
+        slow, fast = WriteBehindBuffer(500, 0.2, 1000, 100, True), WriteBehindBuffer(500, 0.01, 1000, 100, True)
+        slow_rows, fast_rows = results("1"), results("2")
+        await asyncio.gather(slow.save(slow_rows), fast.save(fast_rows))
+        return [row.id for row in fast_rows], [row.id for row in slow_rows]
+    fast_ids, slow_ids = asyncio.run(store())
+    assert fast_ids + slow_ids == list(range(fast_ids[0], fast_ids[0] + 6))
+    assert list(CalculatedResult.objects.order_by("id").values_list("expression", flat=True)) == ["2"] * 3 + ["1"] * 3
+
+def test_write_behind_without_waiting_is_single_process(django_app):
+    from main_app.writebehind import WriteBehindBuffer
+    buffer = WriteBehindBuffer(500, 0.01, 1000, 100, False)
+    try:
+        with pytest.raises(Exception, match="single server process"):
+            WriteBehindBuffer(500, 0.01, 1000, 100, False)
+        # waiting buffers take ids at commit and need no lock
+        WriteBehindBuffer(500, 0.01, 1000, 100, True)
+    finally:
+        buffer._lock_file.close()
+
+def store_history(float_modes: list) -> list:
+    from main_app.models import CalculatedResult
+    return CalculatedResult.objects.bulk_create(
+        CalculatedResult(expression=f"{i}+0", result=str(i), float_mode=float_mode) for i, float_mode in enumerate(float_modes)
+    )
+
+def test_retention_runs_without_sockets(clean_history, monkeypatch):
+    from asgiref.testing import ApplicationCommunicator
+    from main_app import retention, leader
+    from main_app.models import CalculatedResult
+    from CalculatorApp.asgi import application
+    store_history([False] * 5)
+    monkeypatch.setattr(settings, "SYNC_PERIOD", 0.05)
+    monkeypatch.setattr(retention, "_retention", retention.Retention(None, 2, None, None, TMP_DIR, 100, 60))
+    monkeypatch.setattr(leader, "_retention_lock", None)
+    async def request():
+        scope = {"type": "http", "method": "GET", "path": "/health", "query_string": b"", "headers": [], "client": ("127.0.0.1", 1)}
+        communicator = ApplicationCommunicator(application, scope)
+        await communicator.send_input({"type": "http.request"})
+        assert (await communicator.receive_output())["status"] == 200
+        await communicator.wait()
+        await asyncio.sleep(0.3)
+    try:
+        asyncio.run(request())
+    finally:
+        leader._retention_lock._file.close()
+    assert retention._retention.runs == 1
+    assert CalculatedResult.objects.count() == 2
+
+async def read_sync(communicator) -> list:
+    """Frames the server sent until it went quiet"""
+    frames = []
+    while not await communicator.receive_nothing(0.2):
+        frames.append(await communicator.receive_json_from())
+    return frames
+
+def test_retention_archives_to_table_and_expires_clients(clean_history):
+    from channels.testing import WebsocketCommunicator
+    from main_app.retention import Retention
+    from main_app.models import CalculatedResult, ArchivedResult, RetentionRun
+    from CalculatorApp.asgi import application
+    # 3 int rows, then 7 float rows
+    rows = store_history([False] * 3 + [True] * 7)
+    ids = [row.id for row in rows]
+    async def run():
+        expiring = WebsocketCommunicator(application, "/ws/sync?since=0&expire=true")
+        resyncing = WebsocketCommunicator(application, "/ws/sync?since=0")
+        for communicator in (expiring, resyncing):
+            assert (await communicator.connect())[0]
+            assert (await read_sync(communicator))[0]["type"] == "snapshot"
+        record = await Retention(None, None, 2, "table", TMP_DIR, 2, None).run()
+        frames = await read_sync(expiring), await read_sync(resyncing)
+        for communicator in (expiring, resyncing):
+            await communicator.disconnect()
+        return record, frames
+    record, (expired, resynced) = asyncio.run(run())
+    # the oldest int row and all float rows but the 2 newest are gone
+    gone = [ids[0]] + ids[3:8]
+    assert (record.deleted, record.archived, record.archive) == (6, 6, "table")
+    assert RetentionRun.objects.get().id == record.id
+    assert list(CalculatedResult.objects.order_by("id").values_list("id", flat=True)) == ids[1:3] + ids[8:]
+    assert list(ArchivedResult.objects.order_by("id").values_list("id", "expression")) == [(row.id, row.expression) for row in rows if row.id in gone]
+    assert expired == [{"type": "expire", "until": ids[7], "keep": ids[1:3]}]
+    assert resynced[0]["type"] == "snapshot"
+    assert [row["id"] for row in resynced[0]["rows"]] == ids[1:3] + ids[8:]
+
+def test_retention_archives_to_file(clean_history):
+    import gzip
+    import datetime
+    from main_app.retention import Retention
+    from main_app.models import CalculatedResult, ArchivedResult
+    rows = store_history([False, True] * 3)
+    old = datetime.datetime(2020, 1, 1)
+    CalculatedResult.objects.filter(id__in=[row.id for row in rows[:3]]).update(timestamp=old)
+    archive_path = os.path.join(TMP_DIR, "archive")
+    record = asyncio.run(Retention(3600, None, None, "file", archive_path, 2, None).run())
+    assert (record.deleted, record.archived, record.archive) == (3, 3, "file")
+    assert CalculatedResult.objects.count() == 3 and not ArchivedResult.objects.exists()
+    [segment] = os.listdir(archive_path)
+    # one gzip member per chunk, read back as one stream
+    with gzip.open(os.path.join(archive_path, segment), "rt") as file:
+        archived = [json.loads(line) for line in file]
+    assert archived == [
+        {"id": row.id, "expression": row.expression, "result": row.result,
+         "timestamp": old.isoformat(), "float_mode": row.float_mode, "session": ""}
+        for row in rows[:3]
+    ]
+    shutil.rmtree(archive_path)
+
+def test_too_many_in_flight_is_a_reply(clean_history, monkeypatch):
+    from channels.testing import WebsocketCommunicator
+    from main_app import consumers
+    from CalculatorApp.asgi import application
+    monkeypatch.setattr(settings, "CALC_WS_MAX_IN_FLIGHT", 2)
+    # any queued frame makes the outbox drop sync frames
+    monkeypatch.setattr(settings, "CALC_WS_OUTBOX_BYTES", 10)
+    async def evaluate(float_mode, expression):
+        await asyncio.Event().wait()
+    monkeypatch.setattr(consumers, "evaluate_expression", evaluate)
+    send = consumers.SyncConsumer.send
+    released = None
+    async def stalled_send(self, text_data=None, bytes_data=None, close=False):
+        await released.wait()
+        await send(self, text_data, bytes_data, close)
+    monkeypatch.setattr(consumers.SyncConsumer, "send", stalled_send)
+    async def run():
+        nonlocal released
+        released = asyncio.Event()
+        communicator = WebsocketCommunicator(application, "/ws/sync?since=0")
+        await communicator.connect()
+        # the writer is stuck on the initial snapshot
+        await asyncio.sleep(0.1)
+        # one queued reply and one running calculation fill the limit
+        await communicator.send_json_to({"id": 0})
+        await communicator.send_json_to({"id": 1, "expression": "2+2"})
+        await communicator.send_json_to({"id": 2, "expression": "2+2"})
+        await asyncio.sleep(0.1)
+        released.set()
+        frames = await read_sync(communicator)
+        await communicator.disconnect()
+        return frames
+    frames = asyncio.run(run())
+    assert frames[0]["type"] == "snapshot"
+    assert frames[1]["id"] == 0 and "error" in frames[1]
+    assert frames[2] == {"id": 2, "error": "Too many requests in flight"}
+
+def test_client_not_reading_replies_is_closed(clean_history, monkeypatch):
+    from channels.testing import WebsocketCommunicator
+    from main_app import consumers
+    from CalculatorApp.asgi import application
+    monkeypatch.setattr(settings, "CALC_WS_MAX_IN_FLIGHT", 2)
+    async def evaluate(float_mode, expression):
+        return "4"
+    monkeypatch.setattr(consumers, "evaluate_expression", evaluate)
+    async def stalled_send(self, text_data=None, bytes_data=None, close=False):
+        await asyncio.Event().wait()
+    monkeypatch.setattr(consumers.SyncConsumer, "send", stalled_send)
+    async def run():
+        communicator = WebsocketCommunicator(application, "/ws/sync?since=0")
+        await communicator.connect()
+        # the writer is stuck on the initial snapshot
+        await asyncio.sleep(0.1)
+        for id in range(2):
+            await communicator.send_json_to({"id": id, "expression": "2+2"})
+        await asyncio.sleep(0.2)
+        # both replies wait behind the stalled snapshot
+        await communicator.send_json_to({"id": 2, "expression": "2+2"})
+        output = await communicator.receive_output(1)
+        await communicator.disconnect()
+        return output
+    assert asyncio.run(run()) == {"type": "websocket.close", "code": 4003}
+
+def test_outbox_drops_sync_frames_and_catches_up_once():
+    from main_app.outbox import Outbox
+    async def run():
+        released = asyncio.Event()
+        sent, drained = [], []
+        async def send(text):
+            await released.wait()
+            sent.append(text)
+        def on_drained():
+            drained.append(outbox.sent_version)
+            outbox.put("catch-up", version=3)
+        outbox = Outbox(send, on_drained, 10)
+        writer = asyncio.create_task(outbox.run())
+        assert outbox.put("sync-1", version=1)
+        await asyncio.sleep(0)
+        # the first frame is being sent, the second one fits
+        assert outbox.put("sync-2", version=2)
+        outbox.put("reply", droppable=False, reply=True)
+        assert not outbox.put("sync-3", version=3)
+        assert not outbox.put("sync-4", version=4)
+        assert outbox.behind and outbox.replies == 1
+        released.set()
+        await asyncio.sleep(0.1)
+        writer.cancel()
+        return sent, drained, outbox
+    sent, drained, outbox = asyncio.run(run())
+    assert sent == ["sync-1", "reply", "catch-up"]
+    assert drained == [1]
+    assert not outbox.behind and outbox.replies == 0 and outbox.dropped == 3
+
+def test_slow_reader_of_long_snapshot_is_not_idle(clean_history, monkeypatch):
+    from channels.testing import WebsocketCommunicator
+    from main_app import consumers
+    from main_app import snapshot
+    from CalculatorApp.asgi import application
+    store_history([False] * 6)
+    monkeypatch.setattr(settings, "CALC_SYNC_CHUNK_ROWS", 1)
+    monkeypatch.setattr(snapshot, "_snapshot", None)
+    # every frame waits until the one before is read
+    monkeypatch.setattr(settings, "CALC_WS_OUTBOX_BYTES", 10)
+    monkeypatch.setattr(settings, "CALC_WS_PING_INTERVAL", 0.2)
+    monkeypatch.setattr(settings, "CALC_WS_PING_TIMEOUT", 1)
+    monkeypatch.setattr(consumers, "REAP_PERIOD", 0.1)
+    send = consumers.SyncConsumer.send
+    async def slow_send(self, text_data=None, bytes_data=None, close=False):
+        await asyncio.sleep(0.25)
+        await send(self, text_data, bytes_data, close)
+    monkeypatch.setattr(consumers.SyncConsumer, "send", slow_send)
+    async def run():
+        communicator = WebsocketCommunicator(application, "/ws/sync?since=0")
+        await communicator.connect()
+        frames = []
+        while not frames or frames[-1].get("type") != "snapshot.end":
+            output = await communicator.receive_output(2)
+            assert output["type"] == "websocket.send", output
+            frame = json.loads(output["text"])
+            if frame["type"] == "ping":
+                await communicator.send_json_to({"type": "pong"})
+                continue
+            frames.append(frame)
+        await communicator.disconnect()
+        return frames
+    frames = asyncio.run(run())
+    assert [frame["type"] for frame in frames] == (
+        ["snapshot"] + ["snapshot.chunk"] * 5 + ["snapshot.end"]
+    )
+
+def test_history_watcher_reads_data_version_off_the_loop(clean_history):
+    import threading
+    from main_app.sync import HistoryWatcher
+    watcher = HistoryWatcher()
+    conn, threads = watcher._conn, []
+    class Recording:
+        def execute(self, sql):
+            threads.append(threading.get_ident())
+            return conn.execute(sql)
+    watcher._conn = Recording()
+    async def run():
+        changes = [await watcher.changed(), await watcher.changed()]
+        await asyncio.to_thread(store_history, [False])
+        return changes + [await watcher.changed()]
+    assert asyncio.run(run()) == [True, False, True]
+    assert threading.get_ident() not in threads
+
+def test_fanout_hub_rejoins_after_layer_errors(monkeypatch):
+    from main_app import fanout
+    class Layer:
+        def __init__(self):
+            self.failures = 2
+            self.joins = 0
+        async def new_channel(self):
+            return "hub"
+        async def group_add(self, group, channel):
+            self.joins += 1
+        async def group_discard(self, group, channel):
+            pass
+        async def receive(self, channel):
+            if self.failures:
+                self.failures -= 1
+                raise Exception("Connection refused")
+            if self.joins < 3:
+                raise Exception("Not re-joined")
+            await asyncio.sleep(0.01)
+            return {"type": "sync.delta"}
+    layer = Layer()
+    monkeypatch.setattr(fanout, "get_channel_layer", lambda: layer)
+    monkeypatch.setattr(fanout, "READ_BACKOFF", 0.01)
+    class Consumer:
+        messages = []
+        async def dispatch(self, message):
+            self.messages.append(message)
+    async def run():
+        hub, consumer = fanout.FanoutHub("group"), Consumer()
+        await hub.subscribe(consumer)
+        await asyncio.sleep(0.1)
+        await hub.unsubscribe(consumer)
+        return hub.stats(), consumer.messages
+    stats, messages = asyncio.run(run())
+    assert stats["errors"] == 2 and not stats["failing"]
+    assert layer.joins == 3 and messages
+
+def test_library_call_past_deadline_keeps_its_slot(monkeypatch):
+    import time
+    from main_app import runner
+    from main_app.scheduler import get_scheduler
+    from main_app.utils import evaluate_expression
+    class Engine:
+        def evaluate(self, mode, input_data):
+            time.sleep(0.3)
+            return "2"
+    monkeypatch.setattr(settings, "CALC_BACKEND", "library")
+    monkeypatch.setattr(settings, "CALC_TIMEOUT", 0.1)
+    monkeypatch.setattr(runner, "get_engine", lambda: Engine())
+    async def run():
+        with pytest.raises(runner.CalcTimeoutError):
+            await evaluate_expression(False, "1+1+1+1")
+        running = get_scheduler().running
+        await asyncio.sleep(0.4)
+        return running, get_scheduler().running
+    assert asyncio.run(run()) == (1, 0)
+
+def test_history_pages_and_not_modified(clean_history):
+    from django.test import AsyncClient
+    ids = [row.id for row in store_history([False, True, False, True, False])]
+    client = AsyncClient(headers={"host": "localhost"})
+    async def run():
+        pages, after_id = [], 0
+        while after_id is not None:
+            page = (await client.get("/history", {"after_id": after_id, "limit": 2})).json()
+            pages.append([row["id"] for row in page["rows"]])
+            after_id = page["next_after_id"]
+        floats = (await client.get("/history", {"mode": "float"})).json()
+        etag = (await client.get("/history"))["ETag"]
+        unchanged = await client.get("/history", headers={"if-none-match": etag})
+        await asyncio.to_thread(store_history, [False])
+        changed = await client.get("/history", headers={"if-none-match": etag})
+        not_allowed = await client.post("/history")
+        return pages, floats, unchanged, changed, not_allowed
+    pages, floats, unchanged, changed, not_allowed = asyncio.run(run())
+    assert pages == [ids[0:2], ids[2:4], ids[4:]]
+    assert [row["id"] for row in floats["rows"]] == [ids[1], ids[3]] and floats["next_after_id"] is None
+    assert unchanged.status_code == 304 and not unchanged.content
+    assert changed.status_code == 200 and changed["ETag"] != unchanged["ETag"]
+    assert not_allowed.status_code == 405 and not_allowed["Allow"] == "GET"
+
+@pytest.mark.parametrize("encoding", ["binary", "binary-zlib"])
+def test_binary_frames_decode_like_json(encoding):
+    import datetime
+    from main_app import codec
+    from main_app.snapshot import encode_row
+    from client.controller.codec import decode_frame
+    start = datetime.datetime(2026, 10, 17, 7, 30, 0, 250)
+    rows = [
+        (100 + 3 * i, f"{i}*(2+2)/√{i}", str(i * 4), start + datetime.timedelta(seconds=i * 37, microseconds=-i))
+        for i in range(40)
+    ]
+    frames = [
+        (codec.SNAPSHOT, (1000, True), rows[:20]),
+        (codec.SNAPSHOT, (1000, False), []),
+        (codec.SNAPSHOT_CHUNK, (), rows[20:]),
+        (codec.SNAPSHOT_END, (1000,), None),
+        (codec.DELTA, (97, 217), rows),
+    ]
+    for kind, header, frame_rows in frames:
+        text = codec.encode_frame(codec.JSON, kind, header, None if frame_rows is None else [encode_row(*row) for row in frame_rows])
+        data = codec.encode_frame(encoding, kind, header, frame_rows)
+        assert decode_frame(data) == json.loads(text)
+    # rows of a delta compress well
+    assert (data[0] & codec.ZLIB != 0) == (encoding == "binary-zlib")
+
+def test_resync_while_outbox_is_behind(clean_history, monkeypatch):
+    from channels.layers import get_channel_layer
+    from channels.testing import WebsocketCommunicator
+    from main_app import consumers, snapshot
+    from main_app.sync import SYNC_GROUP
+    from CalculatorApp.asgi import application
+    store_history([False] * 6)
+    monkeypatch.setattr(settings, "CALC_SYNC_CHUNK_ROWS", 1)
+    monkeypatch.setattr(snapshot, "_snapshot", None)
+    # every queued frame puts sync frames behind it over the limit
+    monkeypatch.setattr(settings, "CALC_WS_OUTBOX_BYTES", 10)
+    monkeypatch.setattr(settings, "CALC_WS_MAX_LAG", 1)
+    monkeypatch.setattr(consumers, "REAP_PERIOD", 0.1)
+    send = consumers.SyncConsumer.send
+    async def slow_send(self, text_data=None, bytes_data=None, close=False):
+        await asyncio.sleep(0.05)
+        await send(self, text_data, bytes_data, close)
+    monkeypatch.setattr(consumers.SyncConsumer, "send", slow_send)
+    async def read_snapshot(communicator):
+        types = []
+        while not types or types[-1] != "snapshot.end":
+            output = await communicator.receive_output(3)
+            assert output["type"] == "websocket.send", output
+            frame = json.loads(output["text"])
+            if frame["type"] in ("snapshot", "snapshot.chunk", "snapshot.end"):
+                types.append(frame["type"])
+        return types
+    async def run():
+        communicator = WebsocketCommunicator(application, "/ws/sync?since=0")
+        await communicator.connect()
+        initial = await read_snapshot(communicator)
+        # the first one is still being sent when the resync streams
+        for _ in range(3):
+            await get_channel_layer().group_send(SYNC_GROUP, {"type": "sync.message", "message": '{"type": "note"}'})
+        await communicator.send_json_to({"type": "resync", "since": 0})
+        resynced = await read_snapshot(communicator)
+        await communicator.disconnect()
+        return initial, resynced
+    initial, resynced = asyncio.run(run())
+    assert initial == resynced == ["snapshot"] + ["snapshot.chunk"] * 5 + ["snapshot.end"]
+
+def test_calculation_during_long_snapshot(clean_history, monkeypatch):
+    from channels.testing import WebsocketCommunicator
+    from main_app import consumers, snapshot
+    from CalculatorApp.asgi import application
+    rows = store_history([False] * 6)
+    monkeypatch.setattr(settings, "CALC_SYNC_CHUNK_ROWS", 1)
+    monkeypatch.setattr(snapshot, "_snapshot", None)
+    monkeypatch.setattr(settings, "CALC_WS_OUTBOX_BYTES", 10)
+    async def evaluate(float_mode, expression):
+        return "2"
+    monkeypatch.setattr(consumers, "evaluate_expression", evaluate)
+    send = consumers.SyncConsumer.send
+    async def slow_send(self, text_data=None, bytes_data=None, close=False):
+        await asyncio.sleep(0.1)
+        await send(self, text_data, bytes_data, close)
+    monkeypatch.setattr(consumers.SyncConsumer, "send", slow_send)
+    async def run():
+        communicator = WebsocketCommunicator(application, "/ws/sync?since=0")
+        await communicator.connect()
+        # the snapshot has read the history before the row is stored
+        frames = [await communicator.receive_json_from(3)]
+        await communicator.send_json_to({"id": 0, "expression": "1+1"})
+        while not frames or frames[-1].get("type") != "delta":
+            frames.append(await communicator.receive_json_from(3))
+        await communicator.disconnect()
+        return frames
+    frames = asyncio.run(run())
+    types = [frame.get("type", "reply") for frame in frames]
+    # the reply doesn't wait for the snapshot, its row comes after it
+    assert types.index("reply") < types.index("snapshot.end")
+    assert types[-2:] == ["snapshot.end", "delta"]
+    assert [row["id"] for row in frames[-1]["rows"]] == [frames[types.index("reply")]["result"]["id"]]
+    assert frames[-1]["from"] == rows[-1].id
+
+def test_cache_key_keeps_what_app_exe_rejects():
+    from main_app.cache import canonicalize
+    assert canonicalize(" 1 +\t2\r\n* ( 3 )\v\f") == "1+2*(3)"
+    # digits on both sides stay apart, "12" and "1 2" differ
+    assert canonicalize("1 \t 2+3") == "1 2+3"
+    for space in ("\x1c", "\x1f", "\xa0", " ", "١"):
+        assert canonicalize(f"1+{space}2") == f"1+{space}2"
+    assert canonicalize("1 ٢") == "1٢"
+
+@pytest.mark.parametrize("first, second", [("1+\x1c2", "1+2"), ("1+2", "1+\x1c2"), ("1 2", "12"), ("12", "1 2")])
+def test_cached_outcomes_match_app_exe(first, second, monkeypatch):
+    from main_app import cache, utils
+    from main_app.runner import CalcError
+    monkeypatch.setattr(cache, "_cache", cache.ResultCache(cache.LocalCache(100, 60)))
+    async def outcome(expression):
+        try:
+            return await utils.evaluate_expression(False, expression)
+        except CalcError as e:
+            return e.code
+    async def run():
+        cold = [await outcome(expression) for expression in (first, second)]
+        warm = [await outcome(expression) for expression in (first, second)]
+        return cold, warm
+    cold, warm = asyncio.run(run())
+    expected = {"1+2": "3", "1+\x1c2": 3, "12": "12", "1 2": 3}
+    assert cold == warm == [expected[first], expected[second]]
+    stats = cache.get_cache().stats()["local"]
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (2, 2, 2)
+
+def test_local_cache_evicts_least_recently_used_and_expired(monkeypatch):
+    from main_app import cache
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    local = cache.LocalCache(2, 10)
+    local.put("a", ("OK", "1"))
+    local.put("b", ("ERR", "3"))
+    assert local.get("a") == ("OK", "1")
+    local.put("c", ("OK", "2"))
+    assert local.get("b") is None and local.get("c") == ("OK", "2")
+    now[0] += 11
+    assert local.get("a") is None
+    assert local.stats() == {
+        "entries": 1, "max_entries": 2, "hits": 2, "misses": 2, "evictions": 1, "expirations": 1,
+    }
+
+def test_shared_cache_between_processes(monkeypatch):
+    from main_app import cache
+    path = os.path.join(TMP_DIR, "shared-cache")
+    writer, reader = cache.SharedCache(path, 4, 60), cache.SharedCache(path, 4, 60)
+    # one bucket of four slots
+    for i in range(5):
+        writer.put(f"int {i}".encode(), (cache.OK, str(i)))
+    assert reader.get(b"int 0") is None
+    assert [reader.get(f"int {i}".encode()) for i in range(1, 5)] == [(cache.OK, str(i)) for i in range(1, 5)]
+    writer.put(b"int 1", (cache.ERR, "3"))
+    assert reader.get(b"int 1") == (cache.ERR, "3")
+    # too big for a slot
+    writer.put(b"int " + b"1+" * 200, (cache.OK, "1"))
+    assert reader.get(b"int " + b"1+" * 200) is None
+    assert writer.stats() == {"slots": 4, "hits": 0, "misses": 0, "evictions": 1}
+    assert (reader.stats()["hits"], reader.stats()["misses"]) == (5, 2)
+    # a different layout starts from an empty table
+    assert cache.SharedCache(path, 8, 60).get(b"int 2") is None
+    expired = cache.SharedCache(path, 8, -1)
+    expired.put(b"int 2", (cache.OK, "2"))
+    assert expired.get(b"int 2") is None
+
+def test_result_cache_promotes_shared_hits_and_skips_long_keys():
+    from main_app import cache
+    path = os.path.join(TMP_DIR, "shared-cache-tiers")
+    shared = cache.SharedCache(path, 64, 60)
+    first = cache.ResultCache(cache.LocalCache(10, 60), shared, 8)
+    second = cache.ResultCache(cache.LocalCache(10, 60), cache.SharedCache(path, 64, 60), 8)
+    key = first.make_key("int", " 2 + 2 ")
+    assert key == "int 2+2"
+    first.put(key, (cache.OK, "4"))
+    assert second.get(key) == (cache.OK, "4")
+    assert second.get(key) == (cache.OK, "4")
+    assert second.stats()["shared"]["hits"] == 1 and second.stats()["local"]["hits"] == 1
+    assert first.make_key("int", "1+" * 5) is None and first.stats()["skipped"] == 1
+
+def test_heartbeat_publishes_only_unannounced_rows(clean_history, monkeypatch):
+    from channels.layers import get_channel_layer
+    from channels.testing import WebsocketCommunicator
+    from main_app import sync
+    from main_app.serializers import CalculatedResultSerializer
+    from CalculatorApp.asgi import application
+    watcher = sync.HistoryWatcher()
+    monkeypatch.setattr(sync, "_watcher", watcher)
+    layer = get_channel_layer()
+    sent = []
+    async def group_send(group, message):
+        sent.append(message["type"])
+        await type(layer).group_send(layer, group, message)
+    monkeypatch.setattr(layer, "group_send", group_send)
+    def delta(rows):
+        return {
+            "type": "sync.delta", "from": rows[0].id - 1, "version": rows[-1].id,
+            "rows": CalculatedResultSerializer(rows, many=True).data, "meta": [[row.float_mode, row.session] for row in rows],
+        }
+    async def run():
+        communicator = WebsocketCommunicator(application, "/ws/sync?since=0")
+        await communicator.connect()
+        # the version of an empty table is 0 whatever ids come next
+        await asyncio.to_thread(store_history, [False])
+        await sync.heartbeat()
+        # another process stores and broadcasts rows, the second delta arrives first
+        first, second = await asyncio.to_thread(store_history, [False] * 2), await asyncio.to_thread(store_history, [True])
+        await layer.group_send(sync.SYNC_GROUP, delta(second))
+        await asyncio.sleep(0.1)
+        assert watcher.version == first[0].id - 1
+        await layer.group_send(sync.SYNC_GROUP, delta(first))
+        await asyncio.sleep(0.1)
+        sent.clear()
+        await sync.heartbeat()
+        # a third process stores rows and dies before broadcasting them
+        third = await asyncio.to_thread(store_history, [False])
+        await sync.heartbeat()
+        await communicator.disconnect()
+        return third
+    third = asyncio.run(run())
+    assert sent == ["sync.heartbeat", "sync.delta", "sync.heartbeat"]
+    assert watcher.version == third[0].id
+
+def run_app(expression: str, float_mode: bool):
+    """Output of app.exe for expression, or its exit code on error"""
+    import subprocess
+    cmd = [os.path.join(ROOT, "build", "app.exe")] + (["--float"] if float_mode else [])
+    proc = subprocess.run(cmd, input=expression, capture_output=True, text=True)
+    return proc.stdout.strip() if proc.returncode == 0 else proc.returncode
+
+def post_vector(body: dict, float_mode: bool):
+    from django.test import AsyncClient
+    client = AsyncClient(headers={"host": "localhost"})
+    query = "?float=true" if float_mode else ""
+    return asyncio.run(client.post(f"/calc/vector{query}", body, content_type="application/json"))
+
+@pytest.mark.parametrize("expression, float_mode, variables", [
+    # C division truncates towards zero, x / -1 negates
+    ("(x-7)/y", False, {"x": [-5, 0, 3, 7, 8, 20], "y": [2, 2, 2, 0, -1, 3]}),
+    ("x/3*y+1", True, {"x": [1, 2, -2, 5, 0], "y": [1, 1, 3, 7, 2]}),
+    # divisors under FLOAT_PRECISION fail as division by zero
+    ("x/(y/100000)", True, {"x": [1, 1, 1, -3], "y": [5, 10, 20, -9]}),
+    ("x/(y/100000)", False, {"x": [1, 1], "y": [5, 200000]}),
+    ("x*y-x", False, {"x": 3, "y": [1, -2, 4]}),
+])
+def test_vector_matches_app_exe(expression, float_mode, variables):
+    import re
+    response = post_vector({"expression": expression, "variables": variables}, float_mode)
+    assert response.status_code == 200, response.content
+    data = response.json()
+    length = max(len(value) for value in variables.values() if isinstance(value, list))
+    expected = []
+    for i in range(length):
+        def value(match):
+            number = variables[match[0]]
+            number = number[i] if isinstance(number, list) else number
+            return f"(0-{-number})" if number < 0 else str(number)
+        expected.append(run_app(re.sub(r"[a-z_]\w*", value, expression), float_mode))
+    # masked elements are the ones app.exe rejects as division by zero
+    assert data["mask"] == [output in (1, 2) for output in expected]
+    assert data["results"] == [None if output in (1, 2) else output for output in expected]
+
+def test_vector_rejects_bad_variables(django_app):
+    mismatched = post_vector({"expression": "x+y", "variables": {"x": [1, 2], "y": [1, 2, 3]}}, False)
+    missing = post_vector({"expression": "x+y", "variables": {"x": [1, 2]}}, False)
+    fraction = post_vector({"expression": "x+1", "variables": {"x": [1, 2.5]}}, False)
+    invalid = post_vector({"expression": "x+1)", "variables": {"x": 1}}, False)
+    assert (mismatched.status_code, mismatched.content) == (400, b"Variable lists must have the same length")
+    assert (missing.status_code, missing.content) == (400, b"Missing variables: y")
+    assert (fraction.status_code, fraction.content) == (400, b"Variable x must be an integer or a list of them")
+    assert invalid.status_code == 400 and invalid.json()["code"] == run_app("1+1)", False)
+    # variables the expression doesn't use are ignored
+    unused = post_vector({"expression": "x+1", "variables": {"x": [1, 2], "z": "unused"}}, False)
+    assert unused.json() == {"results": ["2", "3"], "mask": [False, False]}
+
+def test_vector_reuses_compiled_expressions(django_app):
+    from main_app.vector import compile_expression
+    compile_expression.cache_clear()
+    for variables in ({"x": [1, 2]}, {"x": [3]}, {"x": 4}):
+        assert post_vector({"expression": "x*2", "variables": variables}, False).status_code == 200
+    assert post_vector({"expression": "x*2", "variables": {"x": 4}}, True).json()["results"] == ["8.0000"]
+    info = compile_expression.cache_info()
+    assert (info.hits, info.misses) == (2, 2)
+    assert compile_expression("x*2", False) is compile_expression("x*2", False)
+
+def test_batch_keeps_input_order_and_stores_rows_at_once(clean_history, monkeypatch):
+    from django.db import connections
+    from django.test import AsyncClient
+    from django.test.utils import CaptureQueriesContext
+    from main_app import views, database
+    from main_app.models import CalculatedResult
+    evaluate_expression = views.evaluate_expression
+    async def evaluate(float_mode, expression, priority):
+        # the first item finishes last
+        await asyncio.sleep(0.2 if expression == "9*9" else 0)
+        return await evaluate_expression(float_mode, expression, priority)
+    monkeypatch.setattr(views, "evaluate_expression", evaluate)
+    queries = []
+    call = database.DatabaseThreads._call
+    def counted_call(alias, func, args):
+        with CaptureQueriesContext(connections[alias]) as captured:
+            result = call(alias, func, args)
+        queries.extend(query["sql"] for query in captured.captured_queries if query["sql"] not in ("BEGIN IMMEDIATE", "COMMIT"))
+        return result
+    monkeypatch.setattr(database.DatabaseThreads, "_call", staticmethod(counted_call))
+    items = [
+        {"expression": "9*9"},
+        "1+1",
+        {"expression": "1/0"},
+        {"expression": "5/2", "float": True},
+        {"expression": "2+a"},
+        {"expression": "7 - 3"},
+    ]
+    client = AsyncClient(headers={"host": "localhost"})
+    response = asyncio.run(client.post("/calc/batch?session=batch", items, content_type="application/json"))
+    assert response.status_code == 200
+    data = response.json()
+    assert [item.get("result") for item in data] == ["81", None, None, "2.5000", None, "4"]
+    assert data[1] == {"error": "Incorrect batch item '1+1'"}
+    assert (data[2]["code"], data[4]["code"]) == (1, 3)
+    assert data[5]["expression"] == "7-3"
+    # every row in a single INSERT
+    assert len(queries) == 1 and queries[0].startswith("INSERT")
+    rows = CalculatedResult.objects.order_by("id").values_list("id", "result", "session")
+    assert [(row_id, result) for row_id, result, _ in rows] == [(item["id"], item["result"]) for item in data if "id" in item]
+    assert {session for _, _, session in rows} == {"batch"}
+
+def scheduler_classes(**classes) -> dict:
+    return {
+        name: {"weight": weight, "max_concurrency": max_concurrency, "max_waiting": max_waiting}
+        for name, (weight, max_concurrency, max_waiting) in classes.items()
+    }
+
+def test_scheduler_shares_slots_by_weight():
+    from main_app.scheduler import CalcScheduler
+    scheduler = CalcScheduler(1, scheduler_classes(fast=(3, 1, 100), slow=(1, 1, 100)))
+    order = []
+    async def evaluate(priority):
+        async with scheduler.slot(priority):
+            order.append(priority)
+            await asyncio.sleep(0)
+    async def run():
+        await scheduler.acquire("fast")
+        tasks = [asyncio.create_task(evaluate(priority)) for priority in ["fast"] * 12 + ["slow"] * 12]
+        await asyncio.sleep(0)
+        scheduler.release("fast")
+        await asyncio.gather(*tasks)
+    asyncio.run(run())
+    # both queues stay full for the first 16 slots, then the slow one drains alone
+    assert order[:16].count("fast") == 12 and order[16:] == ["slow"] * 8
+    assert all(order[i:i + 4].count("fast") == 3 for i in range(0, 16, 4))
+    assert scheduler.running == 0 and scheduler.stats()["classes"]["slow"]["dispatched"] == 12
+
+def test_scheduler_caps_class_concurrency():
+    from main_app.scheduler import CalcScheduler
+    scheduler = CalcScheduler(4, scheduler_classes(interactive=(8, 4, 10), bulk=(1, 1, 10)))
+    async def run():
+        await scheduler.acquire("bulk")
+        waiting = asyncio.create_task(scheduler.acquire("bulk"))
+        await asyncio.sleep(0)
+        # free slots go to the other class only
+        for _ in range(3):
+            await asyncio.wait_for(scheduler.acquire("interactive"), 1)
+        capped = scheduler.stats()
+        scheduler.release("interactive")
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        scheduler.release("bulk")
+        await asyncio.wait_for(waiting, 1)
+        return capped
+    capped = asyncio.run(run())
+    assert capped["running"] == 4
+    assert (capped["classes"]["bulk"]["running"], capped["classes"]["bulk"]["waiting"]) == (1, 1)
+    assert (scheduler.classes["bulk"].running, scheduler.running) == (1, 3)
+
+def test_scheduler_rejects_past_max_waiting():
+    from main_app.scheduler import CalcScheduler, CalcQueueFullError
+    scheduler = CalcScheduler(1, scheduler_classes(interactive=(8, 1, 10), bulk=(1, 1, 2)))
+    async def run():
+        await scheduler.acquire("bulk")
+        waiting = [asyncio.create_task(scheduler.acquire("bulk")) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(CalcQueueFullError):
+            await scheduler.acquire("bulk")
+        # the other class has a queue of its own
+        interactive = asyncio.create_task(scheduler.acquire("interactive"))
+        await asyncio.sleep(0)
+        for task in waiting + [interactive]:
+            task.cancel()
+        await asyncio.gather(*waiting, interactive, return_exceptions=True)
+    asyncio.run(run())
+    assert scheduler.classes["bulk"].rejected == 1 and scheduler.classes["interactive"].rejected == 0
+
+def test_scheduler_cancelled_waiters_give_up_their_place():
+    from main_app.scheduler import CalcScheduler
+    scheduler = CalcScheduler(1, scheduler_classes(interactive=(8, 1, 10), bulk=(1, 1, 10)))
+    async def run():
+        await scheduler.acquire("interactive")
+        first, second, third = (asyncio.create_task(scheduler.acquire("interactive")) for _ in range(3))
+        await asyncio.sleep(0)
+        # cancelled while queued
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        assert len(scheduler.classes["interactive"].queue) == 2
+        # cancelled after the slot was granted, before it ran
+        scheduler.release("interactive")
+        assert not second.done()
+        second.cancel()
+        await asyncio.gather(second, return_exceptions=True)
+        await asyncio.wait_for(third, 1)
+        return first.cancelled(), second.cancelled()
+    assert asyncio.run(run()) == (True, True)
+    assert scheduler.running == 1 and not scheduler.classes["interactive"].queue
+
+def test_sync_snapshot_then_delta(clean_history):
+    from channels.testing import WebsocketCommunicator
+    from main_app.models import CalculatedResult
+    from main_app.writebehind import store_results
+    from CalculatorApp.asgi import application
+    ids = [row.id for row in store_history([False] * 3)]
+    async def run():
+        communicator = WebsocketCommunicator(application, "/ws/sync?since=0")
+        await communicator.connect()
+        snapshot = await read_sync(communicator)
+        row = CalculatedResult(expression="2+2", result="4", float_mode=False)
+        await store_results([row])
+        delta = await read_sync(communicator)
+        # a client coming back gets the rows it missed only
+        behind = WebsocketCommunicator(application, f"/ws/sync?since={ids[0]}")
+        await behind.connect()
+        caught_up = await read_sync(behind)
+        for communicator in (communicator, behind):
+            await communicator.disconnect()
+        return snapshot, row, delta, caught_up
+    snapshot, row, delta, caught_up = asyncio.run(run())
+    assert len(snapshot) == 1 and snapshot[0]["type"] == "snapshot" and not snapshot[0]["more"]
+    assert snapshot[0]["version"] == ids[-1] and [row["id"] for row in snapshot[0]["rows"]] == ids
+    assert delta == [{"type": "delta", "from": ids[-1], "version": row.id, "rows": [
+        {"id": row.id, "expression": "2+2", "result": "4", "timestamp": row.timestamp.isoformat().replace("+00:00", "Z")},
+    ]}]
+    assert [(frame["type"], frame["from"], frame["version"]) for frame in caught_up] == [("delta", ids[0], row.id)]
+    assert [row["id"] for row in caught_up[0]["rows"]] == ids[1:] + [row.id]
+
+def test_sync_gap_triggers_catch_up_and_resync(clean_history):
+    from channels.layers import get_channel_layer
+    from channels.testing import WebsocketCommunicator
+    from main_app.serializers import CalculatedResultSerializer
+    from main_app.sync import SYNC_GROUP
+    from CalculatorApp.asgi import application
+    [first] = store_history([False])
+    async def run():
+        communicator = WebsocketCommunicator(application, "/ws/sync?since=0")
+        await communicator.connect()
+        snapshot = await read_sync(communicator)
+        # two rows are stored, only the delta of the second one arrives
+        missed, last = await asyncio.to_thread(store_history, [False, True])
+        await get_channel_layer().group_send(SYNC_GROUP, {
+            "type": "sync.delta", "from": last.id - 1, "version": last.id,
+            "rows": [CalculatedResultSerializer(last).data], "meta": [[True, ""]],
+        })
+        caught_up = await read_sync(communicator)
+        # a client seeing a gap itself asks for a delta, or for everything
+        await communicator.send_json_to({"type": "resync", "since": missed.id})
+        resynced = await read_sync(communicator)
+        await communicator.send_json_to({"type": "resync"})
+        full = await read_sync(communicator)
+        await communicator.disconnect()
+        return snapshot, missed, last, caught_up, resynced, full
+    snapshot, missed, last, caught_up, resynced, full = asyncio.run(run())
+    assert snapshot[0]["version"] == first.id
+    assert [(frame["type"], frame["from"], frame["version"]) for frame in caught_up] == [("delta", first.id, last.id)]
+    assert [row["id"] for row in caught_up[0]["rows"]] == [missed.id, last.id]
+    assert [(frame["type"], frame["from"]) for frame in resynced] == [("delta", missed.id)]
+    assert [row["id"] for row in resynced[0]["rows"]] == [last.id]
+    assert [frame["type"] for frame in full] == ["snapshot"]
+    assert [row["id"] for row in full[0]["rows"]] == [first.id, missed.id, last.id]
+
+def test_sync_since_past_retention_horizon_gets_snapshot(clean_history, monkeypatch):
+    from channels.testing import WebsocketCommunicator
+    from main_app import snapshot
+    from main_app.retention import Retention
+    from CalculatorApp.asgi import application
+    ids = [row.id for row in store_history([False] * 4)]
+    # the newest 2 rows are kept
+    record = asyncio.run(Retention(None, 2, None, None, TMP_DIR, 100, None).run())
+    assert (record.deleted, record.version) == (2, ids[-1])
+    newer = [row.id for row in store_history([False] * 2)]
+    # a fresh process knows the horizon from calc_retention_run
+    monkeypatch.setattr(snapshot, "_snapshot", None)
+    async def sync(since):
+        communicator = WebsocketCommunicator(application, f"/ws/sync?since={since}")
+        await communicator.connect()
+        frames = await read_sync(communicator)
+        await communicator.disconnect()
+        return [(frame["type"], [row["id"] for row in frame["rows"]]) for frame in frames]
+    async def run():
+        return [await sync(since) for since in (ids[0], ids[-1], newer[-1] + 100, newer[0])]
+    away, at_run, unknown, after_run = asyncio.run(run())
+    assert away == at_run == unknown == [("snapshot", ids[2:] + newer)]
+    assert after_run == [("delta", newer[1:])]
+
+def test_encoded_rows_match_serializer(clean_history):
+    import datetime
+    from django.test import override_settings
+    from main_app.models import CalculatedResult
+    from main_app.serializers import CalculatedResultSerializer
+    from main_app.snapshot import encode_row, ROW_FIELDS
+    values = [
+        ("1/3", "0.3333", datetime.datetime(2026, 10, 17, 7, 30, 0, 250)),
+        ("2*3", "-6", datetime.datetime(2026, 10, 17, 7, 30)),
+        ("√2·π \"quoted\" \\ 😀", "1e+308", datetime.datetime(1999, 12, 31, 23, 59, 59, 999999)),
+        ("1+\x1c2\t\n ", "-nan", datetime.datetime(2026, 3, 29, 2, 30, 0, 1)),
+    ]
+    stored = CalculatedResult.objects.bulk_create(
+        CalculatedResult(expression=expression, result=result, float_mode=True) for expression, result, _ in values
+    )
+    for row, (_, _, timestamp) in zip(stored, values):
+        CalculatedResult.objects.filter(id=row.id).update(timestamp=timestamp)
+    loaded = CalculatedResult.objects.order_by("id")
+    rows = list(loaded.values_list(*ROW_FIELDS))
+    assert [encode_row(*row) for row in rows] == [json.dumps(CalculatedResultSerializer(row).data) for row in loaded]
+    # values as the ORM returns them with time zones on, and aware ones without
+    moscow = datetime.timezone(datetime.timedelta(hours=3))
+    aware = [
+        datetime.datetime(2026, 10, 17, 4, 30, 0, 250, tzinfo=datetime.timezone.utc),
+        datetime.datetime(2026, 10, 17, 7, 30, tzinfo=moscow),
+        datetime.datetime(2026, 10, 17, 7, 30),
+    ]
+    for use_tz in (True, False):
+        with override_settings(USE_TZ=use_tz):
+            for timestamp in aware:
+                row = CalculatedResult(id=7, expression="1/3", result="0.3333", timestamp=timestamp)
+                assert encode_row(7, "1/3", "0.3333", timestamp) == json.dumps(CalculatedResultSerializer(row).data)
+    assert encode_row(7, "1", "1", None) == json.dumps(CalculatedResultSerializer(CalculatedResult(id=7, expression="1", result="1")).data)
+
+def test_sync_subscriptions_get_matching_rows(clean_history):
+    from channels.testing import WebsocketCommunicator
+    from main_app.models import CalculatedResult
+    from main_app.writebehind import store_results
+    from CalculatorApp.asgi import application
+    def results(rows):
+        return [
+            CalculatedResult(expression=f"{i}+0", result=str(i), float_mode=float_mode, session=session)
+            for i, (float_mode, session) in enumerate(rows)
+        ]
+    stored = CalculatedResult.objects.bulk_create(results([(False, "alice"), (True, "bob"), (True, "alice"), (False, "")]))
+    queries = {
+        "own": "own=true&session=alice",
+        "float": "mode=float",
+        "last": "last=2",
+        "bob_int": "own=true&session=bob&mode=int&last=1",
+    }
+    async def run():
+        communicators = {name: WebsocketCommunicator(application, f"/ws/sync?since=0&{query}") for name, query in queries.items()}
+        snapshots = {}
+        for name, communicator in communicators.items():
+            await communicator.connect()
+            snapshots[name] = await read_sync(communicator)
+        added = results([(True, "bob"), (False, "alice")])
+        await store_results(added)
+        deltas = {name: await read_sync(communicator) for name, communicator in communicators.items()}
+        rejected = WebsocketCommunicator(application, "/ws/sync?since=0&own=true")
+        await rejected.connect()
+        closed = await rejected.receive_output(1)
+        for communicator in [*communicators.values(), rejected]:
+            await communicator.disconnect()
+        return snapshots, added, deltas, closed
+    snapshots, added, deltas, closed = asyncio.run(run())
+    ids = [row.id for row in stored]
+    new = [row.id for row in added]
+    def rows(frames):
+        return [[row["id"] for row in frame["rows"]] for frame in frames]
+    assert {name: rows(frames) for name, frames in snapshots.items()} == {
+        "own": [[ids[0], ids[2]]], "float": [[ids[1], ids[2]]], "last": [ids[2:]], "bob_int": [[]],
+    }
+    # versions stay global
+    assert {frame["version"] for frames in snapshots.values() for frame in frames} == {ids[-1]}
+    assert {name: rows(frames) for name, frames in deltas.items()} == {
+        "own": [[new[1]]], "float": [[new[0]]], "last": [new], "bob_int": [],
+    }
+    assert all((frame["from"], frame["version"]) == (ids[-1], new[-1]) for frames in deltas.values() for frame in frames)
+    assert closed["type"] == "websocket.close" and closed["code"] == 4002
+
+def test_migrations_add_columns_and_indexes(clean_history):
+    from django.core.management import call_command
+    from django.db import connection
+    def table(name):
+        with connection.cursor() as cursor:
+            columns = {row[1]: row[4] for row in cursor.execute(f"PRAGMA table_info({name})")}
+            indexes = {row[1] for row in cursor.execute(f"PRAGMA index_list({name})")}
+        return columns, indexes
+    call_command("migrate", "main_app", "0001", verbosity=0)
+    try:
+        assert "float_mode" not in table("calc_result")[0]
+        # rows stored before 0002 get its defaults
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO calc_result (expression, result, timestamp) VALUES ('1+1', '2', '2026-10-17 07:30:00')")
+    finally:
+        call_command("migrate", "main_app", verbosity=0)
+    columns, indexes = table("calc_result")
+    assert (columns["float_mode"], columns["session"]) == ("0", "''")
+    assert {"calc_result_timestamp_idx", "calc_result_session_idx", "calc_result_float_mode_idx"} <= indexes
+    assert set(table("calc_result_archive")[0]) >= {"id", "expression", "result", "timestamp", "float_mode", "session", "archived_at"}
+    assert "version" in table("calc_retention_run")[0]
+    from main_app.models import CalculatedResult
+    assert list(CalculatedResult.objects.values_list("float_mode", "session")) == [(False, "")]
+
+def test_history_reads_use_read_only_alias(clean_history, monkeypatch):
+    from django.db import connections, OperationalError
+    from django.test import AsyncClient
+    from django.test.utils import CaptureQueriesContext
+    from main_app import database
+    from main_app.database import get_database
+    from main_app.models import CalculatedResult
+    store_history([False, True])
+    aliases = []
+    call = database.DatabaseThreads._call
+    def counted_call(alias, func, args):
+        with CaptureQueriesContext(connections[alias]) as captured:
+            result = call(alias, func, args)
+        aliases.extend(alias for _ in captured.captured_queries)
+        return result
+    monkeypatch.setattr(database.DatabaseThreads, "_call", staticmethod(counted_call))
+    client = AsyncClient(headers={"host": "localhost"})
+    async def run():
+        page = await client.get("/history")
+        query_only = await get_database().read(
+            lambda: connections[settings.HISTORY_DB].cursor().execute("PRAGMA query_only").fetchone()[0]
+        )
+        try:
+            await get_database().read(lambda: CalculatedResult.objects.using(settings.HISTORY_DB).create(expression="1", result="1"))
+        except OperationalError as e:
+            error = str(e)
+        return page, query_only, error
+    page, query_only, error = asyncio.run(run())
+    assert page.status_code == 200 and len(page.json()["rows"]) == 2
+    assert aliases and set(aliases) == {settings.HISTORY_DB}
+    assert query_only == 1
+    assert "readonly" in error
+    assert CalculatedResult.objects.count() == 2
+
+def test_binary_wire_format():
+    import datetime
+    from main_app import codec
+    from main_app.snapshot import encode_row
+    from client.controller import codec as client_codec
+    start = datetime.datetime(2026, 10, 17, 7, 30)
+    delta = [
+        (5, "1+2", "3", start),
+        (7, "(4/3)", "-1.3333", start + datetime.timedelta(seconds=1, microseconds=5)),
+        (8, "2*-", "-nan", start - datetime.timedelta(microseconds=1)),
+    ]
+    # both sides hold the format: server bytes are pinned here, the client decodes these bytes
+    frames = [
+        (codec.DELTA, (4, 8), delta, "3404040301020180b8b7f98781af068a897a8b897a0305031a2e4d3f2cb00107043a1b3333acdc"),
+        (codec.SNAPSHOT, (8, True), [(9, "√4", "2", start)], "6108010980b8b7f98781af0604e2889a340120"),
+        (codec.SNAPSHOT_END, (8,), None, "0308"),
+    ]
+    for kind, header, rows, wire in frames:
+        data = codec.encode_frame(codec.BINARY, kind, header, rows)
+        assert data.hex() == wire
+        text = codec.encode_frame(codec.JSON, kind, header, None if rows is None else [encode_row(*row) for row in rows])
+        assert client_codec.decode_frame(bytes.fromhex(wire)) == json.loads(text)
+    for name in ("SNAPSHOT", "SNAPSHOT_CHUNK", "SNAPSHOT_END", "DELTA", "PACKED_EXPRESSIONS", "PACKED_RESULTS",
+                 "MORE", "ZLIB", "EPOCH", "EXPRESSION_SYMBOLS", "RESULT_SYMBOLS", "HEX_DIGITS"):
+        assert getattr(client_codec, name) == getattr(codec, name), name
+
+def test_error_messages_follow_calculator_h():
+    import re
+    from main_app.runner import CalcError
+    with open(os.path.join(ROOT, "src", "calculator.h")) as file:
+        codes = dict(re.findall(r"CALC_ERR_(\w+) = (\d+)", file.read()))
+    assert {int(code) for code in codes.values()} == {1, 2, 3, 4, 5}
+    assert CalcError(int(codes["NO_MEMORY"])).reason == "Out of memory"
+    assert CalcError(int(codes["PARENTHESIS"])).reason == "Not closed parenthesis"
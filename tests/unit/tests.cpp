@@ -1,4 +1,7 @@
 #include <gtest/gtest.h>
+#include <string>
+#include <thread>
+#include <vector>
 
 extern "C" {
 #include "../../src/calculator.h"
@@ -125,6 +128,155 @@ TEST(CalculateExpr, CalculateFloat)
     EXPECT_NEAR(calculate_expression(buff).floatValue, 2.5, FLOAT_PRECISION);
 }
 
+// Tests for reentrant context API
+TEST(ContextEval, CalculateInt)
+{
+    char buff[] = "(5-4+1-1)*(5/2)";
+    CalcContext ctx;
+    calc_init(&ctx, INT_MODE);
+    EXPECT_EQ(calc_expression(&ctx, buff).intValue, 2);
+    EXPECT_EQ(ctx.error, CALC_OK);
+}
+
+TEST(ContextEval, IndependentContexts)
+{
+    char buff[] = "12+3*4";
+    CalcContext int_ctx;
+    CalcContext float_ctx;
+    calc_init(&int_ctx, INT_MODE);
+    calc_init(&float_ctx, FLOAT_MODE);
+    // interleave two evaluations over the same buffer
+    NumberType first = calc_get_product(&int_ctx, buff);
+    NumberType second = calc_get_product(&float_ctx, buff);
+    EXPECT_EQ(first.intValue, 12);
+    EXPECT_NEAR(second.floatValue, 12.0, FLOAT_PRECISION);
+    EXPECT_EQ(int_ctx.pos, 2);
+    EXPECT_EQ(float_ctx.pos, 2);
+}
+
+TEST(ContextEval, ErrorsAreReturned)
+{
+    struct {
+        const char* input;
+        Mode mode;
+        CalcStatus status;
+    } cases[] = {
+        {"5/0", INT_MODE, CALC_ERR_INT_DIV_BY_ZERO},
+        {"5/(1-1)", FLOAT_MODE, CALC_ERR_FLOAT_DIV_BY_ZERO},
+        {"2+a", INT_MODE, CALC_ERR_INVALID_INPUT},
+        {"2 3", INT_MODE, CALC_ERR_INVALID_INPUT},
+        {"(2+3", INT_MODE, CALC_ERR_PARENTHESIS},
+        {"2+3)", INT_MODE, CALC_ERR_PARENTHESIS},
+    };
+    for (const auto& c : cases) {
+        char buff[MAX_BUFFER_SIZE];
+        NumberType result;
+        strcpy(buff, c.input);
+        EXPECT_EQ(calc_evaluate(c.mode, buff, &result), c.status) << c.input;
+    }
+}
+
+TEST(ContextEval, FormatResult)
+{
+    char buff[] = " 32 * 7 / 63 + 41 ";
+    char out[MAX_RESULT_SIZE];
+    EXPECT_EQ(calc_evaluate_to_string(1, buff, out, sizeof(out)), CALC_OK);
+    EXPECT_STREQ(out, "44.5556");
+}
+
+TEST(ContextEval, ParallelEvaluation)
+{
+    std::vector<std::thread> threads;
+    std::vector<long> results(8);
+    for (size_t i = 0; i < results.size(); ++i) {
+        threads.emplace_back([i, &results]() {
+            for (int n = 0; n < 1000; ++n) {
+                char buff[MAX_BUFFER_SIZE];
+                NumberType result;
+                snprintf(buff, sizeof(buff), "(%zu+1)*(2+%d)-%d*(%zu+1)", i, n, n, i);
+                if (calc_evaluate(INT_MODE, buff, &result) != CALC_OK) return;
+                results[i] = result.intValue;
+            }
+        });
+    }
+    for (auto& t : threads) {
+        t.join();
+    }
+    for (size_t i = 0; i < results.size(); ++i) {
+        EXPECT_EQ(results[i], 2 * (long)(i + 1));
+    }
+}
+
+// Tests for streaming evaluator
+static CalcStatus stream_eval(Mode mode, const std::string& input, size_t chunk, NumberType* result)
+{
+    CalcStream stream;
+    calc_stream_init(&stream, mode);
+    for (size_t i = 0; i < input.size(); i += chunk) {
+        calc_stream_feed(&stream, input.data() + i, std::min(chunk, input.size() - i));
+    }
+    CalcStatus status = calc_stream_finish(&stream, result);
+    calc_stream_free(&stream);
+    return status;
+}
+
+TEST(StreamEval, ChunkedInput)
+{
+    std::string input = " 7 - 4 +3*(5 + 9*8 - (7+3) / 10) * 2";
+    for (size_t chunk = 1; chunk <= input.size(); ++chunk) {
+        NumberType result;
+        ASSERT_EQ(stream_eval(INT_MODE, input, chunk, &result), CALC_OK);
+        EXPECT_EQ(result.intValue, 459);
+    }
+}
+
+TEST(StreamEval, MatchesRecursiveEvaluator)
+{
+    const char* inputs[] = {"(8*9-67)/(5-7*6)+23", "32*7/63+41", "(0-5)*0", "1-2-3-4/5/6*7", "((2))"};
+    for (const char* input : inputs) {
+        char buff[MAX_BUFFER_SIZE];
+        strcpy(buff, input);
+        CalcContext ctx;
+        calc_init(&ctx, FLOAT_MODE);
+        NumberType expected = calc_expression(&ctx, buff);
+        NumberType result;
+        ASSERT_EQ(stream_eval(FLOAT_MODE, input, 3, &result), CALC_OK) << input;
+        // same operation order gives bit-identical doubles, including -0.0
+        EXPECT_EQ(memcmp(&result, &expected, sizeof(NumberType)), 0) << input;
+    }
+}
+
+TEST(StreamEval, DeepNesting)
+{
+    const size_t depth = 100000;
+    std::string input = std::string(depth, '(') + "6/4" + std::string(depth, ')') + "*2";
+    NumberType result;
+    ASSERT_EQ(stream_eval(INT_MODE, input, CHUNK_SIZE, &result), CALC_OK);
+    EXPECT_EQ(result.intValue, 2);
+}
+
+TEST(StreamEval, ErrorPriority)
+{
+    struct {
+        const char* input;
+        CalcStatus status;
+    } cases[] = {
+        {"5/0+a", CALC_ERR_INVALID_INPUT}, // invalid symbol wins over evaluation error
+        {"(5/0", CALC_ERR_PARENTHESIS},    // unbalanced parenthesis wins over evaluation error
+        {"(2+", CALC_ERR_PARENTHESIS},
+        {"2+", CALC_ERR_INVALID_INPUT},
+        {"()", CALC_ERR_PARENTHESIS},
+        {"(2)3", CALC_ERR_INVALID_INPUT}, // implicit multiplication
+        {"2(3)", CALC_ERR_INVALID_INPUT},
+        {"1/0*(2)3", CALC_ERR_INT_DIV_BY_ZERO},
+        {"", CALC_OK},
+    };
+    for (const auto& c : cases) {
+        NumberType result;
+        EXPECT_EQ(stream_eval(INT_MODE, c.input, 1, &result), c.status) << c.input;
+    }
+}
+
 int main(int argc, char** argv)
 {
     testing::InitGoogleTest(&argc, argv);